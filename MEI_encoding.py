@@ -1,7 +1,9 @@
 from rodan.jobs.base import RodanTask
 import build_mei_file as bm
 import parse_classifier_table as pct
-import json
+import jsomr_ingest
+from instrumentation import Instrumentation
+from mei_validator import StructureValidator
 
 from celery.utils.log import get_task_logger
 
@@ -27,6 +29,29 @@ class MEI_encoding(RodanTask):
                 'minimum': 0.0,
                 'maximum': 10.0,
                 'description': 'A multiplier controlling the spacing allowed between two neume components when grouping into neumes. 1.0 will use the median width of all glyphs on the page, 2.0 will use twice the median width, and so on. At 0, neume components will not be merged together, and each one will be treated as its own neume.',
+            },
+            'Output Format': {
+                'type': 'string',
+                'enum': ['standard', 'compact', 'minified'],
+                'default': 'standard',
+                'description': 'How the MEI file is written. Standard gives every element a random ID, like libmei does. Compact gives them short IDs numbered in order (z1, nc2, ...), so encoding the same page again gives the same file. Minified is compact without indentation or line breaks.',
+            },
+            'Memory Limit': {
+                'type': 'integer',
+                'default': 0,
+                'minimum': 0,
+                'description': 'At more than 0, encode in memory-bounded mode: the page fails instead of taking more than about this many megabytes of memory on top of what the worker already uses, and its peak memory use is logged. At 0, there is no limit.',
+            },
+            'Staff Workers': {
+                'type': 'integer',
+                'default': 0,
+                'minimum': 0,
+                'description': 'At more than 1, the staves of the page are encoded in parallel over this many processes, with the same result. Only useful for very dense pages, and only where the job may start processes of its own; otherwise, staves are encoded one after the other. Not used in memory-bounded mode.',
+            },
+            'Classifier Aliases': {
+                'type': 'string',
+                'default': '',
+                'description': 'Glyph classes to encode as other classes of the MEI mapping CSV, as name=target pairs separated by commas (e.g. neume.podatus3=neume.podatus2). Whatever the aliases, a class that is not in the CSV is encoded as the closest more general class that is, leaving off the last dotted part of its name one at a time (neume.podatus2.variant as neume.podatus2, and so on).',
             }
         }
     }
@@ -63,10 +88,13 @@ class MEI_encoding(RodanTask):
     def run_my_task(self, inputs, settings, outputs):
         self.logger.info(settings)
 
+        # in memory-bounded mode, the JSON inputs are never held in memory as a whole
+        memory_limit = settings.get(u'Memory Limit') or None
+        backend = 'stream' if memory_limit else 'auto'
+
         jsomr_path = inputs['JSOMR'][0]['resource_path']
         self.logger.info('loading jsomr...')
-        with open(jsomr_path, 'r') as file:
-            jsomr = json.loads(file.read())
+        jsomr = jsomr_ingest.load_jsomr(jsomr_path, backend)
 
         try:
             alignment_path = inputs['Text Alignment JSON'][0]['resource_path']
@@ -75,17 +103,28 @@ class MEI_encoding(RodanTask):
             syls = None
         else:
             self.logger.info('loading text alignment results..')
-            with open(alignment_path, 'r') as file:
-                syls = json.loads(file.read())
+            syls = jsomr_ingest.load_alignment(alignment_path, backend)
 
         self.logger.info('fetching classifier...')
-        classifier_table = pct.fetch_table_from_csv(inputs['MEI Mapping CSV'][0]['resource_path'])
+        classifier_table = pct.ClassifierResolver(
+            pct.load_classifier(inputs['MEI Mapping CSV'][0]['resource_path'], logger=self.logger),
+            pct.parse_aliases(settings.get(u'Classifier Aliases') or ''))
         width_mult = settings[u'Neume Component Spacing']
-        mei_string = bm.process(jsomr, syls, classifier_table, width_mult)
+        output_format = settings.get(u'Output Format', 'standard')
+        staff_workers = settings.get(u'Staff Workers') or None
+        if memory_limit:
+            staff_workers = None
 
-        self.logger.info('writing to file...')
+        self.logger.info('encoding and writing to file...')
         outfile_path = outputs['MEI'][0]['resource_path']
-        with open(outfile_path, 'w') as file:
-            file.write(mei_string)
+        validator = StructureValidator()
+        bm.process(jsomr, syls, classifier_table, width_mult, output_path=outfile_path,
+                   instrumentation=Instrumentation(logger=self.logger),
+                   output_format=output_format,
+                   memory_limit=memory_limit * 1000000 if memory_limit else None,
+                   validator=validator, staff_workers=staff_workers, logger=self.logger)
+        if validator.count:
+            self.logger.warning('the MEI has {} structural errors:\n{}'.format(
+                validator.count, validator.report()))
 
         return True
@@ -0,0 +1,151 @@
+from rodan.jobs.base import RodanTask
+import batch_encode
+import parse_classifier_table as pct
+import multiprocessing
+import os
+
+from celery.utils.log import get_task_logger
+
+
+def resource_paths(inputs, port):
+    '''
+    Returns the paths of all resources given to the input @port, in order, whether they arrive
+    as one entry per resource or as a resource list.
+    '''
+    paths = []
+    for entry in inputs.get(port, []):
+        path = entry['resource_path']
+        paths.extend(path if isinstance(path, (list, tuple)) else [path])
+    return paths
+
+
+class MEI_encoding_batch(RodanTask):
+    name = 'MEI Encoding (Batch)'
+    author = 'Tim de Reuse'
+    description = 'Builds MEI files for a list of pages from pitchfinding information and transcript alignment results, all in one task.'
+    enabled = True
+    category = "Encoding"
+    interactive = False
+    logger = get_task_logger(__name__)
+
+    settings = {
+        'title': 'Mei Encoding Settings',
+        'type': 'object',
+        'job_queue': 'Python2',
+        'required': ['Neume Component Spacing'],
+        'properties': {
+            'Neume Component Spacing': {
+                'type': 'number',
+                'default': 0.5,
+                'minimum': 0.0,
+                'maximum': 10.0,
+                'description': 'A multiplier controlling the spacing allowed between two neume components when grouping into neumes. 1.0 will use the median width of all glyphs on the page, 2.0 will use twice the median width, and so on. At 0, neume components will not be merged together, and each one will be treated as its own neume.',
+            },
+            'Worker Processes': {
+                'type': 'integer',
+                'default': 0,
+                'minimum': 0,
+                'maximum': 64,
+                'description': 'How many pages to encode at once. At 0, one page per available core. Pages are encoded one at a time if the task runs somewhere it cannot start worker processes.',
+            },
+            'Output Format': {
+                'type': 'string',
+                'enum': ['standard', 'compact', 'minified'],
+                'default': 'standard',
+                'description': 'How the MEI file is written. Standard gives every element a random ID, like libmei does. Compact gives them short IDs numbered in order (z1, nc2, ...), so encoding the same page again gives the same file. Minified is compact without indentation or line breaks.',
+            },
+            'Memory Limit': {
+                'type': 'integer',
+                'default': 0,
+                'minimum': 0,
+                'description': 'At more than 0, encode every page in memory-bounded mode: a page fails instead of taking more than about this many megabytes of memory on top of what its worker already uses. At 0, there is no limit.',
+            },
+            'Classifier Aliases': {
+                'type': 'string',
+                'default': '',
+                'description': 'Glyph classes to encode as other classes of the MEI mapping CSV, as name=target pairs separated by commas (e.g. neume.podatus3=neume.podatus2). Whatever the aliases, a class that is not in the CSV is encoded as the closest more general class that is, leaving off the last dotted part of its name one at a time (neume.podatus2.variant as neume.podatus2, and so on).',
+            }
+        }
+    }
+
+    input_port_types = [{
+        'name': 'JSOMR',
+        'resource_types': ['application/json'],
+        'minimum': 1,
+        'maximum': 1,
+        'is_list': True
+    }, {
+        'name': 'Text Alignment JSON',
+        'resource_types': ['application/json'],
+        'minimum': 0,
+        'maximum': 1,
+        'is_list': True
+    }, {
+        'name': 'MEI Mapping CSV',
+        'resource_types': ['text/csv'],
+        'minimum': 1,
+        'maximum': 1,
+        'is_list': False
+    }
+    ]
+
+    output_port_types = [{
+        'name': 'MEI',
+        'resource_types': ['application/mei+xml'],
+        'minimum': 1,
+        'maximum': 1,
+        'is_list': True
+    }]
+
+    def run_my_task(self, inputs, settings, outputs):
+        self.logger.info(settings)
+
+        # pages are paired up by their position in the two lists
+        jsomr_paths = resource_paths(inputs, 'JSOMR')
+        alignment_paths = resource_paths(inputs, 'Text Alignment JSON')
+        if not alignment_paths:
+            self.logger.warning('no text alignment given! using dummy syllables...')
+            alignment_paths = [None] * len(jsomr_paths)
+        elif len(alignment_paths) != len(jsomr_paths):
+            raise ValueError('got {} JSOMR files but {} text alignment files'.format(
+                len(jsomr_paths), len(alignment_paths)))
+
+        out_folder = outputs['MEI'][0]['resource_folder']
+        pages = [
+            batch_encode.Page(
+                '{:05d}'.format(i), jsomr, syls, os.path.join(out_folder, '{:05d}.mei'.format(i)))
+            for i, (jsomr, syls) in enumerate(zip(jsomr_paths, alignment_paths))
+        ]
+
+        self.logger.info('fetching classifier...')
+        classifier_table = pct.ClassifierResolver(
+            pct.load_classifier(inputs['MEI Mapping CSV'][0]['resource_path'], logger=self.logger),
+            pct.parse_aliases(settings.get(u'Classifier Aliases') or ''))
+        width_mult = settings[u'Neume Component Spacing']
+        output_format = settings.get(u'Output Format', 'standard')
+        memory_limit = settings.get(u'Memory Limit') or None
+
+        # worker processes of a prefork celery pool are daemonic and can't have children
+        processes = settings.get(u'Worker Processes') or None
+        if multiprocessing.current_process().daemon:
+            processes = 1
+
+        def progress(result):
+            if result.error:
+                self.logger.error('page {} failed:\n{}'.format(result.name, result.error))
+            elif result.violations:
+                self.logger.warning('page {} has structural errors:\n{}'.format(result.name, result.violations))
+            else:
+                self.logger.info('encoded page {} in {:.3f}s'.format(result.name, result.seconds))
+
+        self.logger.info('encoding {} pages...'.format(len(pages)))
+        results = batch_encode.encode_pages(
+            pages, classifier_table, width_mult, processes, progress, output_format=output_format,
+            memory_limit=memory_limit * 1000000 if memory_limit else None)
+
+        failed = [r.name for r in results if r.error is not None]
+        if failed:
+            raise RuntimeError('{} of {} pages failed to encode: {}'.format(
+                len(failed), len(pages), ', '.join(failed)))
+
+        return True
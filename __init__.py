@@ -5,3 +5,4 @@ import logging
 logger = logging.getLogger("rodan")
 from rodan.jobs import module_loader
 module_loader("rodan.jobs.MEI_encoding.MEI_encoding")
+module_loader("rodan.jobs.MEI_encoding.MEI_encoding_batch")
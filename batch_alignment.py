@@ -0,0 +1,162 @@
+import numpy as np
+import build_mei_file as bm
+from glyph_table import GlyphTable
+
+# numpy is only needed by this module, which nothing in the rodan jobs imports; it is an optional
+# way of aligning many pages at once, giving the same pairs as build_mei_file
+
+# most (syllable box, candidate glyph) cells compared at once; boxes are taken in chunks that stay
+# under this, whatever the number of glyphs within a line spacing of each box
+CHUNK_CELLS = 1 << 20
+
+# stands for "no candidate" among the positions found
+NO_GLYPH = np.iinfo(np.int64).max
+
+
+def _glyph_columns(glyphs):
+    # ulx, uly and horizontal center of every glyph, in page order
+    if isinstance(glyphs, GlyphTable):
+        ulx = np.array(glyphs.ulx, dtype=np.float64)
+        uly = np.array(glyphs.uly, dtype=np.float64)
+        ncols = np.array(glyphs.ncols, dtype=np.float64)
+    else:
+        boxes = [g['bounding_box'] for g in glyphs]
+        ulx = np.array([bb['ulx'] for bb in boxes], dtype=np.float64)
+        uly = np.array([bb['uly'] for bb in boxes], dtype=np.float64)
+        ncols = np.array([bb['ncols'] for bb in boxes], dtype=np.float64)
+    return ulx, uly, ulx + ncols // 2
+
+
+class _Batch(object):
+    '''
+    The glyphs and syllable boxes of a batch of pages, laid out for the vectorized search: the
+    glyphs of every page sorted by uly, one page after the other, so that the glyphs within the
+    vertical band of a syllable box (y_low < uly < y_high) are the slice [lo, hi) of the columns.
+    '''
+
+    def __init__(self, pages):
+        ulx, uly, center, pos = [], [], [], []
+        box_x, box_lo, box_hi, self.box_ranges = [], [], [], []
+        offset = num_boxes = 0
+        for glyphs, syl_boxes, median_line_spacing in pages:
+            syl_boxes = syl_boxes or []
+            page_ulx, page_uly, page_center = _glyph_columns(glyphs)
+            order = np.argsort(page_uly, kind='stable')
+            page_uly = page_uly[order]
+            ulx.append(page_ulx[order])
+            uly.append(page_uly)
+            center.append(page_center[order])
+            pos.append(order)
+
+            y_high = np.array([box['ul'][1] for box in syl_boxes], dtype=np.float64)
+            box_x.append(np.array([box['ul'][0] for box in syl_boxes], dtype=np.float64))
+            box_lo.append(offset + np.searchsorted(page_uly, y_high - median_line_spacing, 'right'))
+            box_hi.append(offset + np.searchsorted(page_uly, y_high, 'left'))
+            self.box_ranges.append((num_boxes, num_boxes + len(syl_boxes)))
+            offset += len(page_uly)
+            num_boxes += len(syl_boxes)
+
+        def join(parts, dtype):
+            return np.concatenate(parts).astype(dtype) if parts else np.empty(0, dtype)
+
+        self.ulx = join(ulx, np.float64)
+        self.uly = join(uly, np.float64)
+        self.center = join(center, np.float64)
+        self.pos = join(pos, np.int64)
+        self.box_x = join(box_x, np.float64)
+        self.box_lo = join(box_lo, np.int64)
+        self.box_hi = join(box_hi, np.int64)
+
+    def candidates(self):
+        '''
+        Returns, for every syllable box, the position of the leftmost glyph of its page (by ulx,
+        then position) within its band and with its center strictly to the right of the box, or
+        NO_GLYPH if there is none. Glyphs already taken by earlier boxes are not excluded here.
+        '''
+        best = np.full(len(self.box_x), NO_GLYPH, dtype=np.int64)
+        if not len(best):
+            return best
+        widths = self.box_hi - self.box_lo
+        rows = max(1, CHUNK_CELLS // max(1, int(widths.max())))
+        for start in range(0, len(best), rows):
+            # every band of the chunk is padded to the widest among them
+            width = int(widths[start:start + rows].max())
+            if width > 0:
+                best[start:start + rows] = self._leftmost(start, min(start + rows, len(best)), width)
+        return best
+
+    def _leftmost(self, start, stop, width):
+        # rows are the boxes [start, stop), columns the glyphs of their bands in uly order
+        offsets = np.arange(width)
+        in_band = offsets < (self.box_hi[start:stop] - self.box_lo[start:stop])[:, None]
+        cells = np.minimum(self.box_lo[start:stop, None] + offsets, len(self.ulx) - 1)
+        mask = in_band & (self.center[cells] > self.box_x[start:stop, None])
+        ulx = np.where(mask, self.ulx[cells], np.inf)
+        leftmost = ulx.min(axis=1)
+        # among the glyphs that are equally far left, the one that comes first on the page
+        pos = np.where(mask & (ulx == leftmost[:, None]), self.pos[cells], NO_GLYPH)
+        return pos.min(axis=1)
+
+    def leftmost_from(self, box, first_pos):
+        '''
+        Same as candidates, for the single syllable @box, but only among glyphs at positions from
+        @first_pos on. Returns None if there is none.
+        '''
+        band = slice(self.box_lo[box], self.box_hi[box])
+        mask = (self.center[band] > self.box_x[box]) & (self.pos[band] >= first_pos)
+        if not mask.any():
+            return None
+        ulx = np.where(mask, self.ulx[band], np.inf)
+        return int(np.where(mask & (ulx == ulx.min()), self.pos[band], NO_GLYPH).min())
+
+
+def find_anchor_starts_batch(pages):
+    '''
+    Vectorized version of build_mei_file.anchor_starts for many pages in one call. Takes an
+    iterable of (glyphs, syl_boxes, median_line_spacing) triples and returns the start positions
+    of every page's syllable boxes (none for a page without), exactly as anchor_starts computes
+    them.
+
+    The candidate anchor of every syllable box of every page is computed at once, with broadcast
+    masks over the glyphs within a line spacing of each box. Only the selection of the anchors
+    is sequential, since each box can only take glyphs that no earlier box on its page has; a
+    candidate that an earlier box has already passed is searched for again among the glyphs
+    that are left.
+    '''
+    pages = list(pages)
+    batch = _Batch(pages)
+    best = batch.candidates().tolist()
+
+    results = []
+    for first, last in batch.box_ranges:
+        starts = []
+        last_used = 0
+        for box in range(first, last):
+            pos = best[box]
+            if pos != NO_GLYPH and pos < last_used:
+                pos = batch.leftmost_from(box, last_used)
+            if pos is None or pos == NO_GLYPH:
+                starts.append(last_used)
+                continue
+            starts.append(pos)
+            last_used = pos
+        results.append(starts)
+    return results
+
+
+def neume_to_lyric_alignment_batch(pages):
+    '''
+    Vectorized neume-to-lyric alignment for many pages in one call. Takes an iterable of
+    (glyphs, syl_boxes, median_line_spacing) triples, as would be passed to
+    build_mei_file.neume_to_lyric_alignment, and returns a list with the pairs of each page in
+    the same order. That function remains the reference implementation; this one returns the same
+    pairs.
+    '''
+    pages = list(pages)
+    results = []
+    for (glyphs, syl_boxes, median_line_spacing), starts in zip(pages, find_anchor_starts_batch(pages)):
+        if not syl_boxes:
+            results.append(bm.dummy_syllable_pairs(glyphs))
+        else:
+            results.append(bm.pairs_from_starts(glyphs, syl_boxes, starts))
+    return results
@@ -0,0 +1,300 @@
+'''
+Encodes a whole manuscript outside of Rodan, one MEI file per page, using every core.
+
+Pages are given either as directories:
+    python batch_encode.py classifier.csv --jsomr-dir ./jsomr-split --syls-dir ./syl_json --out-dir ./out_mei
+where every JSOMR file is paired with the text alignment JSON of the same name (if there is one),
+or as a CSV manifest with jsomr, syls and output columns (syls may be left empty):
+    python batch_encode.py classifier.csv --manifest pages.csv
+
+The classifier is loaded once and handed to the worker processes. A page that fails to encode
+is reported and skipped; the rest of the batch carries on. With --metrics, the measurements
+of every page (see instrumentation.py) are written next to its MEI file as <output>.metrics.json,
+and with --profile, a cProfile dump of every page is written as <output>.prof. With
+--incremental, pages are re-encoded with incremental.encode_incremental, so that only what
+changed since the last run on the same output directory is encoded again. --output-format picks
+one of the formats in mei_writer.OUTPUT_FORMATS, e.g. compact for reproducible IDs. With
+--memory-limit, every page is encoded in memory-bounded mode (see memory_guard.py), and fails
+once encoding it has taken more than about that many megabytes; with --metrics, its peak memory
+use is recorded too.
+Every page is checked for structural errors as it is written (see mei_validator.py) unless
+--no-validate is given; pages with any are reported, and make the batch exit with an error.
+With --png-dir, the alignment of every page that has an image of the same name there (e.g.
+CF-012.png) is drawn over it into <output>_alignment.png (see visualize_alignment.py, which
+needs PIL).
+'''
+import argparse
+import csv
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+from collections import namedtuple
+
+import build_mei_file as bm
+import incremental
+import jsomr_ingest
+import parse_classifier_table as pct
+from instrumentation import Instrumentation
+from mei_validator import StructureValidator, validate_file
+from mei_writer import OUTPUT_FORMATS
+
+Page = namedtuple('Page', ['name', 'jsomr', 'syls', 'output'])
+# @violations is the report of mei_validator.StructureValidator for the page's MEI, or None if
+# there were none (or it wasn't validated)
+PageResult = namedtuple('PageResult', ['name', 'output', 'seconds', 'error', 'violations'])
+
+# set in every worker process by _init_worker
+_classifier = None
+_width_mult = 0
+_metrics = False
+_profile = False
+_incremental = False
+_output_format = None
+_memory_limit = None
+_validate = False
+
+
+def pages_from_dirs(jsomr_dir, syls_dir, out_dir):
+    '''
+    Returns a Page for every .json file in @jsomr_dir, paired with the file of the same name in
+    @syls_dir (or None if there isn't one, or no @syls_dir is given), writing to @out_dir.
+    '''
+    pages = []
+    for fname in sorted(os.listdir(jsomr_dir)):
+        name, ext = os.path.splitext(fname)
+        if ext.lower() != '.json':
+            continue
+        syls = os.path.join(syls_dir, fname) if syls_dir else None
+        if syls is not None and not os.path.isfile(syls):
+            syls = None
+        pages.append(Page(name, os.path.join(jsomr_dir, fname), syls, os.path.join(out_dir, name + '.mei')))
+    return pages
+
+
+def pages_from_manifest(fname):
+    '''
+    Returns a Page for every row of the CSV manifest @fname, which has jsomr, syls and output
+    columns. Relative paths are taken relative to the manifest.
+    '''
+    base = os.path.dirname(os.path.abspath(fname))
+
+    def resolve(path):
+        path = (path or '').strip()
+        return os.path.join(base, path) if path else None
+
+    pages = []
+    with open(fname) as f:
+        for row in csv.DictReader(f):
+            jsomr = resolve(row['jsomr'])
+            name = os.path.splitext(os.path.basename(jsomr))[0]
+            pages.append(Page(name, jsomr, resolve(row.get('syls')), resolve(row['output'])))
+    return pages
+
+
+def _init_worker(classifier, width_mult, metrics=False, profile=False, incremental=False,
+                 output_format=None, memory_limit=None, validate=False):
+    global _classifier, _width_mult, _metrics, _profile, _incremental, _output_format, _memory_limit
+    global _validate
+    _classifier = classifier
+    _width_mult = width_mult
+    _metrics = metrics
+    _profile = profile
+    _incremental = incremental
+    _output_format = output_format
+    _memory_limit = memory_limit
+    _validate = validate
+
+
+def encode_page(page):
+    '''
+    Encodes a single Page with the worker's classifier, writing the MEI to its output path.
+    Never raises: returns a PageResult, with the formatted exception as @error if encoding failed,
+    in which case an output file left by an earlier run is kept as it was.
+    '''
+    start = time.time()
+    validator = None
+    # the MEI is written next to the output and only moved over it once complete
+    tmp_path = page.output + '.tmp'
+    try:
+        # in memory-bounded mode, the JSOMR is never held in memory as a whole
+        backend = 'stream' if _memory_limit is not None else 'auto'
+        jsomr = jsomr_ingest.load_jsomr(page.jsomr, backend)
+        syls = jsomr_ingest.load_alignment(page.syls, backend) if page.syls is not None else None
+        if _incremental:
+            incremental.encode_incremental(jsomr, syls, _classifier, _width_mult, page.output)
+            if _validate:
+                # reused syllables are copied over as text, so check the file that came out
+                validator = validate_file(page.output)
+        else:
+            instrumentation = None
+            if _metrics or _profile:
+                instrumentation = Instrumentation(
+                    sidecar_path=page.output + '.metrics.json' if _metrics else None,
+                    profile=_profile, profile_path=page.output + '.prof' if _profile else None)
+            validator = StructureValidator() if _validate else None
+            bm.process(jsomr, syls, _classifier, _width_mult, output_path=tmp_path,
+                       instrumentation=instrumentation, output_format=_output_format,
+                       memory_limit=_memory_limit, validator=validator)
+            pct.replace_file(tmp_path, page.output)
+    except Exception:
+        # don't leave a half-written file behind (an incremental run cleans up after itself)
+        if not _incremental and os.path.isfile(tmp_path):
+            os.remove(tmp_path)
+        return PageResult(page.name, page.output, time.time() - start, traceback.format_exc(), None)
+    violations = validator.report() if validator is not None and validator.count else None
+    return PageResult(page.name, page.output, time.time() - start, None, violations)
+
+
+def encode_pages(pages, classifier, width_mult=0, processes=None, callback=None, metrics=False,
+                 profile=False, incremental=False, output_format=None, memory_limit=None, validate=True):
+    '''
+    Encodes all @pages in parallel over @processes worker processes (by default, one per core),
+    sharing the compiled @classifier (or parse_classifier_table.ClassifierResolver, with its
+    aliases) between them. With @processes set to 1, pages are encoded one after the other in
+    this process instead, e.g. where child processes can't be started.
+    @callback, if given, is called with each PageResult as soon as its page is done. @metrics and
+    @profile write each page's measurements and profile next to its output, and @incremental only
+    re-encodes what changed since the last run. @output_format and @memory_limit (in bytes) are
+    passed on to build_mei_file.process. With @validate, the structure of every page's MEI is
+    checked as it is written. Returns the PageResults in the order of @pages.
+    '''
+    if incremental and output_format not in (None, 'standard'):
+        # reused syllables keep the IDs of the previous run, which sequential IDs would clash with
+        raise ValueError('incremental encoding only writes the standard output format')
+    if incremental and memory_limit is not None:
+        # it reads the previous output back into memory whole
+        raise ValueError('incremental encoding can not be memory-bounded')
+    classifier = pct.resolver(classifier)
+    for page in pages:
+        out_dir = os.path.dirname(page.output)
+        if out_dir and not os.path.isdir(out_dir):
+            os.makedirs(out_dir)
+
+    if processes == 1:
+        _init_worker(classifier, width_mult, metrics, profile, incremental, output_format, memory_limit, validate)
+        results = []
+        for page in pages:
+            results.append(encode_page(page))
+            if callback is not None:
+                callback(results[-1])
+        return results
+
+    results = {}
+    pool = multiprocessing.Pool(
+        processes, _init_worker,
+        (classifier, width_mult, metrics, profile, incremental, output_format, memory_limit, validate))
+    try:
+        for result in pool.imap_unordered(encode_page, pages):
+            results[result.name, result.output] = result
+            if callback is not None:
+                callback(result)
+    finally:
+        pool.close()
+        pool.join()
+
+    return [results[page.name, page.output] for page in pages]
+
+
+def report(results, elapsed, out=sys.stdout):
+    '''
+    Writes the time taken by every page, the failures and structural errors, and the overall
+    throughput to @out.
+    '''
+    failed = [r for r in results if r.error is not None]
+    invalid = [r for r in results if r.violations is not None]
+    for r in results:
+        status = 'FAILED' if r.error else 'INVALID' if r.violations else 'ok'
+        out.write('{:<40} {:>8.3f}s  {}\n'.format(r.name, r.seconds, status))
+    for r in failed:
+        out.write('\n{} failed:\n{}'.format(r.name, r.error))
+    for r in invalid:
+        out.write('\n{} has structural errors:\n{}\n'.format(r.name, r.violations))
+
+    done = len(results) - len(failed)
+    rate = len(results) / elapsed if elapsed > 0 else float('inf')
+    out.write('\n{} pages encoded, {} failed, {} with structural errors, in {:.2f}s ({:.2f} pages/sec)\n'.format(
+        done, len(failed), len(invalid), elapsed, rate))
+
+
+def draw_alignments(results, png_dir, threads=None):
+    '''
+    Draws the alignment of every encoded page in @results over its image in @png_dir (a .png
+    named as the page) into <output>_alignment.png, in a pool of @threads threads. Pages without
+    an image are skipped. Returns a dictionary of the formatted exceptions of the pages that
+    couldn't be drawn, by name.
+    '''
+    # PIL is only needed here
+    import visualize_alignment as va
+
+    names = []
+    pages = []
+    for r in results:
+        png = os.path.join(png_dir, r.name + '.png')
+        if r.error is None and os.path.isfile(png):
+            names.append(r.name)
+            pages.append(va.OverlayPage(png, r.output, os.path.splitext(r.output)[0] + '_alignment.png'))
+    errors = va.draw_mei_files(pages, threads=threads)
+    return {name: error for name, error in zip(names, errors) if error is not None}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Encode a batch of pages into MEI files.')
+    parser.add_argument('classifier', help='MEI mapping CSV')
+    parser.add_argument('--manifest', help='CSV with jsomr, syls and output columns')
+    parser.add_argument('--jsomr-dir', help='directory of pitch finding JSOMR files')
+    parser.add_argument('--syls-dir', help='directory of text alignment JSON files, named as the JSOMR')
+    parser.add_argument('--out-dir', help='directory to write MEI files to')
+    parser.add_argument('--width-mult', type=float, default=0, help='neume component spacing')
+    parser.add_argument('--processes', type=int, default=None, help='worker processes (default: all cores)')
+    parser.add_argument('--metrics', action='store_true', help='write per-page metrics next to each MEI file')
+    parser.add_argument('--profile', action='store_true', help='write a cProfile dump next to each MEI file')
+    parser.add_argument('--incremental', action='store_true', help='only re-encode what changed since the last run')
+    parser.add_argument('--output-format', choices=list(OUTPUT_FORMATS), default='standard',
+                        help='IDs and layout of the MEI files (default: standard)')
+    parser.add_argument('--memory-limit', type=float, default=None,
+                        help='encode in memory-bounded mode, failing any page that takes more megabytes than this to encode')
+    parser.add_argument('--no-validate', action='store_true', help='skip checking the structure of the MEI files')
+    parser.add_argument('--alias', action='append', default=[], metavar='NAME=TARGET',
+                        help='encode glyphs of class NAME as class TARGET of the classifier; can be repeated')
+    parser.add_argument('--png-dir', help='directory of page images to draw the alignment of each page over')
+    args = parser.parse_args(argv)
+
+    if args.manifest:
+        pages = pages_from_manifest(args.manifest)
+    elif args.jsomr_dir and args.out_dir:
+        pages = pages_from_dirs(args.jsomr_dir, args.syls_dir, args.out_dir)
+    else:
+        parser.error('either --manifest or both --jsomr-dir and --out-dir are required')
+    if args.png_dir and OUTPUT_FORMATS[args.output_format].gzip:
+        parser.error('--png-dir can not read gzip output')
+
+    try:
+        aliases = pct.parse_aliases(','.join(args.alias))
+    except ValueError as e:
+        parser.error(str(e))
+    classifier = pct.ClassifierResolver(pct.load_classifier(args.classifier), aliases)
+
+    def progress(result):
+        status = 'failed' if result.error else 'invalid' if result.violations else 'encoded'
+        print('{} {} ({:.3f}s)'.format(status, result.name, result.seconds))
+
+    start = time.time()
+    results = encode_pages(
+        pages, classifier, args.width_mult, args.processes, progress, args.metrics, args.profile,
+        args.incremental, args.output_format,
+        int(args.memory_limit * 1e6) if args.memory_limit else None, not args.no_validate)
+    report(results, time.time() - start)
+
+    undrawn = {}
+    if args.png_dir:
+        undrawn = draw_alignments(results, args.png_dir)
+        for name, error in sorted(undrawn.items()):
+            print('\ncould not draw the alignment of {}:\n{}'.format(name, error))
+
+    return 1 if undrawn or any(r.error is not None or r.violations is not None for r in results) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
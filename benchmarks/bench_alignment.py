@@ -0,0 +1,125 @@
+'''
+Benchmark for neume_to_lyric_alignment on synthetic pages of increasing size.
+
+Compares the staff-bucketed GlyphIndex lookup used by build_mei_file against the original linear
+rescan of the page, checks that both produce the same pairs, and prints the time per glyph so that
+near-linear scaling of the indexed version can be read directly off the output.
+
+Run from the repository root:
+    python benchmarks/bench_alignment.py [max_glyphs]
+'''
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import build_mei_file as bm
+
+GLYPHS_PER_STAFF = 40
+STAFF_HEIGHT = 200
+GLYPH_WIDTH = 30
+SCAN_LIMIT = 10000      # the linear rescan is quadratic, so stop timing it past this size
+
+
+def make_page(num_glyphs, seed=0):
+    '''
+    Returns (glyphs, syl_boxes, median_line_spacing) for a synthetic page with @num_glyphs
+    neumes spread over as many staves as needed, with a syllable under roughly every third glyph.
+    '''
+    rng = random.Random(seed)
+    glyphs = []
+    syl_boxes = []
+    num_staves = (num_glyphs + GLYPHS_PER_STAFF - 1) // GLYPHS_PER_STAFF
+    for staff in range(num_staves):
+        top = staff * STAFF_HEIGHT * 2
+        for n in range(min(GLYPHS_PER_STAFF, num_glyphs - staff * GLYPHS_PER_STAFF)):
+            ulx = 100 + n * GLYPH_WIDTH * 2 + rng.randint(-5, 5)
+            glyphs.append({
+                'name': 'neume.punctum',
+                'staff': staff + 1,
+                'offset': ulx,
+                'bounding_box': {
+                    'ulx': ulx,
+                    'uly': top + rng.randint(0, STAFF_HEIGHT - GLYPH_WIDTH),
+                    'ncols': GLYPH_WIDTH,
+                    'nrows': GLYPH_WIDTH,
+                },
+            })
+            if n % 3 == 0:
+                syl_x = ulx - rng.randint(0, 10)
+                syl_boxes.append({
+                    'syl': 'la',
+                    'ul': [syl_x, top + STAFF_HEIGHT + 20],
+                    'lr': [syl_x + GLYPH_WIDTH * 2, top + STAFF_HEIGHT + 60],
+                })
+
+    for g in glyphs:
+        bb = g['bounding_box']
+        bb['lrx'] = bb['ulx'] + bb['ncols']
+        bb['lry'] = bb['uly'] + bb['nrows']
+        g['system_begin'] = False
+
+    glyphs.sort(key=lambda x: (int(x['staff']), int(x['offset'])))
+    return glyphs, syl_boxes, STAFF_HEIGHT * 1.5
+
+
+def scan_alignment(glyphs, syl_boxes, median_line_spacing):
+    '''
+    The original linear-rescan implementation of neume_to_lyric_alignment, kept here as a
+    baseline for timing and to check that the indexed version returns the same pairs.
+    '''
+    dummy_syl = {u'syl': '', u'ul': [0, 0], u'lr': [0, 0]}
+    pairs = []
+    starts = []
+    last_used = 0
+    for box in syl_boxes:
+        above_glyphs = [
+            g for g in glyphs[last_used:] if
+            (box['ul'][1] - median_line_spacing < g['bounding_box']['uly'] < box['ul'][1]) and
+            (box['ul'][0] < g['bounding_box']['ulx'] + g['bounding_box']['ncols'] // 2)
+            ]
+        if not above_glyphs:
+            starts.append(last_used)
+            continue
+        nearest_glyph = min(above_glyphs, key=lambda g: g['bounding_box']['ulx'])
+        starts.append(glyphs.index(nearest_glyph))
+        last_used = max(starts)
+
+    if not starts[0] == 0:
+        pairs.append((glyphs[:starts[0]], dummy_syl))
+    starts.append(len(glyphs))
+    for i in range(len(starts) - 1):
+        pairs.append((glyphs[starts[i]:starts[i+1]], syl_boxes[i]))
+    return pairs
+
+
+def time_call(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def main(max_glyphs=50000):
+    sizes = [n for n in (1000, 2000, 5000, 10000, 20000, 50000) if n <= max_glyphs]
+
+    print('{:>8} {:>8} {:>12} {:>14} {:>12}'.format(
+        'glyphs', 'syls', 'indexed (s)', 'us per glyph', 'rescan (s)'))
+    for n in sizes:
+        glyphs, syl_boxes, spacing = make_page(n)
+        pairs, indexed_time = time_call(bm.neume_to_lyric_alignment, glyphs, syl_boxes, spacing)
+
+        scan_col = '-'
+        if n <= SCAN_LIMIT:
+            expected, scan_time = time_call(scan_alignment, glyphs, syl_boxes, spacing)
+            if pairs != expected:
+                raise AssertionError('indexed alignment differs from rescan at {} glyphs'.format(n))
+            scan_col = '{:.4f}'.format(scan_time)
+
+        print('{:>8} {:>8} {:>12.4f} {:>14.2f} {:>12}'.format(
+            n, len(syl_boxes), indexed_time, indexed_time / n * 1e6, scan_col))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 50000)
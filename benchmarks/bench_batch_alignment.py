@@ -0,0 +1,52 @@
+'''
+Benchmark for the vectorized batch alignment in batch_alignment.py.
+
+Aligns a batch of synthetic pages (see bench_alignment.py) page by page with
+build_mei_file.neume_to_lyric_alignment, the reference implementation, and all at once with
+neume_to_lyric_alignment_batch, checks that both give the same pairs, and prints the time taken
+by each, and by the search for the anchors alone (slicing the pages into pairs is the same work
+for both). Pages are given both as lists of glyph dicts and as GlyphTables, as process() has
+them. tests/test_batch_alignment.py checks the pairs on harder pages.
+
+Run from the repository root:
+    python benchmarks/bench_batch_alignment.py [num_pages] [glyphs_per_page]
+'''
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import build_mei_file as bm
+import batch_alignment as ba
+from bench_alignment import make_page
+from glyph_table import GlyphTable
+
+
+def time_call(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def compare(label, pages):
+    reference, reference_time = time_call(lambda: [bm.neume_to_lyric_alignment(*page) for page in pages])
+    batch, batch_time = time_call(ba.neume_to_lyric_alignment_batch, pages)
+    if batch != reference:
+        raise AssertionError('vectorized alignment differs from the reference')
+    _, reference_anchors = time_call(lambda: [bm.anchor_starts(*page) for page in pages])
+    _, batch_anchors = time_call(ba.find_anchor_starts_batch, pages)
+    print('{}: pairs identical'.format(label))
+    print('  reference:  {:.4f}s, anchors {:.4f}s'.format(reference_time, reference_anchors))
+    print('  vectorized: {:.4f}s, anchors {:.4f}s'.format(batch_time, batch_anchors))
+
+
+def main(num_pages=100, glyphs_per_page=2000):
+    pages = [make_page(glyphs_per_page, seed=i) for i in range(num_pages)]
+    compare('{} pages of {} glyph dicts'.format(num_pages, glyphs_per_page), pages)
+    tables = [(GlyphTable.from_jsomr(glyphs), syl_boxes, spacing) for glyphs, syl_boxes, spacing in pages]
+    compare('{} pages of {} glyphs in GlyphTables'.format(num_pages, glyphs_per_page), tables)
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:3]])
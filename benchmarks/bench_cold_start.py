@@ -0,0 +1,94 @@
+'''
+Cold-start check for the Rodan job: measures how long a fresh interpreter takes to import
+everything MEI_encoding.MEI_encoding.run_my_task needs, and makes sure none of the modules that
+are only needed for drawing or optional backends get pulled in along the way.
+
+Each measurement is taken in a new process, so nothing is already in sys.modules. Fails if the
+best time is over the budget or a heavy module is loaded, and lists the slowest imports as
+reported by python -X importtime.
+
+Run from the repository root, with rodan, celery and pymei importable:
+    python benchmarks/bench_cold_start.py [budget_ms] [runs]
+'''
+import os
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# modules that run_my_task should never cause to be imported
+HEAVY_MODULES = ['numpy', 'PIL', 'visualize_alignment', 'xml.etree.ElementTree']
+
+BUDGET_MS = 100
+
+MEASURE = '''
+import sys, time
+start = time.time()
+import MEI_encoding
+elapsed = time.time() - start
+print(elapsed * 1000)
+print(','.join(m for m in sys.argv[1:] if m in sys.modules))
+'''
+
+
+def _env():
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([ROOT] + [p for p in [env.get('PYTHONPATH')] if p])
+    return env
+
+
+def measure():
+    '''
+    Imports MEI_encoding in a fresh interpreter. Returns the time taken in milliseconds and the
+    list of heavy modules that ended up loaded.
+    '''
+    out = subprocess.check_output(
+        [sys.executable, '-c', MEASURE] + HEAVY_MODULES, env=_env(), universal_newlines=True)
+    elapsed, loaded = out.split('\n')[:2]
+    return float(elapsed), [m for m in loaded.split(',') if m]
+
+
+def slowest_imports(count=10):
+    '''
+    Returns the @count (cumulative microseconds, module) pairs that python -X importtime reports
+    as slowest when importing MEI_encoding.
+    '''
+    proc = subprocess.Popen(
+        [sys.executable, '-X', 'importtime', '-c', 'import MEI_encoding'],
+        env=_env(), stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    _, err = proc.communicate()
+    times = []
+    for line in err.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        times.append((int(cumulative), name.strip()))
+    return sorted(times, reverse=True)[:count]
+
+
+def main(budget_ms=BUDGET_MS, runs=5):
+    results = [measure() for _ in range(runs)]
+    times = sorted(elapsed for elapsed, _ in results)
+    loaded = sorted(set(m for _, modules in results for m in modules))
+
+    print('import MEI_encoding: best {:.1f}ms, median {:.1f}ms over {} runs (budget {}ms)'.format(
+        times[0], times[len(times) // 2], runs, budget_ms))
+    print('slowest imports (cumulative):')
+    for cumulative, name in slowest_imports():
+        print('  {:>10.1f}ms  {}'.format(cumulative / 1000.0, name))
+
+    failed = False
+    if loaded:
+        print('heavy modules loaded on the core path: {}'.format(', '.join(loaded)))
+        failed = True
+    if times[0] > budget_ms:
+        print('over the cold-start budget by {:.1f}ms'.format(times[0] - budget_ms))
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    budget_ms = float(args[0]) if len(args) > 0 else BUDGET_MS
+    runs = int(args[1]) if len(args) > 1 else 5
+    sys.exit(main(budget_ms, runs))
@@ -0,0 +1,73 @@
+'''
+Compares reading a large synthetic JSOMR file with json.load followed by GlyphTable.from_jsomr
+against jsomr_ingest.load_jsomr with each of its backends, printing the time taken and the peak
+memory traced while reading.
+
+Run from the repository root:
+    python benchmarks/bench_ingest.py [num_glyphs]
+'''
+import importlib.util
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import jsomr_ingest
+from glyph_table import GlyphTable
+import synthetic
+
+
+def json_load(fname):
+    with open(fname) as f:
+        jsomr = json.load(f)
+    jsomr['glyphs'] = GlyphTable.from_jsomr(jsomr['glyphs'])
+    return jsomr
+
+
+def measure(load, fname):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = load(fname)
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def main(num_glyphs=50000):
+    jsomr = synthetic.make_jsomr(num_glyphs, max(num_glyphs // 40, 1))
+    fd, fname = tempfile.mkstemp(suffix='.json')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(jsomr, f)
+    del jsomr
+
+    loaders = [
+        ('json.load', json_load),
+        ('stream', lambda fname: jsomr_ingest.load_jsomr(fname, 'stream')),
+    ]
+    if importlib.util.find_spec('orjson') is not None:
+        loaders.append(('orjson', lambda fname: jsomr_ingest.load_jsomr(fname, 'orjson')))
+    else:
+        print('orjson is not installed, skipping its backend')
+
+    print('{} glyphs, {:.1f}MB of JSOMR'.format(num_glyphs, os.path.getsize(fname) / 1e6))
+    expected = None
+    for name, load in loaders:
+        result, elapsed, peak = measure(load, fname)
+        rows = [tuple(g[k] for k in ('name', 'staff', 'offset', 'strt_pos', 'octave', 'note'))
+                for g in result['glyphs']]
+        if expected is None:
+            expected = rows
+        elif rows != expected:
+            raise AssertionError('{} read different glyphs than json.load'.format(name))
+        print('{:<10} {:>8.1f}ms  peak {:>7.1f}MB'.format(name, elapsed * 1000, peak / 1e6))
+
+    os.remove(fname)
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])
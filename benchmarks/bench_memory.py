@@ -0,0 +1,107 @@
+'''
+Measures the peak memory of encoding one large synthetic page (see synthetic.py) in a fresh
+process for each mode: building a pymei document and serializing it with documentToText,
+streaming it with process(output_path=...), and the memory-bounded mode, which also reads the
+JSOMR with the streaming reader and reports the RSS at every staff and the allocations of every
+stage.
+
+Run from the repository root, with pymei importable:
+    python benchmarks/bench_memory.py [num_glyphs] [memory_limit_mb]
+The memory limit defaults to 4096MB; lower it to see where a page fails.
+'''
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# run in a child process for every mode, so that each one starts from the same baseline
+CHILD = '''
+import json, sys
+sys.path[:0] = [{root!r}, {bench!r}]
+import build_mei_file as bm
+import jsomr_ingest
+import parse_classifier_table as pct
+from instrumentation import Instrumentation
+from memory_guard import peak_rss
+
+mode, jsomr_fname, syls_fname, mapping, out_fname, limit = sys.argv[1:]
+classifier = pct.load_classifier(mapping, cache_dir=None)
+result = {{}}
+if mode == 'bounded':
+    jsomr = jsomr_ingest.load_jsomr(jsomr_fname, 'stream')
+    syls = jsomr_ingest.load_alignment(syls_fname, 'stream')
+    instrumentation = Instrumentation(trace_memory=True)
+    bm.process(jsomr, syls, classifier, 0.5, output_path=out_fname, instrumentation=instrumentation,
+               memory_limit=int(float(limit) * 1e6))
+    result['stages'] = instrumentation.metrics.stages
+    result['memory'] = instrumentation.metrics.memory
+else:
+    with open(jsomr_fname) as f:
+        jsomr = json.load(f)
+    with open(syls_fname) as f:
+        syls = json.load(f)
+    if mode == 'pymei':
+        with open(out_fname, 'w') as f:
+            f.write(bm.process(jsomr, syls, classifier, 0.5))
+    else:
+        bm.process(jsomr, syls, classifier, 0.5, output_path=out_fname)
+result['peak_rss_bytes'] = peak_rss()
+print(json.dumps(result))
+'''
+
+
+def run(mode, jsomr_fname, syls_fname, mapping, out_fname, limit):
+    # returns what the child measured, or the last line of its error output if it failed
+    child = CHILD.format(root=ROOT, bench=os.path.dirname(os.path.abspath(__file__)))
+    proc = subprocess.Popen(
+        [sys.executable, '-c', child, mode, jsomr_fname, syls_fname, mapping, out_fname, str(limit)],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = proc.communicate()
+    if proc.returncode != 0:
+        return err.decode('utf-8').strip().split('\n')[-1]
+    return json.loads(out.decode('utf-8').strip().split('\n')[-1])
+
+
+def main(num_glyphs=20000, memory_limit=4096):
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import synthetic
+
+    tmp = tempfile.mkdtemp()
+    jsomr_fname = os.path.join(tmp, 'page.json')
+    syls_fname = os.path.join(tmp, 'syls.json')
+    mapping = os.path.join(tmp, 'mapping.csv')
+    jsomr = synthetic.make_jsomr(num_glyphs, max(num_glyphs // 40, 1))
+    with open(jsomr_fname, 'w') as f:
+        json.dump(jsomr, f)
+    with open(syls_fname, 'w') as f:
+        json.dump(synthetic.make_alignment(jsomr), f)
+    synthetic.write_mapping_csv(mapping)
+    del jsomr
+
+    print('{} glyphs, {:.1f}MB of JSOMR'.format(num_glyphs, os.path.getsize(jsomr_fname) / 1e6))
+    for mode in ('pymei', 'stream', 'bounded'):
+        result = run(mode, jsomr_fname, syls_fname, mapping, os.path.join(tmp, mode + '.mei'), memory_limit)
+        if not isinstance(result, dict):
+            print('{:<8} failed: {}'.format(mode, result))
+            continue
+        print('{:<8} peak RSS {:>8.1f}MB'.format(mode, result['peak_rss_bytes'] / 1e6))
+        if mode == 'bounded':
+            for name, stage in result['stages'].items():
+                if stage['allocated_bytes'] is not None:
+                    print('    {:<12} {:>12,d} bytes allocated'.format(name, stage['allocated_bytes']))
+            staves = result['memory']['staves']
+            if staves:
+                print('    RSS from {:.1f}MB at staff {} to {:.1f}MB at staff {}'.format(
+                    staves[0]['rss_bytes'] / 1e6, staves[0]['staff'],
+                    staves[-1]['rss_bytes'] / 1e6, staves[-1]['staff']))
+
+    for fname in os.listdir(tmp):
+        os.remove(os.path.join(tmp, fname))
+    os.rmdir(tmp)
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])
@@ -0,0 +1,112 @@
+'''
+Starts an encoding_service.EncodingService on a free localhost port and sends it synthetic pages
+(see synthetic.py) from a number of concurrent clients, printing the latency of every request as
+reported by the service and how many times it was turned away (clients try again shortly after a
+503), and the service's /stats at the end.
+
+Run from the repository root, with pymei importable:
+    python benchmarks/bench_service.py [num_glyphs] [requests] [clients] [workers]
+'''
+import asyncio
+import http.client
+import json
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from encoding_service import EncodingService
+import synthetic
+
+
+def free_port():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def start_service(service, port):
+    # runs the service's event loop in a background thread, returning once it is listening
+    ready = threading.Event()
+
+    def run():
+        async def serve():
+            await service.warm_up()
+            server = await asyncio.start_server(service.handle, '127.0.0.1', port)
+            ready.set()
+            async with server:
+                await server.serve_forever()
+        asyncio.run(serve())
+
+    threading.Thread(target=run, daemon=True).start()
+    ready.wait()
+
+
+def post(port, body, retry_delay=0.02):
+    # returns the status, the time until the page was encoded, the number of 503s on the way, and
+    # the queue and encode latencies reported by the service
+    start = time.perf_counter()
+    rejected = 0
+    while True:
+        conn = http.client.HTTPConnection('127.0.0.1', port)
+        conn.request('POST', '/encode', body, {'Content-Type': 'application/json'})
+        response = conn.getresponse()
+        response.read()
+        conn.close()
+        if response.status != 503:
+            break
+        rejected += 1
+        time.sleep(retry_delay)
+    elapsed = time.perf_counter() - start
+    return (response.status, elapsed, rejected,
+            response.getheader('X-Queue-Seconds'), response.getheader('X-Encode-Seconds'))
+
+
+def main(num_glyphs=500, requests=40, clients=8, workers=2):
+    fd, mapping = tempfile.mkstemp(suffix='.csv')
+    os.close(fd)
+    synthetic.write_mapping_csv(mapping)
+    jsomr = synthetic.make_jsomr(num_glyphs, max(num_glyphs // 40, 1))
+    body = json.dumps({
+        'jsomr': jsomr,
+        'alignment': synthetic.make_alignment(jsomr),
+        'classifier': os.path.splitext(os.path.basename(mapping))[0],
+        'width_mult': 0.5,
+        'output_format': 'compact',
+    }).encode('utf-8')
+
+    service = EncodingService(workers, classifiers=[mapping])
+    port = free_port()
+    start_service(service, port)
+    print('{} glyphs, {:.1f}kB per request, {} clients, {} workers, at most {} pending'.format(
+        num_glyphs, len(body) / 1e3, clients, workers, service.max_pending))
+
+    with ThreadPoolExecutor(clients) as pool:
+        results = list(pool.map(lambda _: post(port, body), range(requests)))
+
+    served = [r for r in results if r[0] == 200]
+    for status, elapsed, rejected, queue, encode in results:
+        print('{} {:>8.1f}ms  turned away {:>3}x  queue {}s  encode {}s'.format(
+            status, elapsed * 1000, rejected, queue, encode))
+    if served:
+        times = sorted(r[1] for r in served)
+        print('served {} of {}, turned away {} times; p50 {:.1f}ms, max {:.1f}ms'.format(
+            len(served), len(results), sum(r[2] for r in results),
+            times[len(times) // 2] * 1000, times[-1] * 1000))
+
+    conn = http.client.HTTPConnection('127.0.0.1', port)
+    conn.request('GET', '/stats')
+    print(conn.getresponse().read().decode('utf-8'))
+    service.close()
+    os.remove(mapping)
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])
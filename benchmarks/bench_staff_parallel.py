@@ -0,0 +1,57 @@
+'''
+Parity check and benchmark for encoding the staves of a page in parallel (staff_parallel.py).
+
+Encodes one dense synthetic page (see synthetic.py) serially and with every number of staff
+workers given, in the compact format so that IDs can be compared too, fails if any output
+differs from the serial one, and prints the best time of each.
+
+Run from the repository root, with pymei importable:
+    python benchmarks/bench_staff_parallel.py [num_glyphs] [num_staves] [workers ...]
+'''
+import copy
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import build_mei_file as bm
+import parse_classifier_table as pct
+import synthetic
+
+
+def encode(jsomr, syls, classifier, workers, repeat=3):
+    # returns the MEI and the best time taken over @repeat runs
+    best = None
+    for _ in range(repeat):
+        page = copy.deepcopy(jsomr)
+        start = time.perf_counter()
+        mei = bm.process(page, syls, classifier, 0.5, output_format='compact', staff_workers=workers)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return mei, best
+
+
+def main(num_glyphs=20000, num_staves=60, workers=(2, 4, 8)):
+    fd, mapping = tempfile.mkstemp(suffix='.csv')
+    os.close(fd)
+    synthetic.write_mapping_csv(mapping)
+    classifier = pct.load_classifier(mapping, cache_dir=None)
+    jsomr = synthetic.make_jsomr(num_glyphs, num_staves)
+    syls = synthetic.make_alignment(jsomr)
+
+    serial, serial_time = encode(jsomr, syls, classifier, None)
+    print('{} glyphs on {} staves, {} cores'.format(num_glyphs, num_staves, os.cpu_count()))
+    print('serial:     {:>8.3f}s'.format(serial_time))
+    for n in workers:
+        mei, elapsed = encode(jsomr, syls, classifier, n)
+        if mei != serial:
+            raise AssertionError('output with {} staff workers differs from the serial output'.format(n))
+        print('{:>2} workers: {:>8.3f}s  ({:.2f}x)'.format(n, elapsed, serial_time / elapsed))
+    os.remove(mapping)
+
+
+if __name__ == '__main__':
+    args = [int(a) for a in sys.argv[1:]]
+    main(*args[:2], workers=args[2:] or (2, 4, 8))
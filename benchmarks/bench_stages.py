@@ -0,0 +1,200 @@
+'''
+Times every stage of the encoder separately on a synthetic page (see synthetic.py): parsing the
+mapping CSV, add_flags_to_glyphs, building the GlyphTable, neume_to_lyric_alignment, build_mei,
+merge_nearby_neume_components and serializing with documentToText, plus the streaming process()
+end to end, with and without checking its output with mei_validator, and mei_validator.validate_file
+on the file written.
+
+Results are written as JSON, together with the workload and environment they were measured on,
+so that runs can be compared; with --compare, every stage is checked against an earlier results
+file and the run fails if any stage got slower by more than --threshold.
+
+Run from the repository root, with pymei importable:
+    python benchmarks/bench_stages.py --glyphs 2000 --output results.json
+    python benchmarks/bench_stages.py --glyphs 2000 --compare results.json
+'''
+import argparse
+import copy
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+import build_mei_file as bm
+import parse_classifier_table as pct
+from glyph_table import GlyphTable
+from mei_validator import StructureValidator, validate_file
+from zone_registry import ZoneRegistry
+import synthetic
+
+RESULTS_FORMAT = 1
+
+
+def time_stage(fn, setup=None, repeat=5):
+    '''
+    Calls @fn @repeat times, each time with the result of calling @setup (if given) as its
+    argument, so that setup work isn't timed. Returns the list of times in seconds.
+    '''
+    times = []
+    for _ in range(repeat):
+        args = (setup(),) if setup is not None else ()
+        start = time.perf_counter()
+        fn(*args)
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, universal_newlines=True,
+            stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(config, repeat=5):
+    '''
+    Generates the workload described by @config and times every stage on it. Returns a dict of
+    stage name to list of times.
+    '''
+    jsomr = synthetic.make_jsomr(
+        config['glyphs'], config['staves'], config['ligature_density'], config['seed'])
+    syls = synthetic.make_alignment(jsomr, config['syllable_density'], config['seed'])
+    staves, page = jsomr['staves'], jsomr['page']
+    syl_boxes, median_line_spacing = syls['syl_boxes'], syls['median_line_spacing']
+
+    tmp_dir = tempfile.mkdtemp()
+    csv_fname = os.path.join(tmp_dir, 'mapping.csv')
+    mei_fname = os.path.join(tmp_dir, 'out.mei')
+    synthetic.write_mapping_csv(csv_fname)
+
+    classifier = pct.compile_classifier(pct.fetch_table_from_csv(csv_fname))
+    glyphs = GlyphTable.from_jsomr(jsomr['glyphs'])
+    pairs = bm.neume_to_lyric_alignment(glyphs, syl_boxes, median_line_spacing)
+
+    def built_document():
+        zones = ZoneRegistry()
+        return bm.build_mei(pairs, classifier, staves, page, zones), zones
+
+    def merged_document():
+        meiDoc, zones = built_document()
+        return bm.merge_nearby_neume_components(meiDoc, config['width_mult'], zones)
+
+    stages = [
+        ('parse_classifier', lambda: pct.compile_classifier(pct.fetch_table_from_csv(csv_fname)), None),
+        ('add_flags_to_glyphs', bm.add_flags_to_glyphs, lambda: copy.deepcopy(jsomr['glyphs'])),
+        ('glyph_table', lambda: GlyphTable.from_jsomr(jsomr['glyphs']), None),
+        ('neume_to_lyric_alignment', lambda: bm.neume_to_lyric_alignment(glyphs, syl_boxes, median_line_spacing), None),
+        ('build_mei', lambda: bm.build_mei(pairs, classifier, staves, page, ZoneRegistry()), None),
+        ('merge_nearby_neume_components',
+            lambda doc: bm.merge_nearby_neume_components(doc[0], config['width_mult'], doc[1]), built_document),
+        ('documentToText', bm.documentToText, merged_document),
+        ('process_streaming', lambda: bm.process(jsomr, syls, classifier, config['width_mult'], output_path=mei_fname), None),
+        ('process_streaming_validated',
+            lambda: bm.process(jsomr, syls, classifier, config['width_mult'], output_path=mei_fname,
+                               validator=StructureValidator()), None),
+        ('validate_file', lambda: validate_file(mei_fname), None),
+    ]
+
+    results = {}
+    for name, fn, setup in stages:
+        results[name] = time_stage(fn, setup, repeat)
+        print('{:<32} best {:>9.2f}ms'.format(name, min(results[name]) * 1000))
+
+    os.remove(csv_fname)
+    os.remove(mei_fname)
+    os.rmdir(tmp_dir)
+    return results
+
+
+def summarize(config, times):
+    stages = {}
+    for name, ts in times.items():
+        ts = sorted(ts)
+        stages[name] = {
+            'best': ts[0],
+            'median': ts[len(ts) // 2],
+            'best_per_glyph_us': ts[0] / max(config['glyphs'], 1) * 1e6,
+        }
+    return {
+        'format': RESULTS_FORMAT,
+        'timestamp': datetime.datetime.utcnow().isoformat() + 'Z',
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'config': config,
+        'stages': stages,
+    }
+
+
+def compare(old, new, threshold):
+    '''
+    Prints the change in best time of every stage between two results dicts. Returns the names of
+    the stages that got slower by more than a factor of @threshold.
+    '''
+    if old['config'] != new['config']:
+        print('warning: comparing runs on different workloads: {} vs {}'.format(old['config'], new['config']))
+
+    regressions = []
+    print('{:<32} {:>10} {:>10} {:>8}'.format('stage', 'old (ms)', 'new (ms)', 'ratio'))
+    for name, stage in sorted(new['stages'].items()):
+        if name not in old['stages']:
+            print('{:<32} {:>10} {:>10.2f}'.format(name, '-', stage['best'] * 1000))
+            continue
+        before = old['stages'][name]['best']
+        ratio = stage['best'] / before if before > 0 else float('inf')
+        flag = '  REGRESSION' if ratio > threshold else ''
+        print('{:<32} {:>10.2f} {:>10.2f} {:>7.2f}x{}'.format(name, before * 1000, stage['best'] * 1000, ratio, flag))
+        if ratio > threshold:
+            regressions.append(name)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Time each encoding stage on a synthetic page.')
+    parser.add_argument('--glyphs', type=int, default=2000)
+    parser.add_argument('--staves', type=int, default=12)
+    parser.add_argument('--ligature-density', type=float, default=0.1)
+    parser.add_argument('--syllable-density', type=float, default=0.3)
+    parser.add_argument('--width-mult', type=float, default=0.5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--output', help='write results as JSON to this file')
+    parser.add_argument('--compare', help='compare against results JSON from an earlier run')
+    parser.add_argument('--threshold', type=float, default=1.2,
+                        help='slowdown factor past which --compare reports a regression')
+    args = parser.parse_args(argv)
+
+    config = {
+        'glyphs': args.glyphs,
+        'staves': args.staves,
+        'ligature_density': args.ligature_density,
+        'syllable_density': args.syllable_density,
+        'width_mult': args.width_mult,
+        'seed': args.seed,
+    }
+    results = summarize(config, run(config, args.repeat))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(json.load(f), results, args.threshold)
+        if regressions:
+            print('slower than before: {}'.format(', '.join(regressions)))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,136 @@
+'''
+Generators for synthetic encoding inputs: JSOMR pages as output by pitch finding, text alignment
+JSON for them, and an MEI mapping CSV covering every glyph name they use.
+
+The knobs are the number of glyphs and staves on a page, the share of neumes that are multi-
+component ligatures, and the share of neumes that get a syllable of their own. Everything is
+seeded, so the same arguments always give the same page.
+'''
+import csv
+import random
+
+STAFF_HEIGHT = 150
+STAFF_SPACING = 300
+MARGIN = 100
+
+# (classification, MEI snippet) rows of the mapping CSV
+MAPPING = [
+    ('neume.punctum', '<neume><nc/></neume>'),
+    ('neume.podatus', '<neume><nc/><nc intm="2S"/></neume>'),
+    ('neume.clivis', '<neume><nc/><nc intm="-2S"/></neume>'),
+    ('neume.torculus', '<neume><nc/><nc intm="2S"/><nc intm="-1S"/></neume>'),
+    ('neume.ligature2', '<neume><nc ligated="true"/><nc intm="-1S" ligated="true"/></neume>'),
+    ('neume.ligature3', '<neume><nc ligated="true"/><nc intm="-2S" ligated="true"/><nc intm="3S"/></neume>'),
+    ('clef.c', '<clef shape="C"/>'),
+    ('clef.f', '<clef shape="F"/>'),
+    ('custos', '<custos/>'),
+]
+
+NEUMES = ['neume.punctum', 'neume.podatus', 'neume.clivis', 'neume.torculus']
+LIGATURES = ['neume.ligature2', 'neume.ligature3']
+CLEFS = ['clef.c', 'clef.f']
+SYLLABLES = ['al', 'le', 'lu', 'ia', 'glo', 'ri', 'a', 'in', 'ex', 'cel', 'sis', 'de', 'o']
+
+
+def write_mapping_csv(fname):
+    '''
+    Writes a mapping CSV, in the MEI mapping tool's format, with a row for every glyph name the
+    generated pages use.
+    '''
+    with open(fname, 'w') as f:
+        writer = csv.writer(f)
+        writer.writerow(['classification', 'mei'])
+        for name, mei in MAPPING:
+            writer.writerow([name, mei])
+
+
+def make_jsomr(num_glyphs=1000, num_staves=10, ligature_density=0.1, seed=0):
+    '''
+    Returns a JSOMR page with @num_glyphs glyphs spread evenly over @num_staves staves. Every
+    staff starts with a clef and ends with a custos; of the neumes in between, roughly a share of
+    @ligature_density are ligatures.
+    '''
+    rng = random.Random(seed)
+    per_staff = [num_glyphs // num_staves + (1 if s < num_glyphs % num_staves else 0) for s in range(num_staves)]
+
+    glyphs = []
+    staves = []
+    right = MARGIN
+    for staff, count in enumerate(per_staff):
+        top = MARGIN + staff * STAFF_SPACING
+        x = MARGIN + 20
+        for n in range(count):
+            if n == 0:
+                name = rng.choice(CLEFS)
+            elif n == count - 1 and count > 2:
+                name = 'custos'
+            elif rng.random() < ligature_density:
+                name = rng.choice(LIGATURES)
+            else:
+                name = rng.choice(NEUMES)
+
+            width = rng.randint(20, 60)
+            glyphs.append({
+                'glyph': {
+                    'name': name,
+                    'bounding_box': {
+                        'ulx': x,
+                        'uly': top + rng.randint(0, STAFF_HEIGHT - 30),
+                        'ncols': width,
+                        'nrows': rng.randint(20, 60),
+                    },
+                    'state': 1,
+                    'id': 'g{}'.format(len(glyphs)),
+                },
+                'pitch': {
+                    'staff': str(staff + 1),
+                    'offset': x,
+                    'strt_pos': rng.randint(1, 9),
+                    'octave': rng.randint(2, 4),
+                    'note': rng.choice('abcdefg'),
+                    'clef_pos': 3,
+                    'clef': name[-1] if name in CLEFS else 'c',
+                },
+            })
+            x += width + rng.randint(0, 40)
+
+        staves.append({
+            'staff_no': staff + 1,
+            'bounding_box': {'ulx': MARGIN, 'uly': top, 'ncols': x - MARGIN, 'nrows': STAFF_HEIGHT},
+            'num_lines': 4,
+            'line_positions': [],
+        })
+        right = max(right, x)
+
+    page = {
+        'resolution': 0,
+        'bounding_box': {
+            'ulx': 0,
+            'uly': 0,
+            'ncols': right + MARGIN,
+            'nrows': 2 * MARGIN + num_staves * STAFF_SPACING,
+        },
+    }
+    return {'page': page, 'staves': staves, 'glyphs': glyphs}
+
+
+def make_alignment(jsomr, syllable_density=0.3, seed=0):
+    '''
+    Returns text alignment results for a page from make_jsomr, with a syllable box under roughly a
+    share of @syllable_density of its neumes, starting a little to the left of the neume.
+    '''
+    rng = random.Random(seed)
+    syl_boxes = []
+    for g in jsomr['glyphs']:
+        if not g['glyph']['name'].startswith('neume') or rng.random() >= syllable_density:
+            continue
+        bb = g['glyph']['bounding_box']
+        staff = jsomr['staves'][int(g['pitch']['staff']) - 1]['bounding_box']
+        ulx = bb['ulx'] - rng.randint(0, 15)
+        uly = staff['uly'] + staff['nrows'] + 20
+        syl_boxes.append({
+            'syl': rng.choice(SYLLABLES),
+            'ul': [ulx, uly],
+            'lr': [ulx + rng.randint(40, 90), uly + 40],
+        })
+    return {'syl_boxes': syl_boxes, 'median_line_spacing': STAFF_SPACING}
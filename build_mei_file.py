@@ -1,12 +1,21 @@
-import xml.etree.ElementTree as ET
-import numpy as np
-import json
+import io
+from contextlib import contextmanager
 import parse_classifier_table as pct
-from pymei import MeiDocument, MeiElement, MeiAttribute, documentToText, documentToFile
+from pymei import MeiDocument, MeiElement, documentToText
 from itertools import groupby
-from visualize_alignment import draw_mei_doc
+from glyph_index import GlyphIndex
+from glyph_table import GlyphTable
+from memory_guard import MemoryGuard
+from mei_writer import SequentialIds, StreamElement, StreamingMeiWriter, get_output_format, open_output
+from zone_registry import ZoneRegistry
 from rodan.jobs.MEI_encoding import __version__
 
+SCALE = ['c', 'd', 'e', 'f', 'g', 'a', 'b']
+SCALE_INDEX = dict((pname, i) for i, pname in enumerate(SCALE))
+
+# (pname, oct) strings of every pitch number seen so far, see number_to_pitch
+_pitch_names = {}
+
 
 def add_flags_to_glyphs(glyphs):
     '''
@@ -45,31 +54,32 @@ def add_flags_to_glyphs(glyphs):
 
 def neume_to_lyric_alignment(glyphs, syl_boxes, median_line_spacing):
     '''
-    Given the processed glyphs from add_flags_to_glyphs and the information from the text alignment
-    job (syl_boxes, median_line_spacing), finds out which syllables of text correspond to which
-    glyphs on the page and returns a list of ([neumes], syllable) pairs.
+    Given the processed glyphs (a GlyphTable, or the list from add_flags_to_glyphs) and the
+    information from the text alignment job (syl_boxes, median_line_spacing), finds out which
+    syllables of text correspond to which glyphs on the page and returns a list of
+    ([neumes], syllable) pairs.
 
     Things like custos, clefs, and accidentals are included inside these lists even though they
     are, strictly speaking, not part of the MEI for the syllable; that is handled in the method that
     actually encodes the MEI.
     '''
 
-    dummy_syl = {u'syl': '', u'ul': [0, 0], u'lr': [0, 0]}
-
     # if there's no syl information then make fake syllables for testing. this method makes one
     # large syllable covering an entire staff line.
     if not syl_boxes:
-        glyphs = sorted(glyphs, key=lambda x: int(x['staff']))
+        return dummy_syllable_pairs(glyphs)
 
-        grouped_glyphs = [list(g) for k, g in groupby(glyphs, key=lambda x: int(x['staff']))]
+    starts = anchor_starts(glyphs, syl_boxes, median_line_spacing)
+    return pairs_from_starts(glyphs, syl_boxes, starts)
 
-        pairs = [(g, dummy_syl) for g in grouped_glyphs]
-        return pairs
 
-    glyphs_pos = 0
-    num_glyphs = len(glyphs)
+def anchor_starts(glyphs, syl_boxes, median_line_spacing):
+    '''
+    For every syllable box, finds the position in @glyphs of its anchor glyph (or, if it has none,
+    of the previous box's anchor), which is where that syllable's glyphs start.
+    '''
+    index = GlyphIndex(glyphs)
 
-    pairs = []
     starts = []
     last_used = 0
     for box in syl_boxes:
@@ -79,87 +89,129 @@ def neume_to_lyric_alignment(glyphs, syl_boxes, median_line_spacing):
         # 1) have not been assigned to a syl_box yet, and
         # 2) are within a median line width above the current box, and
         # 3) are to the right of the current box.
-        above_glyphs = [
-            g for g in glyphs[last_used:] if
-            (box['ul'][1] - median_line_spacing < g['bounding_box']['uly'] < box['ul'][1]) and
-            (box['ul'][0] < g['bounding_box']['ulx'] + g['bounding_box']['ncols'] // 2)
-            ]
+        # of those, the one closest to the current box (smallest ulx) is the anchor.
+        nearest_pos = index.nearest_right(
+            x=box['ul'][0],
+            y_low=box['ul'][1] - median_line_spacing,
+            y_high=box['ul'][1],
+            first_pos=last_used,
+        )
 
-        if not above_glyphs:
+        if nearest_pos is None:
             starts.append(last_used)
             continue
 
-        # find the glyph in above_glyphs that is closest to the current box
-        nearest_glyph = min(above_glyphs, key=lambda g: g['bounding_box']['ulx'])
-
         # append the index of this glyph to the start positions list
-        starts.append(glyphs.index(nearest_glyph))
-        last_used = max(starts)
+        starts.append(nearest_pos)
+        last_used = max(last_used, nearest_pos)
+
+    return starts
+
+
+def blank_syllable():
+    '''
+    Returns a syllable box with no text and an empty bounding box, used for glyphs that could not
+    be assigned to any syllable on the page.
+    '''
+    return {u'syl': '', u'ul': [0, 0], u'lr': [0, 0]}
+
+
+def dummy_syllable_pairs(glyphs):
+    '''
+    Pairs every staff's worth of glyphs with a blank syllable, for when no text alignment
+    information is available.
+    '''
+    dummy_syl = blank_syllable()
+
+    glyphs = sorted(glyphs, key=lambda x: int(x['staff']))
+    grouped_glyphs = [list(g) for k, g in groupby(glyphs, key=lambda x: int(x['staff']))]
+
+    return [(g, dummy_syl) for g in grouped_glyphs]
+
 
+def pairs_from_starts(glyphs, syl_boxes, starts):
+    '''
+    Given the position of the anchor glyph of every syllable box (or the previous anchor, for
+    boxes that have none), slices the glyphs into the ([neumes], syllable) pairs returned by
+    neume_to_lyric_alignment.
+    '''
+    return list(iter_pairs_from_starts(glyphs, syl_boxes, starts))
+
+
+def iter_pairs_from_starts(glyphs, syl_boxes, starts):
+    '''
+    Lazy version of pairs_from_starts, slicing out each pair only as it is needed.
+    '''
     # if there are unassigned "orphan" glyphs at the beginning of the page, assign them all to a
     # dummy syl_box so they can be detected later
     if not starts[0] == 0:
-        pairs.append(
-            (glyphs[:starts[0]], dummy_syl)
-        )
+        yield (glyphs[:starts[0]], blank_syllable())
 
-    starts.append(len(glyphs))
-    for i in range(len(starts) - 1):
-        pairs.append((glyphs[starts[i]:starts[i+1]], syl_boxes[i]))
-
-    return pairs
+    for i in range(len(starts)):
+        end = starts[i + 1] if i + 1 < len(starts) else len(glyphs)
+        yield (glyphs[starts[i]:end], syl_boxes[i])
 
 
 def generate_base_document():
     '''
-    Generates a generic template for an MEI document for neume notation.
-
-    Currently a bit of this is hardcoded and should probably be made more customizable.
+    Generates a generic template for an MEI document for neume notation, as a pymei document.
+    Returns the document, and its (empty) surface and layer elements.
     '''
     meiDoc = MeiDocument("4.0.0")
+    mei, surface, layer = generate_base_tree()
+    meiDoc.root = mei
+    return meiDoc, surface, layer
 
-    mei = MeiElement("mei")
+
+def generate_base_tree(element_cls=MeiElement):
+    '''
+    Generates a generic template for an MEI document for neume notation, built out of
+    @element_cls elements (MeiElement, or mei_writer.StreamElement for the streaming writer).
+    Returns the root <mei> element, and the (empty) surface and layer elements.
+
+    Currently a bit of this is hardcoded and should probably be made more customizable.
+    '''
+    mei = element_cls("mei")
     mei.addAttribute("meiversion", "4.0.0")
-    meiDoc.root = mei
 
     # placeholder meiHead
-    meihead = MeiElement('meiHead')
+    meihead = element_cls('meiHead')
     mei.addChild(meihead)
-    fileDesc = MeiElement('fileDesc')
+    fileDesc = element_cls('fileDesc')
     meihead.addChild(fileDesc)
-    titleSt = MeiElement('titleStmt')
+    titleSt = element_cls('titleStmt')
     fileDesc.addChild(titleSt)
-    title = MeiElement('title')
+    title = element_cls('title')
     titleSt.addChild(title)
     title.setValue('MEI Encoding Output (%s)' % __version__)
-    pubStmt = MeiElement('pubStmt')
+    pubStmt = element_cls('pubStmt')
     fileDesc.addChild(pubStmt)
 
-    music = MeiElement("music")
+    music = element_cls("music")
     mei.addChild(music)
 
-    facs = MeiElement("facsimile")
+    facs = element_cls("facsimile")
     music.addChild(facs)
 
-    surface = MeiElement("surface")
+    surface = element_cls("surface")
     facs.addChild(surface)
 
-    body = MeiElement('body')
+    body = element_cls('body')
     music.addChild(body)
 
-    mdiv = MeiElement('mdiv')
+    mdiv = element_cls('mdiv')
     body.addChild(mdiv)
 
-    score = MeiElement('score')
+    score = element_cls('score')
     mdiv.addChild(score)
 
-    scoreDef = MeiElement('scoreDef')
+    scoreDef = element_cls('scoreDef')
     score.addChild(scoreDef)
 
-    staffGrp = MeiElement('staffGrp')
+    staffGrp = element_cls('staffGrp')
     scoreDef.addChild(staffGrp)
 
-    staffDef = MeiElement('staffDef')
+    staffDef = element_cls('staffDef')
     staffGrp.addChild(staffDef)
 
     # these hardcoded attributes define a single staff with 4 lines, neume notation, with a default c clef
@@ -169,16 +221,16 @@ def generate_base_document():
     staffDef.addAttribute('clef.line', '3')
     staffDef.addAttribute('clef.shape', 'C')
 
-    section = MeiElement('section')
+    section = element_cls('section')
     score.addChild(section)
 
-    staff = MeiElement('staff')
+    staff = element_cls('staff')
     section.addChild(staff)
 
-    layer = MeiElement('layer')
+    layer = element_cls('layer')
     staff.addChild(layer)
 
-    return meiDoc, surface, layer
+    return mei, surface, layer
 
 
 def add_attributes_to_element(el, add):
@@ -193,148 +245,127 @@ def add_attributes_to_element(el, add):
     return el
 
 
-def create_primitive_element(xml, glyph, surface):
+def create_primitive_element(template, glyph, zones, pitch=None, element_cls=MeiElement):
     '''
-    Creates a "lowest-level" element out of the xml retrieved from the MEI mapping tool (passed as
-    an ElementTree object in @xml) and registers its bounding box in the given surface.
+    Creates a "lowest-level" element out of a template compiled from the MEI mapping tool (see
+    parse_classifier_table.compile_classifier) and registers its bounding box in the given
+    ZoneRegistry.
+    The element takes its pitch from the glyph, unless a (pname, oct) pair is given in @pitch.
     '''
-    res = MeiElement(xml.tag)
-    attribs = xml.attrib
-
-    # ncs, custos do not have a @line attribute. this is a bit of a hack...
-    if xml.tag == 'clef':
-        attribs['line'] = str(glyph['strt_pos'])
-
-    attribs['oct'] = str(glyph['octave'])
-    attribs['pname'] = str(glyph['note'])
-    res = add_attributes_to_element(res, attribs)
+    pname, octave = pitch if pitch else (str(glyph['note']), str(glyph['octave']))
+    pitched = {'line': str(glyph['strt_pos']), 'oct': octave, 'pname': pname}
+
+    res = element_cls(template.tag)
+    for key, value in template.attribs:
+        if value is None:
+            value = pitched[key]
+        if value == 'None':
+            continue
+        res.addAttribute(key, value)
 
-    zoneId = generate_zone(surface, glyph['bounding_box'])
+    zoneId = zones.register(glyph['bounding_box'])
     res.addAttribute('facs', '#' + zoneId)
     return res
 
 
-def glyph_to_element(classifier, glyph, surface):
+def glyph_to_element(classifier, glyph, zones, element_cls=MeiElement):
     '''
     Translates a glyph as output by the pitchfinder into an MEI element, registering bounding boxes
-    in the given surface.
+    in the given ZoneRegistry.
 
     Currently the assumption is that no MEI information in the given classifier is more than one
     level deep - that is, everything is either a single element (clef, custos) or the child of a
     single element (neumes).
+
+    Glyphs whose class isn't in the classifier are left out. If @classifier is a
+    parse_classifier_table.ClassifierResolver, their class is first resolved to a more general
+    one, and those that still can't be encoded are counted in it, to be reported for the whole
+    page; so are the pitches of neumes that aren't in the scale, whose components then all keep
+    the pitch of the glyph.
     '''
     name = str(glyph['name'])
-    try:
-        xml = classifier[name]
-    except KeyError:
-        print('entry {} not found in classifier table!'.format(name))
+    if isinstance(classifier, pct.ClassifierResolver):
+        template = classifier.lookup(name)
+    else:
+        template = classifier.get(name)
+    if template is None:
         return None
 
-    # remove everything up to the first dot in the name of the glyph
-    try:
-        name = name[:name.index('.')]
-    except ValueError:
-        pass
-
     # if this is an element with no children, then just apply a pitch and position to it
-    if not list(xml):
-        return create_primitive_element(xml, glyph, surface)
+    if not template.components:
+        return create_primitive_element(template, glyph, zones, element_cls=element_cls)
 
-    # else, this element has at least one child (is a neume)
-    ncs = list(xml)
-    els = [create_primitive_element(nc, glyph, surface) for nc in ncs]
-    parent = MeiElement(xml.tag)
+    # else, this element has at least one child (is a neume). the first nc takes the pitch of the
+    # glyph, and every nc after it is as many steps away from it as the intervals before it add up to
+    pitch = (str(glyph['note']), str(glyph['octave']))
+    try:
+        number = pitch_to_number(*pitch)
+    except (KeyError, ValueError):
+        if len(template.components) > 1 and isinstance(classifier, pct.ClassifierResolver):
+            classifier.out_of_scale[''.join(pitch)] += 1
+        number = None
+
+    els = []
+    for nc in template.components:
+        nc_pitch = pitch if number is None or not nc.offset else number_to_pitch(number + nc.offset)
+        els.append(create_primitive_element(nc, glyph, zones, nc_pitch, element_cls))
+
+    parent = element_cls(template.tag)
     parent.setChildren(els)
-
-    if len(els) < 2:
-        return parent
-
-    # if there's more than one element, must resolve intervals between ncs
-    for i in range(1, len(els)):
-        prev_nc = parent.children[i - 1]
-        cur_nc = parent.children[i]
-        new_pname, new_octave = resolve_interval(prev_nc, cur_nc)
-        cur_nc.addAttribute('pname', new_pname)
-        cur_nc.addAttribute('oct', new_octave)
-        cur_nc.removeAttribute('intm')
-
     return parent
 
 
-def resolve_interval(prev_nc, cur_nc):
+def pitch_to_number(pname, octave):
     '''
-    When given a ligature or something like that which specifies only the starting pitch and an
-    interval, we need to calculate what the pitch of the rest of the notes are going to be. Given
-    two neume components, where the second one has an 'intm' attribute, this calculates what the
-    correct scale degree and octave is.
-
-    N.B. in MEI octave numbers increase when going from a B to a C.
+    Returns the pitch @pname in @octave (as written in MEI) as a single number of diatonic steps,
+    octave * 7 + scale degree, so that moving by an interval of any size is just an addition.
+    Raises a KeyError or ValueError if the pitch isn't valid.
     '''
+    return int(octave) * len(SCALE) + SCALE_INDEX[pname]
 
-    scale = ['c', 'd', 'e', 'f', 'g', 'a', 'b']
-
-    interval = cur_nc.getAttribute('intm').value
-    try:
-        interval = interval.lower().replace('s', '')
-        interval = int(interval)
-    except ValueError:
-        interval = 0
-    except AttributeError:
-        interval = 0
-
-    starting_pitch = prev_nc.getAttribute('pname').value
-    starting_octave = int(prev_nc.getAttribute('oct').value)
-    end_octave = starting_octave
-
-    try:
-        start_index = scale.index(starting_pitch)
-    except ValueError:
-        print('pname {} is not in scale {}!'.format(starting_pitch, scale))
-        return
 
-    end_idx = start_index + interval
-
-    if end_idx >= len(scale):
-        end_octave += 1
-    elif end_idx < 0:
-        end_octave -= 1
-
-    end_idx %= len(scale)
-    end_pname = scale[end_idx]
-
-    return str(end_pname), str(end_octave)
-
-
-def generate_zone(surface, bb):
+def number_to_pitch(number):
     '''
-    Given a bounding box, generates a zone element, adds it to the given @surface,
-    and returns its ID.
+    Returns the (pname, oct) strings of the pitch @number from pitch_to_number.
     '''
-    el = MeiElement('zone')
-    surface.addChild(el)
-
-    # could be cleaner, but necessary so that we don't add extra attributes from @bb
-    attribs = {
-        'ulx': bb['ulx'],
-        'uly': bb['uly'],
-        'lrx': bb['lrx'],
-        'lry': bb['lry'],
-    }
-
-    el = add_attributes_to_element(el, attribs)
-    return el.getId()
+    try:
+        return _pitch_names[number]
+    except KeyError:
+        octave, degree = divmod(number, len(SCALE))
+        pitch = _pitch_names[number] = (SCALE[degree], str(octave))
+        return pitch
 
 
-def build_mei(pairs, classifier, staves, page):
+def build_mei(pairs, classifier, staves, page, zones=None):
     '''
     Encodes the final MEI document using:
         @pairs: Pairs from the neume_to_lyric_alignment.
-        @classifier: The MEI mapping dictionary output
-            by fetch_table_from_csv() in parse_classifier_table.py
+        @classifier: The MEI mapping dictionary output by fetch_table_from_csv() in
+            parse_classifier_table.py, compiled with compile_classifier(), or a
+            ClassifierResolver. Glyphs it has no entry for are reported once at the end.
         @staves: Bounding box information from pitch finding JSON.
         @page: Page dimension information from pitch finding JSON.
+        @zones: Optionally, an empty ZoneRegistry (with no surface) that will be attached to the
+            document's surface, so the caller can reuse it for merge_nearby_neume_components.
     '''
     meiDoc, surface, layer = generate_base_document()
+    set_surface_bounds(surface, page)
+
+    if zones is None:
+        zones = ZoneRegistry()
+    zones.surface = surface
+    zones.element_cls = MeiElement
+
+    classifier = pct.resolver(classifier)
+    encode_layer(pairs, classifier, staves, zones, layer)
+    classifier.log_unknown()
+    return meiDoc
+
+
+def set_surface_bounds(surface, page):
+    '''
+    Sets the bounding box of the @surface element to that of the page.
+    '''
     surface_bb = {
         'ulx': page['bounding_box']['ulx'],
         'uly': page['bounding_box']['uly'],
@@ -346,221 +377,420 @@ def build_mei(pairs, classifier, staves, page):
     surface.addAttribute('lrx', str(surface_bb['lrx']))
     surface.addAttribute('lry', str(surface_bb['lry']))
 
+
+def encode_layer(pairs, classifier, staves, zones, layer, element_cls=MeiElement):
+    '''
+    Adds the contents of the page to @layer, syllable by syllable, registering every bounding box
+    in the ZoneRegistry @zones. Takes the same @pairs, @classifier and @staves as build_mei; elements
+    are created as @element_cls (MeiElement, or mei_writer.StreamElement for the streaming writer).
+    '''
     # add an initial system beginning
-    sb = MeiElement('sb')
-    bb = staves[0]['bounding_box']
+    layer.addChild(create_system_break(staves[0], zones, element_cls))
+
+    # add to the MEI document, syllable by syllable
+    for gs, syl_box in pairs:
+        for el in encode_syllable(gs, syl_box, classifier, staves, zones, element_cls):
+            layer.addChild(el)
+
+
+def create_system_break(staff, zones, element_cls=MeiElement):
+    '''
+    Creates an <sb> element whose zone is the bounding box of @staff, from the pitch finding JSON.
+    '''
+    sb = element_cls('sb')
+    bb = staff['bounding_box']
     bb = {
         'ulx': bb['ulx'],
         'uly': bb['uly'],
         'lrx': bb['ulx'] + bb['ncols'],
         'lry': bb['uly'] + bb['nrows'],
     }
-    zoneId = generate_zone(surface, bb)
+    zoneId = zones.register(bb)
     sb.addAttribute('facs', '#' + zoneId)
-    layer.addChild(sb)
+    return sb
 
-    # add to the MEI document, syllable by syllable
-    for gs, syl_box in pairs:
 
-        # first add information about the text itself
-        cur_syllable = MeiElement('syllable')
-        bb = {
-            'ulx': syl_box['ul'][0],
-            'uly': syl_box['ul'][1],
-            'lrx': syl_box['lr'][0],
-            'lry': syl_box['lr'][1],
-        }
-        zoneId = generate_zone(surface, bb)
-        layer.addChild(cur_syllable)
-
-        # add syl element containing text on page
-        syl = MeiElement('syl')
-        syl.setValue(str(syl_box['syl']))
-        syl.addAttribute('facs', '#' + zoneId)
-        cur_syllable.addChild(syl)
-
-        # iterate over glyphs on the page that fall within the bounds of this syllable
-        for i, glyph in enumerate(gs):
-
-            # are we done with neume components in this grouping?
-            syllable_over = not any(('neume' in x['name']) for x in gs[i:])
-            new_el = glyph_to_element(classifier, glyph, surface)
-            if not new_el:
-                continue
-            # four cases to consider:
-            # 1. no line break and done with this syllable (usually a clef)
-            # 2. no line break and not done with this syllable (more neume components to add)
-            # 3. a line break and done with this syllable (a custos OUTSIDE a <syllable> tag)
-            # 4. a line break and not done with this syllable (a custos INSIDE a <syllable> tag)
-
-            if not glyph['system_begin']:
-                # case 1
-                if syllable_over:
-                    layer.addChild(new_el)
-                # case 2
-                else:
-                    cur_syllable.addChild(new_el)
-                continue
-
-            sb = MeiElement('sb')
-            cur_staff = int(glyph['staff'])
-
-            bb = staves[cur_staff]['bounding_box']
-            bb = {
-                'ulx': bb['ulx'],
-                'uly': bb['uly'],
-                'lrx': bb['ulx'] + bb['ncols'],
-                'lry': bb['uly'] + bb['nrows'],
-            }
-            zoneId = generate_zone(surface, bb)
-            sb.addAttribute('facs', '#' + zoneId)
-
-            # case 3: the syllable is over, so the custos goes outside the syllable
-            # do not include custos in <sb> tags! this was a typo in the MEI documentation
-            if syllable_over:
-                layer.addChild(new_el)
-                layer.addChild(sb)
-            # case 4
+def syllable_over_flags(gs):
+    '''
+    For every glyph in @gs, whether there are no neumes left in the group from that glyph on
+    (i.e. whether we are done with neume components in this syllable), computed in a single
+    backward pass over the group.
+    '''
+    flags = [False] * len(gs)
+    over = True
+    for i in range(len(gs) - 1, -1, -1):
+        if 'neume' in gs[i]['name']:
+            over = False
+        flags[i] = over
+    return flags
+
+
+def encode_syllable(gs, syl_box, classifier, staves, zones, element_cls=MeiElement, syllable_over=None,
+                    merger=None):
+    '''
+    Encodes a single ([glyphs], syllable) pair from neume_to_lyric_alignment. Returns the list of
+    elements to add to the layer, in order: the <syllable>, followed by whatever belongs outside
+    of it (clefs, custos and system breaks after the last neume). @syllable_over can be given if
+    the flags from syllable_over_flags have already been computed for @gs. If a NeumeMerger is
+    given as @merger, nearby neume components are merged as the syllable is filled in.
+    '''
+    if syllable_over is None:
+        syllable_over = syllable_over_flags(gs)
+
+    # first add information about the text itself
+    cur_syllable = element_cls('syllable')
+    bb = {
+        'ulx': syl_box['ul'][0],
+        'uly': syl_box['ul'][1],
+        'lrx': syl_box['lr'][0],
+        'lry': syl_box['lr'][1],
+    }
+    zoneId = zones.register(bb)
+    layer_els = [cur_syllable]
+
+    if merger is None:
+        def add_to_syllable(el, bb=None):
+            cur_syllable.addChild(el)
+    else:
+        merger.begin(cur_syllable)
+        add_to_syllable = merger.add
+
+    # add syl element containing text on page
+    syl = element_cls('syl')
+    syl.setValue(str(syl_box['syl']))
+    syl.addAttribute('facs', '#' + zoneId)
+    add_to_syllable(syl)
+
+    # iterate over glyphs on the page that fall within the bounds of this syllable
+    for i, glyph in enumerate(gs):
+
+        new_el = glyph_to_element(classifier, glyph, zones, element_cls)
+        if not new_el:
+            continue
+        # four cases to consider:
+        # 1. no line break and done with this syllable (usually a clef)
+        # 2. no line break and not done with this syllable (more neume components to add)
+        # 3. a line break and done with this syllable (a custos OUTSIDE a <syllable> tag)
+        # 4. a line break and not done with this syllable (a custos INSIDE a <syllable> tag)
+
+        if not glyph['system_begin']:
+            # case 1
+            if syllable_over[i]:
+                layer_els.append(new_el)
+            # case 2
             else:
-                cur_syllable.addChild(new_el)
-                cur_syllable.addChild(sb)
+                add_to_syllable(new_el, glyph['bounding_box'])
+            continue
+
+        sb = create_system_break(staves[int(glyph['staff'])], zones, element_cls)
+
+        # case 3: the syllable is over, so the custos goes outside the syllable
+        # do not include custos in <sb> tags! this was a typo in the MEI documentation
+        if syllable_over[i]:
+            layer_els.append(new_el)
+            layer_els.append(sb)
+        # case 4
+        else:
+            add_to_syllable(new_el, glyph['bounding_box'])
+            add_to_syllable(sb)
+
+    return layer_els
 
-    return meiDoc
 
+def zone_widths(glyphs, syl_boxes, classifier, staves):
+    '''
+    Returns the width of every zone registration that encoding these glyphs and syllable boxes
+    makes (every glyph appears in exactly one pair from neume_to_lyric_alignment, and @syl_boxes
+    are the boxes of all the pairs, including blank ones), without creating any elements. This
+    lets the median width for merging neume components be known before the layer is written.
+    '''
+    widths = [staves[0]['bounding_box']['ncols']]
+    widths.extend(syl_box['lr'][0] - syl_box['ul'][0] for syl_box in syl_boxes)
+    for glyph in glyphs:
+        template = classifier.get(str(glyph['name']))
+        if template is None:
+            continue
+        bb = glyph['bounding_box']
+        widths.extend([bb['lrx'] - bb['ulx']] * (len(template.components) or 1))
+        if glyph['system_begin']:
+            widths.append(staves[int(glyph['staff'])]['bounding_box']['ncols'])
+    return widths
 
-def merge_nearby_neume_components(meiDoc, width_mult):
+
+def merge_nearby_neume_components(meiDoc, width_mult, zones=None):
     '''
     A heuristic to merge together neume components that are 1) consecutive 2) within the same
     syllable 3) within a certain distance from each other. This distance is by default set to the
     average width of a neume component within this page, but can be modified using the
     @width_multiplier argument. The output MEI will still be correct even if this method is not run.
+
+    @zones is the ZoneRegistry the document was built with, if available; otherwise it is rebuilt
+    from the attributes of the document's surface.
     '''
     all_syllables = meiDoc.getElementsByName('syllable')
-    surface = meiDoc.getElementsByName('surface')[0]
+    if zones is None:
+        zones = ZoneRegistry.from_surface(meiDoc.getElementsByName('surface')[0])
 
-    surf_dict = {}
-    neume_widths = []
-    for c in surface.getChildren():
-        surf_dict[c.id] = {}
-        for coord in c.attributes:
-            surf_dict[c.id][coord.name] = int(coord.value)
+    med_neume_width = merge_threshold(zones.widths, width_mult)
+
+    for syllable in all_syllables:
+        merge_syllable_neumes(syllable, zones, med_neume_width)
+
+    return meiDoc
 
-    neume_widths = [x['lrx'] - x['ulx'] for x in surf_dict.values()]
-    med_neume_width = np.median(neume_widths) * width_mult
+
+def merge_threshold(widths, width_mult):
+    '''
+    Returns the largest distance allowed between two neumes that are merged, given the widths of
+    all zones on the page.
+    '''
+    return median(widths) * width_mult
+
+
+def median(values):
+    '''
+    The median of a non-empty list of numbers, as a float (same as numpy.median, which isn't worth
+    importing for this alone).
+    '''
+    values = sorted(values)
+    mid = len(values) // 2
+    if len(values) % 2:
+        return float(values[mid])
+    return (values[mid - 1] + values[mid]) / 2.0
+
+
+def merge_syllable_neumes(syllable, zones, max_distance):
+    '''
+    Merges the consecutive neumes of a single syllable that are within @max_distance of each
+    other, as described in merge_nearby_neume_components, looking up the extents of neume
+    components in the ZoneRegistry @zones.
+    '''
 
     # returns True if both inputs are of type 'neume' and they are close enough to be merged
     def compare_neumes(nl, nr):
         if not (nl.name == 'neume' and nr.name == 'neume'):
             return False
 
-        nl_right_bound = max([surf_dict[n.getAttribute('facs').value[1:]]['lrx'] for n in nl.children])
-        nr_left_bound = min([surf_dict[n.getAttribute('facs').value[1:]]['ulx'] for n in nr.children])
+        nl_right_bound = max([zones[n.getAttribute('facs').value[1:]].lrx for n in nl.children])
+        nr_left_bound = min([zones[n.getAttribute('facs').value[1:]].ulx for n in nr.children])
 
         distance = nr_left_bound - nl_right_bound
 
-        return (distance <= med_neume_width)
+        return (distance <= max_distance)
 
-    for syllable in all_syllables:
-        children = syllable.getChildren()
+    children = syllable.getChildren()
 
-        # holds children of the current syllable that will be added to target
-        accumulator = []
+    # holds children of the current syllable that will be added to target
+    accumulator = []
 
-        # holds the first neume in a sequence of neumes that will be merged
-        target = None
+    # holds the first neume in a sequence of neumes that will be merged
+    target = None
 
-        # holds children once in the accumulator that must be removed after iteration is done
-        children_to_remove = []
+    # holds children once in the accumulator that must be removed after iteration is done
+    children_to_remove = []
 
-        # iterate over all children. for each neume decide whether or not it should be merged
-        # with the next one using compare_neumes. if yes, add the next one to the accumulator.
-        # if not, empty the accumulator and add its contents to the target.
-        for i in range(len(children)):
-            if (i + 1 < len(children)) and (compare_neumes(children[i], children[i+1])):
-                accumulator.append(children[i+1])
-                if not target:
-                    target = children[i]
-            else:
-                ncs_to_merge = []
-                for neume in accumulator:           # empty contents of accumulator into ncs_to_merge
-                    ncs_to_merge += neume.children
-                for nc in ncs_to_merge:             # merge all neume components
-                    target.addChild(nc)
-                children_to_remove += accumulator
-                # for neume in accumulator:           # clean up neumes that were merged
-                #     syllable.removeChild(neume)
-                target = None
-                accumulator = []
-
-        for neume in children_to_remove:
-            syllable.removeChild(neume)
+    # iterate over all children. for each neume decide whether or not it should be merged
+    # with the next one using compare_neumes. if yes, add the next one to the accumulator.
+    # if not, empty the accumulator and add its contents to the target.
+    for i in range(len(children)):
+        if (i + 1 < len(children)) and (compare_neumes(children[i], children[i+1])):
+            accumulator.append(children[i+1])
+            if not target:
+                target = children[i]
+        else:
+            ncs_to_merge = []
+            for neume in accumulator:           # empty contents of accumulator into ncs_to_merge
+                ncs_to_merge += neume.children
+            for nc in ncs_to_merge:             # merge all neume components
+                target.addChild(nc)
+            children_to_remove += accumulator
+            target = None
+            accumulator = []
 
-    return meiDoc
+    for neume in children_to_remove:
+        syllable.removeChild(neume)
 
 
-def process(jsomr, syls, classifier, width_mult, verbose=True):
+def write_mei(out, pairs, classifier, staves, page, width_mult=0):
     '''
-    Runs the entire MEI encoding process given the three inputs to the rodan job and the
-    width_multiplier parameter for merging neume components.
+    Encodes the same MEI document as build_mei (followed by merge_nearby_neume_components, if
+    @width_mult > 0), but writes it incrementally to the file-like object @out with the streaming
+    writer in mei_writer.py instead of building a pymei tree. Each syllable is merged and written
+    as soon as it is complete, so the whole document is never held in memory at once.
     '''
-    glyphs = jsomr['glyphs']
-    syl_boxes = syls['syl_boxes'] if syls is not None else None
-    median_line_spacing = syls['median_line_spacing'] if syls is not None else None
+    # pipeline.py builds on this module, so it is imported here rather than at the top
+    import pipeline
 
-    glyphs = add_flags_to_glyphs(glyphs)
-    pairs = neume_to_lyric_alignment(glyphs, syl_boxes, median_line_spacing)
-    meiDoc = build_mei(pairs, classifier, jsomr['staves'], jsomr['page'])
+    classifier = pct.resolver(classifier)
+    context = pipeline.EncodingContext(None, None, None, classifier, staves, page, width_mult)
+    stages = pipeline.Pipeline().replace('align', pipeline.from_pairs(pairs))
+    stream_document(out, context, stages)
+    classifier.log_unknown()
 
-    if width_mult > 0:
-        meiDoc = merge_nearby_neume_components(meiDoc, width_mult=width_mult)
 
-    return documentToText(meiDoc)
+def stream_document(out, context, stages, instrumentation=None, fmt=None, validator=None, staff_workers=None):
+    '''
+    Runs the page described by @context through the pipeline @stages, writing the resulting MEI
+    to the file-like object @out as it goes, measured by @instrumentation if given. @fmt is the
+    mei_writer.OutputFormat to write it in (only its IDs and minifying matter here). Every zone
+    and child of the layer is fed to the mei_validator.StructureValidator @validator as it is
+    written. With @staff_workers, the staves are encoded over that many processes (see
+    staff_parallel.py).
+    '''
+    element_cls = StreamElement
+    if fmt is not None and fmt.compact_ids:
+        element_cls = SequentialIds(StreamElement)
+    root, surface, layer = generate_base_tree(element_cls)
+    set_surface_bounds(surface, context.page)
+
+    hook = validator.element if validator is not None else None
+    writer = StreamingMeiWriter(out, root, surface, layer, on_zone=hook, on_layer_child=hook,
+                                minify=fmt is not None and fmt.minify)
+    context.zones = ZoneRegistry(writer.surface, element_cls)
+    context.element_cls = element_cls
+    if staff_workers is not None:
+        import staff_parallel
+        staff_parallel.encode_staves(stages, context, writer, staff_workers, instrumentation, validator)
+    else:
+        run_stages(stages, context, writer.layer, instrumentation)
+    with measure(instrumentation, 'serialize'):
+        writer.close()
+    if validator is not None:
+        validator.finish()
+
+
+def run_stages(stages, context, layer, instrumentation=None):
+    '''
+    Runs the pipeline @stages into @layer, through @instrumentation if there is one.
+    '''
+    if instrumentation is None:
+        stages.run(context, layer)
+    else:
+        instrumentation.run(stages, context, layer)
 
 
-if __name__ == '__main__':
+@contextmanager
+def measure(instrumentation, name):
+    '''
+    Records the body of the with statement as stage @name of @instrumentation, if there is one.
+    '''
+    if instrumentation is None:
+        yield
+    else:
+        with instrumentation.measure(name):
+            yield
 
-    # A script for running the encoding process locally on the salzinnes manuscript.
-    # Replace paths and filenames as per your local setup.
-    # Assumes that all files are numbered with the "CF-" filenames that the images of the manuscript
-    # originally came with.
-
-    classifier_fname = 'csv-square notation test_20190725015554.csv'
-    classifier = pct.fetch_table_from_csv(classifier_fname)
-
-    f_inds = range(0, 200)
-
-    for f_ind in f_inds:
-        fname = 'salzinnes_{:0>3}'.format(f_ind)
-        inJSOMR = './jsomr-split/pitches_{}.json'.format(fname)
-        in_syls = './syl_json/{}.json'.format(fname)
-        in_png = '/Users/tim/Desktop/PNG_compressed/CF-{:0>3}.png'.format(f_ind)
-        out_fname = './out_mei/output_split_{}.mei'.format(fname)
-        out_fname_png = './out_png/{}_alignment.png'.format(fname)
-
-        try:
-            with open(inJSOMR, 'r') as file:
-                jsomr = json.loads(file.read())
-            with open(in_syls) as file:
-                syls = json.loads(file.read())
-        except IOError:
-            print('{} not found, skipping...'.format(fname))
-            continue
 
-        print('building mei for {}...'.format(fname))
+def process(jsomr, syls, classifier, width_mult, verbose=True, output_path=None, stages=None,
+            instrumentation=None, output_format=None, memory_limit=None, validator=None,
+            staff_workers=None, aliases=None, logger=None):
+    '''
+    Runs the entire MEI encoding process given the three inputs to the rodan job and the
+    width_multiplier parameter for merging neume components.
+
+    The page goes through a pipeline of lazy stages (see pipeline.py), by default aligning glyphs
+    to syllables, encoding each syllable and merging its nearby neume components; a customized
+    pipeline.Pipeline can be given in @stages to add, drop or reorder stages. An
+    instrumentation.Instrumentation can be given to measure each step of the way.
+
+    @jsomr can also come from jsomr_ingest.load_jsomr, with its glyphs already in a GlyphTable.
+
+    Returns the MEI as a string, or, if @output_path is given, streams it straight into that file
+    and returns None. @output_format names one of mei_writer.OUTPUT_FORMATS: 'compact' gives
+    every element a short ID numbered in document order (z1, nc2, ...) instead of a random one,
+    so the same page always encodes to the same file, 'minified' also leaves out indentation and
+    line breaks, and 'gzip' also compresses the file (and so needs an @output_path).
+
+    With a @memory_limit in bytes, the page is encoded in memory-bounded mode (see
+    memory_guard.py): the MEI has to be streamed to an @output_path, the glyph dicts in @jsomr are
+    replaced by the GlyphTable made from them so they can be freed, and a MemoryLimitExceeded
+    error is raised as soon as the RSS of the process is found to have grown by more than
+    @memory_limit since this was called. This is a soft limit: the RSS is only sampled between
+    syllable groups. What was measured ends up in the metrics of @instrumentation, if given.
+
+    A mei_validator.StructureValidator can be given in @validator to check the MEI for structural
+    errors on the way; its violations are there to look at once this returns.
+
+    With @staff_workers, the staves of the page are encoded in parallel over that many worker
+    processes (see staff_parallel.py), giving the same MEI as encoding them one after the other.
+    Any stages after the first in a custom pipeline then have to be picklable.
+
+    Glyph classes that aren't in the classifier are encoded as the closest more general class
+    that is (neume.podatus2.variant as neume.podatus2, say), or as whatever @aliases (a
+    dictionary of class names) map them to (see parse_classifier_table.ClassifierResolver; a
+    ClassifierResolver can also be given as @classifier). Glyphs that can't be encoded at all are
+    left out and, if @verbose, reported once for the page as a warning to @logger (by default,
+    parse_classifier_table's), as are neumes whose pitch isn't in the scale.
+    '''
+    fmt = get_output_format(output_format)
+    # pipeline.py builds on this module, so it is imported here rather than at the top
+    import pipeline
+
+    if fmt.gzip and output_path is None:
+        raise ValueError('gzip output can only be written to a file')
+    if memory_limit is not None and output_path is None:
+        raise ValueError('memory-bounded encoding can only be written to a file')
+    if memory_limit is not None and staff_workers is not None:
+        raise ValueError('memory-bounded encoding can not be split over staff workers')
+
+    if instrumentation is not None:
+        instrumentation.start()
+    # taken before anything is built for the page, as the baseline the limit is counted from
+    guard = MemoryGuard(memory_limit) if memory_limit is not None else None
 
-        glyphs = jsomr['glyphs']
-        syl_boxes = syls['syl_boxes']
-        median_line_spacing = syls['median_line_spacing']
+    syl_boxes = syls['syl_boxes'] if syls is not None else None
+    median_line_spacing = syls['median_line_spacing'] if syls is not None else None
 
-        print('adding flags to glyphs...')
-        glyphs = add_flags_to_glyphs(glyphs)
-        print('performing neume-to-lyric alignment...')
-        pairs = neume_to_lyric_alignment(glyphs, syl_boxes, median_line_spacing)
-        print('building MEI...')
-        meiDoc = build_mei(pairs, classifier, jsomr['staves'], jsomr['page'])
-        print('neume component spacing > 0, merging nearby components...')
-        meiDoc = merge_nearby_neume_components(meiDoc, width_mult=0.25)
+    with measure(instrumentation, 'classifier'):
+        classifier = pct.resolver(classifier, aliases)
+    with measure(instrumentation, 'glyph_table'):
+        glyphs = jsomr['glyphs']
+        if not isinstance(glyphs, GlyphTable):
+            glyphs = GlyphTable.from_jsomr(glyphs)
+            if memory_limit is not None:
+                jsomr['glyphs'] = glyphs
+    context = pipeline.EncodingContext(
+        glyphs, syl_boxes, median_line_spacing, classifier, jsomr['staves'], jsomr['page'], width_mult)
+    if stages is None:
+        stages = pipeline.Pipeline()
+
+    if guard is not None:
+        stages = stages.copy().append('memory', guard.stage)
+
+    if output_path is not None:
+        with open_output(output_path, fmt) as out:
+            stream_document(out, context, stages, instrumentation, fmt, validator, staff_workers)
+        result = None
+    elif fmt.compact_ids or fmt.minify or staff_workers is not None:
+        # only the streaming writer can minify or stitch staves together; otherwise it writes the
+        # same text documentToText does
+        out = io.StringIO()
+        stream_document(out, context, stages, instrumentation, fmt, validator, staff_workers)
+        result = out.getvalue()
+    else:
+        meiDoc, surface, layer = generate_base_document()
+        set_surface_bounds(surface, jsomr['page'])
+        context.zones = ZoneRegistry(surface, MeiElement)
+        context.element_cls = MeiElement
+        run_stages(stages, context, layer, instrumentation)
+        if validator is not None:
+            with measure(instrumentation, 'validate'):
+                validator.element(meiDoc.getRootElement())
+                validator.finish()
+        with measure(instrumentation, 'serialize'):
+            result = documentToText(meiDoc)
+
+    if verbose:
+        classifier.log_unknown(logger if logger is not None else pct.logger)
+    if instrumentation is not None:
+        if guard is not None:
+            instrumentation.metrics.memory = guard.report()
+        instrumentation.finish(context)
+    return result
 
-        draw_mei_doc(in_png, out_fname_png, meiDoc)
 
-        documentToFile(meiDoc, out_fname)
+if __name__ == '__main__':
+    # encoding whole manuscripts locally, and drawing their alignment (--png-dir), is done by batch_encode.py
+    import sys
+    import batch_encode
+    sys.exit(batch_encode.main())
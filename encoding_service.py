@@ -0,0 +1,351 @@
+'''
+A long-running local encoding service, for correction tools that need a page re-encoded within a
+fraction of a second, without going through a Celery task that imports everything and parses the
+MEI mapping CSV again for every page.
+
+The service speaks plain HTTP/1.1 (one request per connection) on localhost or on a Unix socket:
+    python encoding_service.py --port 8765 --classifier mapping.csv
+    python encoding_service.py --socket /tmp/mei_encoding.sock --workers 4
+
+POST /encode takes a JSON body with the page's JSOMR, its text alignment results (or null), the
+name of the MEI mapping CSV, and optionally the neume component spacing and output format:
+    {"jsomr": {...}, "alignment": {...}, "classifier": "mapping", "width_mult": 0.5,
+     "output_format": "compact"}
+and returns the MEI, with the time spent waiting for a worker, encoding and in total in the
+X-Queue-Seconds, X-Encode-Seconds and X-Total-Seconds headers. GET /stats returns the latencies of
+recent requests and the state of the service as JSON.
+
+Only the MEI mapping CSVs given with --classifier can be used, named by their file name without
+the extension (mapping for /data/mapping.csv); requests can't point the service at other files.
+Malformed requests are answered with a short error message, and failures with a generic one, the
+details going to the service's log only.
+
+Pages are encoded by build_mei_file.process in a pool of worker processes, each keeping the
+classifiers it has compiled (see parse_classifier_table.load_classifier), which it does for
+every classifier as it starts. At most --max-pending requests are taken on at
+once, counting those being encoded; any more are turned away straight away with a 503 and a
+Retry-After header rather than queued without bound.
+'''
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import time
+import traceback
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import build_mei_file as bm
+import parse_classifier_table as pct
+from mei_writer import get_output_format
+
+logger = logging.getLogger(__name__)
+
+# largest request body accepted, in bytes
+MAX_BODY = 256 * 1024 * 1024
+
+# number of recent requests the latency percentiles in /stats are taken over
+STATS_WINDOW = 1000
+
+_REASONS = {
+    200: 'OK',
+    400: 'Bad Request',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    413: 'Payload Too Large',
+    500: 'Internal Server Error',
+    503: 'Service Unavailable',
+}
+
+
+class RequestError(Exception):
+    '''
+    A request that can't be served, answered with the HTTP @status and the error's message.
+    '''
+
+    def __init__(self, status, message):
+        Exception.__init__(self, message)
+        self.status = status
+
+    def __reduce__(self):
+        # raised in worker processes, so it has to survive being pickled back
+        return (RequestError, (self.status, str(self)))
+
+
+def classifier_names(paths):
+    '''
+    Returns the MEI mapping CSVs at @paths in a dictionary by the names requests refer to them
+    by, their file names without the extension. Raises a ValueError if two have the same name.
+    '''
+    names = {}
+    for path in paths:
+        name = os.path.splitext(os.path.basename(path))[0]
+        if name in names:
+            raise ValueError('classifiers {} and {} are both named {}'.format(names[name], path, name))
+        names[name] = os.path.abspath(path)
+    return names
+
+
+# set in every worker process by _init_worker
+_classifiers = {}
+
+
+def _init_worker(classifiers):
+    global _classifiers
+    _classifiers = classifiers
+    for fname in classifiers.values():
+        pct.load_classifier(fname)
+
+
+def encode_request(body):
+    '''
+    Encodes the page in the JSON body of an /encode request, in a worker process. Returns the MEI
+    and the time taken; raises a RequestError if the request is malformed or names a classifier
+    the service wasn't started with.
+    '''
+    start = time.time()
+    try:
+        request = json.loads(body)
+        jsomr = request['jsomr']
+        for key in ('glyphs', 'staves', 'page'):
+            if key not in jsomr:
+                raise KeyError(key)
+        syls = request.get('alignment')
+        name = request['classifier']
+        width_mult = float(request.get('width_mult', 0))
+        output_format = request.get('output_format')
+    except (ValueError, KeyError, TypeError, AttributeError):
+        raise RequestError(400, 'bad request: expected a JSON object with jsomr, alignment and classifier')
+    try:
+        fmt = get_output_format(output_format)
+    except (ValueError, TypeError):
+        raise RequestError(400, 'unknown output format')
+    if fmt.gzip:
+        raise RequestError(400, 'gzip output can only be written to a file')
+    if not isinstance(name, str) or name not in _classifiers:
+        raise RequestError(400, 'unknown classifier')
+
+    classifier = pct.load_classifier(_classifiers[name])
+    mei = bm.process(jsomr, syls, classifier, width_mult, output_format=output_format)
+    return mei, time.time() - start
+
+
+def _percentile(values, fraction):
+    # nearest-rank percentile of an already sorted, non-empty list
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+class LatencyStats(object):
+    '''
+    Counts the requests served, failed and turned away, and keeps the (queue, encode, total)
+    latencies in seconds of the last @window ones served.
+    '''
+
+    def __init__(self, window=STATS_WINDOW):
+        self.latencies = deque(maxlen=window)
+        self.served = 0
+        self.failed = 0
+        self.rejected = 0
+
+    def record(self, queue, encode, total):
+        self.served += 1
+        self.latencies.append((queue, encode, total))
+
+    def as_dict(self):
+        result = {
+            'served': self.served,
+            'failed': self.failed,
+            'rejected': self.rejected,
+        }
+        for i, name in enumerate(('queue', 'encode', 'total')):
+            values = sorted(latency[i] for latency in self.latencies)
+            if not values:
+                continue
+            result[name + '_seconds'] = {
+                'mean': sum(values) / len(values),
+                'p50': _percentile(values, 0.5),
+                'p95': _percentile(values, 0.95),
+                'max': values[-1],
+            }
+        return result
+
+
+class EncodingService(object):
+    '''
+    Serves encoding requests over HTTP, as described in the module documentation, with
+    @workers worker processes (by default, one per core) that compile the @classifiers (paths to
+    MEI mapping CSVs, the only ones requests can use) as they start. At most @max_pending requests (by default, twice the number
+    of workers) are taken on at once.
+    '''
+
+    def __init__(self, workers=None, max_pending=None, classifiers=(), max_body=MAX_BODY, logger=logger):
+        self.workers = workers or os.cpu_count() or 1
+        self.max_pending = max_pending or 2 * self.workers
+        self.classifiers = classifier_names(classifiers)
+        self.max_body = max_body
+        self.logger = logger
+        self.pending = 0
+        self.stats = LatencyStats()
+        self.executor = ProcessPoolExecutor(self.workers, initializer=_init_worker, initargs=(self.classifiers,))
+
+    async def warm_up(self):
+        '''
+        Starts every worker process (compiling the classifiers in each) before the first request
+        comes in, instead of when it does.
+        '''
+        # every task submitted while no worker is idle starts a new one, up to self.workers
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*[loop.run_in_executor(self.executor, os.getpid) for _ in range(self.workers)])
+
+    async def encode(self, body):
+        '''
+        Encodes the page in an /encode request @body in a worker, turning it away if too many
+        requests are pending already. Returns the MEI and the (queue, encode, total) latencies.
+        '''
+        if self.pending >= self.max_pending:
+            self.stats.rejected += 1
+            raise RequestError(503, 'too many requests pending ({}), try again later'.format(self.pending))
+
+        self.pending += 1
+        start = time.time()
+        try:
+            mei, encode_seconds = await asyncio.get_running_loop().run_in_executor(
+                self.executor, encode_request, body)
+        finally:
+            self.pending -= 1
+        total = time.time() - start
+        latency = (max(0.0, total - encode_seconds), encode_seconds, total)
+        self.stats.record(*latency)
+        return mei, latency
+
+    async def handle(self, reader, writer):
+        '''
+        Serves a single request on the connection (@reader, @writer), then closes it.
+        '''
+        status, headers, body = 200, [], b''
+        try:
+            method, path, request_body = await self._read_request(reader)
+            if path == '/encode':
+                if method != 'POST':
+                    raise RequestError(405, 'use POST for /encode')
+                mei, latency = await self.encode(request_body)
+                body = mei.encode('utf-8')
+                headers = [
+                    ('Content-Type', 'application/mei+xml; charset=utf-8'),
+                    ('X-Queue-Seconds', '{:.4f}'.format(latency[0])),
+                    ('X-Encode-Seconds', '{:.4f}'.format(latency[1])),
+                    ('X-Total-Seconds', '{:.4f}'.format(latency[2])),
+                ]
+                self.logger.info('encoded {} bytes of JSOMR in {:.3f}s ({:.3f}s waiting for a worker)'.format(
+                    len(request_body), latency[2], latency[0]))
+            elif path == '/stats':
+                stats = self.stats.as_dict()
+                stats.update({'pending': self.pending, 'max_pending': self.max_pending, 'workers': self.workers,
+                              'classifiers': sorted(self.classifiers)})
+                body = json.dumps(stats, indent=2).encode('utf-8')
+                headers = [('Content-Type', 'application/json')]
+            else:
+                raise RequestError(404, 'not found')
+        except RequestError as e:
+            if e.status != 503:
+                self.stats.failed += 1
+            status, body = e.status, (str(e) + '\n').encode('utf-8')
+            headers = [('Content-Type', 'text/plain; charset=utf-8')]
+            if e.status == 503:
+                headers.append(('Retry-After', '1'))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            writer.close()
+            return
+        except Exception:
+            self.stats.failed += 1
+            self.logger.error('request failed:\n{}'.format(traceback.format_exc()))
+            status, body = 500, b'encoding failed\n'
+            headers = [('Content-Type', 'text/plain; charset=utf-8')]
+
+        head = ['HTTP/1.1 {} {}'.format(status, _REASONS[status])]
+        head.extend('{}: {}'.format(k, v) for k, v in headers)
+        head.extend(['Content-Length: {}'.format(len(body)), 'Connection: close', '', ''])
+        try:
+            writer.write('\r\n'.join(head).encode('latin-1') + body)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def _read_request(self, reader):
+        request_line = (await reader.readline()).decode('latin-1').split()
+        if len(request_line) != 3:
+            raise RequestError(400, 'malformed request line')
+        method, path = request_line[0], request_line[1].split('?')[0]
+
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        try:
+            length = int(headers.get('content-length', 0))
+        except ValueError:
+            raise RequestError(400, 'bad Content-Length')
+        if length > self.max_body:
+            raise RequestError(413, 'request body larger than {} bytes'.format(self.max_body))
+        body = await reader.readexactly(length) if length else b''
+        return method, path, body
+
+    async def serve(self, host='127.0.0.1', port=8765, socket_path=None):
+        '''
+        Warms up the workers, then serves requests on @host:@port, or on the Unix socket
+        @socket_path if given, until cancelled.
+        '''
+        await self.warm_up()
+        if socket_path is not None:
+            server = await asyncio.start_unix_server(self.handle, socket_path)
+            where = socket_path
+        else:
+            server = await asyncio.start_server(self.handle, host, port)
+            where = '{}:{}'.format(host, port)
+        self.logger.info('serving on {} with {} workers, at most {} requests pending'.format(
+            where, self.workers, self.max_pending))
+        async with server:
+            await server.serve_forever()
+
+    def close(self):
+        self.executor.shutdown()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Serve MEI encoding requests locally.')
+    parser.add_argument('--host', default='127.0.0.1', help='address to listen on (default: 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=8765, help='port to listen on (default: 8765)')
+    parser.add_argument('--socket', help='listen on this Unix socket instead')
+    parser.add_argument('--workers', type=int, default=None, help='worker processes (default: all cores)')
+    parser.add_argument('--max-pending', type=int, default=None,
+                        help='requests taken on at once before turning new ones away (default: twice the workers)')
+    parser.add_argument('--classifier', action='append', default=[],
+                        help='MEI mapping CSV requests can use, by its file name without the extension; can be repeated')
+    args = parser.parse_args(argv)
+    if not args.classifier:
+        parser.error('at least one --classifier is required')
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+    try:
+        service = EncodingService(args.workers, args.max_pending, args.classifier)
+    except ValueError as e:
+        parser.error(str(e))
+    try:
+        asyncio.run(service.serve(args.host, args.port, args.socket))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,81 @@
+from bisect import bisect_left, bisect_right
+from glyph_table import GlyphTable
+
+
+class GlyphIndex(object):
+    '''
+    A spatial index over the glyphs of a page (a GlyphTable, or a list of glyphs as output by
+    add_flags_to_glyphs) used to find the anchor glyph of a syllable box without rescanning the whole page.
+
+    Glyphs are bucketed by staff. Each bucket keeps its glyphs sorted by horizontal center, along
+    with the vertical extent of the staff's glyphs, so that a query only has to look at the staves
+    that can overlap the query band and, within each of those, only at glyphs to the right of the
+    query point. Positions returned by queries are indices into the original glyph list.
+    '''
+
+    def __init__(self, glyphs):
+        if isinstance(glyphs, GlyphTable):
+            columns = zip(glyphs.staff, glyphs.ulx, glyphs.uly, glyphs.ncols)
+        else:
+            columns = (
+                (int(g['staff']), g['bounding_box']['ulx'], g['bounding_box']['uly'], g['bounding_box']['ncols'])
+                for g in glyphs
+            )
+
+        buckets = {}
+        for pos, (staff, ulx, uly, ncols) in enumerate(columns):
+            buckets.setdefault(staff, []).append((ulx + ncols // 2, pos, ulx, uly, ncols // 2))
+
+        # each bucket is (top, bottom, last_pos, max_half_width, centers, entries), sorted by top
+        self._buckets = []
+        for entries in buckets.values():
+            entries.sort()
+            top = min(e[3] for e in entries)
+            bottom = max(e[3] for e in entries)
+            last_pos = max(e[1] for e in entries)
+            max_half_width = max(e[4] for e in entries)
+            centers = [e[0] for e in entries]
+            self._buckets.append((top, bottom, last_pos, max_half_width, centers, entries))
+        self._buckets.sort(key=lambda b: b[0])
+
+        self._tops = [b[0] for b in self._buckets]
+
+        # running maximum of the bottoms, so a downward scan over the buckets can stop as soon as
+        # no earlier bucket can reach the query band
+        self._reach = []
+        reach = None
+        for b in self._buckets:
+            reach = b[1] if reach is None else max(reach, b[1])
+            self._reach.append(reach)
+
+    def __len__(self):
+        return sum(len(b[4]) for b in self._buckets)
+
+    def nearest_right(self, x, y_low, y_high, first_pos=0):
+        '''
+        Returns the position of the leftmost glyph (by @ulx) that has position >= @first_pos, an
+        @uly strictly between @y_low and @y_high, and a horizontal center strictly to the right of
+        @x. Ties are broken in favour of the lower position. Returns None if no glyph qualifies.
+        '''
+        best = None
+
+        i = bisect_left(self._tops, y_high) - 1
+        while i >= 0 and self._reach[i] > y_low:
+            top, bottom, last_pos, max_half_width, centers, entries = self._buckets[i]
+            i -= 1
+            if bottom <= y_low or last_pos < first_pos:
+                continue
+
+            for j in range(bisect_right(centers, x), len(entries)):
+                center, pos, ulx, uly, half_width = entries[j]
+
+                # entries are sorted by center, so once the smallest possible ulx of the remaining
+                # entries is past the best candidate, nothing further in this bucket can win
+                if best is not None and center - max_half_width > best[0]:
+                    break
+                if pos < first_pos or not (y_low < uly < y_high):
+                    continue
+                if best is None or (ulx, pos) < best:
+                    best = (ulx, pos)
+
+        return None if best is None else best[1]
@@ -0,0 +1,210 @@
+from array import array
+
+# stored in integer columns when pitch-finding gave no usable value; read back as None
+MISSING = -2 ** 31
+
+_PITCH_FIELDS = ('staff', 'offset', 'strt_pos', 'octave', 'note')
+
+
+def _to_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return MISSING
+
+
+def _from_int(value):
+    return None if value == MISSING else value
+
+
+def _box_column(values):
+    # coordinates are whole pixels, kept in a compact array; should a page have fractional ones,
+    # they are kept as they were given, as the glyph dicts did
+    try:
+        return array('i', values)
+    except (TypeError, OverflowError):
+        return list(values)
+
+
+def jsomr_row(g, strings):
+    '''
+    Extracts the fields the encoder uses from one glyph of a JSOMR file (nested or flat, see
+    GlyphTable.from_jsomr) as a tuple of (staff, offset, name, note, strt_pos, octave, ulx, uly,
+    ncols, nrows). Names and notes are interned through the dict @strings.
+    '''
+    inner = g.get('glyph', g)
+    pitch = g.get('pitch', g)
+    fields = [pitch[k] if k in pitch else inner.get(k) for k in _PITCH_FIELDS]
+    name = pitch['name'] if 'name' in pitch else inner['name']
+    bb = pitch['bounding_box'] if 'bounding_box' in pitch else inner['bounding_box']
+    return (
+        int(fields[0]),
+        int(fields[1]),
+        strings.setdefault(name, name),
+        strings.setdefault(fields[4], fields[4]),
+        _to_int(fields[2]),
+        _to_int(fields[3]),
+        bb['ulx'], bb['uly'], bb['ncols'], bb['nrows'],
+    )
+
+
+class GlyphTable(object):
+    '''
+    A columnar replacement for the list of flattened glyph dicts produced by add_flags_to_glyphs.
+
+    Every field the encoder reads is converted once at ingest and stored in a typed array (or, for
+    names and notes, a list of shared strings), sorted by staff and then offset, with the
+    system_begin flags computed in one pass over the staff column. Indexing or iterating over the
+    table makes lightweight GlyphRow views as they are needed, which behave like the old glyph
+    dicts (glyph['name'], glyph['bounding_box']['ulx'], glyph['system_begin'], ...), so they can
+    be passed to neume_to_lyric_alignment, build_mei and glyph_to_element as they are. Two views
+    of the same glyph are equal.
+    '''
+
+    def __init__(self, names, notes, staff, offset, strt_pos, octave, ulx, uly, ncols, nrows):
+        self.names = names
+        self.notes = notes
+        self.staff = array('i', staff)
+        self.offset = array('i', offset)
+        self.strt_pos = array('i', strt_pos)
+        self.octave = array('i', octave)
+        self.ulx = _box_column(ulx)
+        self.uly = _box_column(uly)
+        self.ncols = _box_column(ncols)
+        self.nrows = _box_column(nrows)
+        self.lrx = _box_column([x + w for x, w in zip(self.ulx, self.ncols)])
+        self.lry = _box_column([y + h for y, h in zip(self.uly, self.nrows)])
+
+        # a line break comes immediately after every glyph that is followed by one on a later staff
+        self.system_begin = array('b', [left < right for left, right in zip(self.staff, self.staff[1:])])
+        if len(self.staff):
+            self.system_begin.append(False)
+
+    @classmethod
+    def from_jsomr(cls, glyphs):
+        '''
+        Builds a table from the raw list of glyphs in a JSOMR file, where each entry has nested
+        'glyph' and 'pitch' dicts (fields in 'pitch' take precedence, as in add_flags_to_glyphs).
+        Glyphs that are already flat dicts are accepted as well.
+        '''
+        strings = {}
+        return cls.from_rows([jsomr_row(g, strings) for g in glyphs])
+
+    @classmethod
+    def from_rows(cls, rows):
+        '''
+        Builds a table from a list of rows as returned by jsomr_row, in any order.
+        '''
+        # sort glyphs in lexicographical order by staff #, left to right
+        rows.sort(key=lambda r: (r[0], r[1]))
+
+        columns = list(zip(*rows)) if rows else [()] * 10
+        staff, offset, names, notes, strt_pos, octave, ulx, uly, ncols, nrows = columns
+        return cls(list(names), list(notes), staff, offset, strt_pos, octave, ulx, uly, ncols, nrows)
+
+    def take(self, positions):
+        '''
+        Returns a new table holding only the glyphs at @positions, in that order, each keeping the
+        system_begin flag it has in this table.
+        '''
+        table = GlyphTable.__new__(GlyphTable)
+        table.names = [self.names[i] for i in positions]
+        table.notes = [self.notes[i] for i in positions]
+        for column in ('staff', 'offset', 'strt_pos', 'octave', 'ulx', 'uly', 'ncols', 'nrows', 'lrx', 'lry',
+                       'system_begin'):
+            values = getattr(self, column)
+            picked = [values[i] for i in positions]
+            setattr(table, column, array(values.typecode, picked) if isinstance(values, array) else picked)
+        return table
+
+    def __len__(self):
+        return len(self.staff)
+
+    def __iter__(self):
+        for i in range(len(self.staff)):
+            yield GlyphRow(self, i)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [GlyphRow(self, j) for j in range(*i.indices(len(self.staff)))]
+        if i < 0:
+            i += len(self.staff)
+        if not 0 <= i < len(self.staff):
+            raise IndexError('glyph index out of range')
+        return GlyphRow(self, i)
+
+
+class GlyphRow(object):
+    '''
+    A read-only view of one glyph in a GlyphTable, indexable by the same keys as the glyph dicts
+    from add_flags_to_glyphs.
+    '''
+    __slots__ = ('table', 'index')
+
+    def __init__(self, table, index):
+        self.table = table
+        self.index = index
+
+    def __getitem__(self, key):
+        try:
+            getter = _ROW_GETTERS[key]
+        except KeyError:
+            raise KeyError(key)
+        return getter(self.table, self.index)
+
+    def __contains__(self, key):
+        return key in _ROW_GETTERS
+
+    def get(self, key, default=None):
+        return self[key] if key in _ROW_GETTERS else default
+
+    def keys(self):
+        return list(_ROW_GETTERS.keys())
+
+    def __eq__(self, other):
+        return isinstance(other, GlyphRow) and self.table is other.table and self.index == other.index
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((id(self.table), self.index))
+
+    def __repr__(self):
+        return 'GlyphRow({!r})'.format(dict((k, self[k]) for k in _ROW_GETTERS if k != 'bounding_box'))
+
+
+class BoxView(object):
+    '''
+    A read-only view of the bounding box of one glyph in a GlyphTable, including lrx and lry.
+    '''
+    __slots__ = ('table', 'index')
+
+    def __init__(self, table, index):
+        self.table = table
+        self.index = index
+
+    def __getitem__(self, key):
+        if key not in _BOX_FIELDS:
+            raise KeyError(key)
+        return getattr(self.table, key)[self.index]
+
+    def __contains__(self, key):
+        return key in _BOX_FIELDS
+
+    def keys(self):
+        return list(_BOX_FIELDS)
+
+
+_BOX_FIELDS = ('ulx', 'uly', 'ncols', 'nrows', 'lrx', 'lry')
+
+_ROW_GETTERS = {
+    'name': lambda t, i: t.names[i],
+    'note': lambda t, i: t.notes[i],
+    'staff': lambda t, i: t.staff[i],
+    'offset': lambda t, i: t.offset[i],
+    'strt_pos': lambda t, i: _from_int(t.strt_pos[i]),
+    'octave': lambda t, i: _from_int(t.octave[i]),
+    'system_begin': lambda t, i: bool(t.system_begin[i]),
+    'bounding_box': lambda t, i: BoxView(t, i),
+}
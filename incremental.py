@@ -0,0 +1,235 @@
+'''
+Incremental re-encoding, for when a page is corrected a few glyphs at a time and encoded again.
+
+encode_incremental writes the MEI like process(output_path=...) does, along with a state file
+(<output>.state.json by default) recording a hash of the inputs of every syllable group, where
+its elements ended up in the MEI, and the zones on the page. When it is run again on the same
+output, the whole page is still aligned (that is cheap, and any change can move the anchors of
+later syllables), but every syllable group whose inputs hash the same as one from the previous
+run is copied from the previous MEI as it was, IDs included. Only the groups that changed go
+through encode_syllable again. The zones of every group are recorded too, in the order it used
+them, and registered again in that order when it is reused, so the surface comes out as it would
+from encoding the page from scratch.
+
+Anything that affects the whole page (the classifier and its aliases, the neume component
+spacing, the merge distance that follows from the widths of all zones, the page's bounding box)
+is recorded as well; if any of it differs, nothing is reused and the page is encoded from
+scratch.
+'''
+import hashlib
+import io
+import json
+import os
+from collections import namedtuple
+
+import build_mei_file as bm
+import parse_classifier_table as pct
+import pipeline
+from glyph_table import GlyphTable
+from mei_writer import StreamElement, StreamingMeiWriter, element_to_text
+from zone_registry import ZoneRegistry
+
+STATE_FORMAT = 2
+
+IncrementalResult = namedtuple('IncrementalResult', ['reused', 'encoded', 'changed_staves', 'reason'])
+
+
+
+class _RecordingZones(ZoneRegistry):
+    '''
+    A ZoneRegistry that also keeps the IDs of the zones registered since the last call to
+    take_registered, in the order they were first registered.
+    '''
+
+    def __init__(self, surface=None, element_cls=None):
+        ZoneRegistry.__init__(self, surface, element_cls)
+        self._registered = []
+
+    def register(self, bb, zone_id=None):
+        zone_id = ZoneRegistry.register(self, bb, zone_id)
+        if zone_id not in self._registered:
+            self._registered.append(zone_id)
+        return zone_id
+
+    def take_registered(self):
+        registered, self._registered = self._registered, []
+        return registered
+
+
+def _hash(value):
+    return hashlib.sha1(repr(value).encode('utf-8')).hexdigest()
+
+
+def _box(bb):
+    return (bb['ulx'], bb['uly'], bb['ncols'], bb['nrows'])
+
+
+def _glyph_inputs(glyph):
+    return (
+        glyph['name'], glyph['note'], glyph['staff'], glyph['offset'], glyph['strt_pos'],
+        glyph['octave'], _box(glyph['bounding_box']), glyph['system_begin'],
+    )
+
+
+def group_key(gs, syl_box, staves):
+    '''
+    A hash of everything encode_syllable reads when encoding the glyphs @gs under @syl_box, given
+    the page-wide settings are the same.
+    '''
+    syl = None if syl_box is None else (syl_box['syl'], list(syl_box['ul']), list(syl_box['lr']))
+    next_staves = [_box(staves[int(g['staff'])]['bounding_box']) for g in gs if g['system_begin']]
+    return _hash((syl, [_glyph_inputs(g) for g in gs], next_staves))
+
+
+def staff_hashes(glyphs):
+    '''
+    A hash of the glyphs on every staff, by staff number.
+    '''
+    staves = {}
+    for glyph in glyphs:
+        staves.setdefault(str(glyph['staff']), []).append(_glyph_inputs(glyph))
+    return dict((staff, _hash(inputs)) for staff, inputs in staves.items())
+
+
+def page_settings(context):
+    '''
+    Everything that affects the encoding of the whole page, which has to be the same for
+    anything to be reused.
+    '''
+    return {
+        'format': STATE_FORMAT,
+        'classifier': _hash(sorted(context.classifier.items())),
+        # lists rather than tuples, as they come back from the saved state
+        'aliases': [list(alias) for alias in sorted(context.classifier.aliases.items())],
+        'width_mult': context.width_mult,
+        'merge_distance': context.merge_distance() if context.width_mult > 0 else None,
+        'page': list(_box(context.page['bounding_box'])),
+    }
+
+
+def load_state(state_path, output_path):
+    '''
+    Returns the state saved by a previous run and the text of its MEI, or (None, None) if either
+    is missing or they don't belong together.
+    '''
+    if not (os.path.isfile(state_path) and os.path.isfile(output_path)):
+        return None, None
+    with io.open(state_path, 'r', encoding='utf-8') as f:
+        state = json.load(f)
+    # the offsets in the state count characters as they are in the file, so newlines are never
+    # translated, here or when the file is written
+    with io.open(output_path, 'r', encoding='utf-8', newline='') as f:
+        text = f.read()
+    if len(text) != state.get('length'):
+        return None, None
+    return state, text
+
+
+def encode_incremental(jsomr, syls, classifier, width_mult, output_path, state_path=None, logger=None):
+    '''
+    Encodes the page as process() would, into @output_path, reusing whatever it can from the
+    previous run on the same output (see the module documentation). Returns an IncrementalResult
+    with the number of syllable groups reused and encoded, the staves whose glyphs changed, and
+    the reason nothing could be reused, if that is the case.
+    '''
+    if state_path is None:
+        state_path = output_path + '.state.json'
+
+    syl_boxes = syls['syl_boxes'] if syls is not None else None
+    median_line_spacing = syls['median_line_spacing'] if syls is not None else None
+    classifier = pct.resolver(classifier)
+    glyphs = jsomr['glyphs']
+    if not isinstance(glyphs, GlyphTable):
+        glyphs = GlyphTable.from_jsomr(glyphs)
+    staves = jsomr['staves']
+
+    context = pipeline.EncodingContext(
+        glyphs, syl_boxes, median_line_spacing, classifier, staves, jsomr['page'], width_mult)
+    groups = list(pipeline.Pipeline().remove('encode').iter_groups(context))
+    settings = page_settings(context)
+    staff_hash = staff_hashes(glyphs)
+
+    state, previous_text = load_state(state_path, output_path)
+    reason = None
+    if state is None:
+        reason = 'no previous run'
+    elif state['settings'] != settings:
+        reason = 'page-wide settings changed'
+    if reason is not None:
+        previous = {}
+        changed_staves = sorted(staff_hash, key=int)
+    else:
+        previous = {}
+        for key, start, end, zone_ids in state['groups']:
+            previous.setdefault(key, []).append((previous_text[start:end], zone_ids))
+        changed_staves = sorted(
+            set(staff_hash.items()).symmetric_difference(state['staves'].items()), key=lambda s: int(s[0]))
+        changed_staves = sorted(set(staff for staff, _ in changed_staves), key=int)
+
+    # the initial system break is treated as a group of its own
+    keys = [_hash(('sb', _box(staves[0]['bounding_box'])))]
+    keys.extend(group_key(group.glyphs, group.syl_box, staves) for group in groups)
+    reuse = [previous[key].pop(0) if previous.get(key) else None for key in keys]
+
+    root, surface, layer = bm.generate_base_tree(StreamElement)
+    bm.set_surface_bounds(surface, context.page)
+
+    tmp_path = output_path + '.tmp'
+    try:
+        with io.open(tmp_path, 'w', encoding='utf-8', newline='') as out:
+            writer = StreamingMeiWriter(out, root, surface, layer)
+            context.zones = _RecordingZones(writer.surface, StreamElement)
+            context.element_cls = StreamElement
+
+            depth = writer.layer.depth
+            spans = []
+            for i, key in enumerate(keys):
+                if reuse[i] is not None:
+                    # the zones of a reused group keep their IDs, unless an earlier group that was
+                    # encoded again has since made a zone for the same bounding box
+                    text, zone_ids = reuse[i]
+                    for zone_id in zone_ids:
+                        ulx, uly, lrx, lry = state['zones'][zone_id]
+                        new_id = context.zones.register({'ulx': ulx, 'uly': uly, 'lrx': lrx, 'lry': lry}, zone_id)
+                        if new_id != zone_id:
+                            text = text.replace('facs="#{}"'.format(zone_id), 'facs="#{}"'.format(new_id))
+                else:
+                    if i == 0:
+                        els = [bm.create_system_break(staves[0], context.zones, StreamElement)]
+                    else:
+                        group = groups[i - 1]
+                        els = bm.encode_syllable(
+                            group.glyphs, group.syl_box, classifier, staves, context.zones,
+                            StreamElement, group.syllable_over, group.merger)
+                    text = ''.join(element_to_text(el, depth) for el in els)
+                start = writer.layer.written
+                writer.layer.add_serialized(text)
+                spans.append((key, start, writer.layer.written, context.zones.take_registered()))
+
+            writer.close()
+    except Exception:
+        if os.path.isfile(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    pct.replace_file(tmp_path, output_path)
+
+    new_state = {
+        'settings': settings,
+        'length': writer.length,
+        'staves': staff_hash,
+        'groups': [(key, writer.layer_start + start, writer.layer_start + end, zone_ids)
+                   for key, start, end, zone_ids in spans],
+        'zones': dict((zone_id, list(zone)) for zone_id, zone in context.zones.items()),
+    }
+    with io.open(state_path, 'w', encoding='utf-8') as f:
+        f.write(json.dumps(new_state, ensure_ascii=False))
+
+    reused = sum(1 for group in reuse if group is not None)
+    result = IncrementalResult(reused, len(reuse) - reused, changed_staves, reason)
+    if logger is not None:
+        logger.info('reused {} syllable groups, encoded {}; changed staves: {}{}'.format(
+            result.reused, result.encoded, ', '.join(changed_staves) or 'none',
+            '' if reason is None else ' ({}, encoded from scratch)'.format(reason)))
+        classifier.log_unknown(logger)
+    return result
@@ -0,0 +1,235 @@
+import json
+import time
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+
+import parse_classifier_table as pct
+import pipeline
+
+
+class EncodingMetrics(object):
+    '''
+    What was measured while encoding one page: the wall time (and, if memory was traced, the net
+    bytes allocated) of every stage, in the order they first ran, and counts of what was encoded.
+    In memory-bounded mode, @memory holds the peak RSS, and the RSS at the start and at every
+    staff (see memory_guard.MemoryGuard.report).
+    '''
+
+    def __init__(self):
+        self.stages = OrderedDict()
+        self.counts = OrderedDict()
+        self.unknown_names = Counter()
+        self.total_seconds = 0.0
+        self.memory = None
+
+    def add_stage(self, name, seconds, allocated=None):
+        stage = self.stages.setdefault(name, {'seconds': 0.0, 'allocated_bytes': None})
+        stage['seconds'] += seconds
+        if allocated is not None:
+            stage['allocated_bytes'] = (stage['allocated_bytes'] or 0) + allocated
+
+    def as_dict(self):
+        result = OrderedDict([
+            ('total_seconds', self.total_seconds),
+            ('stages', self.stages),
+            ('counts', self.counts),
+            ('unknown_names', OrderedDict(sorted(self.unknown_names.items()))),
+        ])
+        if self.memory is not None:
+            result['memory'] = self.memory
+        return result
+
+
+class Instrumentation(object):
+    '''
+    Measures a single call to build_mei_file.process, which takes one as its @instrumentation
+    argument. Every stage of the pipeline is timed separately (although stages run interleaved,
+    one syllable group at a time), as are the steps around it: compiling the classifier, reading
+    the glyphs, adding elements to the layer and serializing.
+
+    Once the page is done, the EncodingMetrics in self.metrics are passed to every one of
+    @callbacks, summarized to @logger (e.g. the MEI_encoding task logger) and, if @sidecar_path is
+    given, written there as JSON. With @trace_memory, tracemalloc is used to record how much each
+    stage allocates, which slows encoding down several times over, so it is only meant for
+    development (in memory-bounded mode, the peak RSS is reported without it); with @profile, the
+    whole call is run under cProfile, leaving the pstats.Stats in self.profile_stats (and dumped
+    to @profile_path, if given).
+    '''
+
+    def __init__(self, callbacks=(), logger=None, sidecar_path=None, trace_memory=False, profile=False,
+                 profile_path=None):
+        self.callbacks = list(callbacks)
+        self.logger = logger
+        self.sidecar_path = sidecar_path
+        self.trace_memory = trace_memory
+        self.profile = profile
+        self.profile_path = profile_path
+        self.metrics = EncodingMetrics()
+        self.profile_stats = None
+        self._inclusive = OrderedDict()
+        self._profiler = None
+        self._started_tracing = False
+        self._start = None
+        self._merger = None
+
+    def add_callback(self, callback):
+        self.callbacks.append(callback)
+
+    def _memory(self):
+        if not self.trace_memory:
+            return None
+        import tracemalloc
+        return tracemalloc.get_traced_memory()[0]
+
+    def start(self):
+        if self.trace_memory:
+            import tracemalloc
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self._started_tracing = True
+        if self.profile:
+            import cProfile
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        self._start = time.time()
+
+    @contextmanager
+    def measure(self, name):
+        '''
+        Records the time taken (and memory allocated) by the body of the with statement as stage
+        @name.
+        '''
+        memory = self._memory()
+        start = time.time()
+        yield
+        allocated = self._memory() - memory if memory is not None else None
+        self.metrics.add_stage(name, time.time() - start, allocated)
+
+    def _timed(self, name, stage):
+        # times every step of the stage's generator, which includes the time spent in the stages
+        # before it; these are subtracted once the page is done
+        totals = self._inclusive.setdefault(name, [0.0, None])
+
+        def timed_stage(groups, context):
+            groups = stage(groups, context)
+            while True:
+                memory = self._memory()
+                start = time.time()
+                try:
+                    group = next(groups)
+                except StopIteration:
+                    group = None
+                totals[0] += time.time() - start
+                if memory is not None:
+                    totals[1] = (totals[1] or 0) + self._memory() - memory
+                if group is None:
+                    return
+                yield group
+        return timed_stage
+
+    def _count(self, groups, context):
+        counts = self.metrics.counts
+        for group in groups:
+            if group.syllable is not None:
+                counts['syllables'] += 1
+            if group.merger is not None:
+                self._merger = group.merger
+            yield group
+
+    def _reset_counts(self):
+        for name in ('glyphs', 'syllables', 'orphan_glyphs', 'zones', 'unknown_glyphs', 'neumes_merged'):
+            self.metrics.counts[name] = 0
+
+    def wrap(self, stages):
+        '''
+        Returns a copy of the pipeline @stages with every stage timed, followed by a stage that
+        counts what comes out of it.
+        '''
+        self._reset_counts()
+        wrapped = pipeline.Pipeline([(name, self._timed(name, stage)) for name, stage in stages.stages])
+        return wrapped.append('count', self._count)
+
+    def run(self, stages, context, layer):
+        '''
+        Runs the pipeline @stages as Pipeline.run does, timing each stage and the adding of
+        elements to @layer separately.
+        '''
+        memory = self._memory()
+        start = time.time()
+        self.wrap(stages).run(context, layer)
+        seconds = time.time() - start
+        allocated = self._memory() - memory if memory is not None else None
+
+        # each stage's totals include those of the stages before it
+        upstream_seconds, upstream_allocated = 0.0, 0
+        for name, (seconds_in, allocated_in) in self._inclusive.items():
+            own_allocated = None if allocated_in is None else allocated_in - upstream_allocated
+            self.metrics.add_stage(name, seconds_in - upstream_seconds, own_allocated)
+            upstream_seconds, upstream_allocated = seconds_in, allocated_in or 0
+
+        own_allocated = None if allocated is None else allocated - upstream_allocated
+        self.metrics.add_stage('layer', seconds - upstream_seconds, own_allocated)
+
+    def add_metrics(self, metrics):
+        '''
+        Adds the EncodingMetrics of part of the page, measured separately (e.g. by a worker
+        process, see staff_parallel.py), to this page's: the time of every stage, and the
+        syllables and merged neumes counted.
+        '''
+        if not self.metrics.counts:
+            self._reset_counts()
+        for name, stage in metrics.stages.items():
+            self.metrics.add_stage(name, stage['seconds'], stage['allocated_bytes'])
+        for name in ('syllables', 'neumes_merged'):
+            self.metrics.counts[name] += metrics.counts.get(name, 0)
+
+    def finish(self, context):
+        '''
+        Fills in the counts, and the glyph names the classifier of the finished @context couldn't
+        resolve, then reports the metrics.
+        '''
+        self.metrics.total_seconds = time.time() - self._start
+        if self._profiler is not None:
+            import pstats
+            self._profiler.disable()
+            self.profile_stats = pstats.Stats(self._profiler)
+            if self.profile_path is not None:
+                self.profile_stats.dump_stats(self.profile_path)
+        if self._started_tracing:
+            import tracemalloc
+            tracemalloc.stop()
+
+        if not self.metrics.counts:
+            self._reset_counts()
+        counts = self.metrics.counts
+        counts['glyphs'] = len(context.glyphs) if context.glyphs is not None else 0
+        counts['orphan_glyphs'] = context.orphan_glyphs
+        counts['zones'] = len(context.zones)
+        if isinstance(context.classifier, pct.ClassifierResolver):
+            self.metrics.unknown_names = Counter(context.classifier.unknown)
+        counts['unknown_glyphs'] = sum(self.metrics.unknown_names.values())
+        if self._merger is not None:
+            counts['neumes_merged'] = self._merger.merged
+
+        if self.logger is not None:
+            self.log(self.logger)
+        if self.sidecar_path is not None:
+            with open(self.sidecar_path, 'w') as f:
+                json.dump(self.metrics.as_dict(), f, indent=2)
+        for callback in self.callbacks:
+            callback(self.metrics)
+
+    def log(self, logger):
+        metrics = self.metrics
+        logger.info('encoded page in {:.3f}s: {}'.format(
+            metrics.total_seconds, ', '.join('{} {}'.format(v, k) for k, v in metrics.counts.items())))
+        for name, stage in metrics.stages.items():
+            allocated = stage['allocated_bytes']
+            logger.info('  {:<12} {:>9.2f}ms{}'.format(
+                name, stage['seconds'] * 1000,
+                '' if allocated is None else ' {:>12,d} bytes'.format(allocated)))
+        if metrics.memory is not None and metrics.memory['peak_rss_bytes'] is not None:
+            limit = metrics.memory['limit_bytes']
+            logger.info('  peak RSS {:.1f}MB, {:.1f}MB at the start{}'.format(
+                metrics.memory['peak_rss_bytes'] / 1e6, (metrics.memory['baseline_rss_bytes'] or 0) / 1e6,
+                '' if limit is None else ' (limit {:.1f}MB more)'.format(limit / 1e6)))
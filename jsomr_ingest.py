@@ -0,0 +1,205 @@
+'''
+Reads JSOMR and text alignment files keeping only what the encoder uses, instead of loading the
+whole JSON document with json.loads(file.read()) and converting it afterwards.
+
+With the default 'stream' backend, a file is read in chunks and decoded one value at a time: each
+glyph is decoded, reduced to a GlyphTable row and dropped before the next one is read, and fields
+the encoder never looks at are skipped. The 'orjson' backend loads the whole document with orjson
+(when it is installed), which is faster but needs the whole document in memory at once; 'auto'
+picks it for files up to ORJSON_MAX_SIZE bytes and streams anything larger.
+'''
+import io
+import json
+import os
+import re
+
+from glyph_table import GlyphTable, jsomr_row
+
+CHUNK_SIZE = 64 * 1024
+ORJSON_MAX_SIZE = 32 * 1024 * 1024
+
+_decoder = json.JSONDecoder()
+_WHITESPACE = ' \t\n\r'
+# what is left of the buffer after a value, when it could be the rest of a number cut short by it
+_NUMBER_TAIL = re.compile(r'[0-9.eE+-]*\Z')
+
+
+class _Reader(object):
+    '''
+    A cursor over a JSON text file that decodes one value at a time, keeping only the part of the
+    file that hasn't been decoded yet in memory.
+    '''
+
+    def __init__(self, f, chunk_size=CHUNK_SIZE):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self):
+        # reads at least as much again as is buffered, so that a value spanning many chunks is
+        # only retried a logarithmic number of times
+        data = self.f.read(max(self.chunk_size, len(self.buf) - self.pos))
+        self.buf = self.buf[self.pos:] + data
+        self.pos = 0
+        if not data:
+            self.eof = True
+        return bool(data)
+
+    def peek(self):
+        '''
+        Skips whitespace and returns the next character, or '' at the end of the file.
+        '''
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in _WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                return ''
+
+    def expect(self, chars):
+        '''
+        Consumes the next character, which has to be one of @chars, and returns it.
+        '''
+        c = self.peek()
+        if not c or c not in chars:
+            raise ValueError('expected one of {!r} but found {!r}'.format(chars, c or 'end of file'))
+        self.pos += 1
+        return c
+
+    def value(self):
+        '''
+        Decodes and consumes the next complete JSON value.
+        '''
+        self.peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.buf, self.pos)
+            except ValueError:
+                if not self._fill():
+                    raise
+                continue
+            # a number at the end of the buffer might carry on in the next chunk, even past what
+            # was decoded of it (as in "12." or "1e")
+            if not self.eof and _NUMBER_TAIL.match(self.buf, end) and self._fill():
+                continue
+            self.pos = end
+            return value
+
+    def object_keys(self):
+        '''
+        Iterates over the keys of the object that comes next. After each key, the caller has to
+        consume its value (with value(), array_items(), ...) before asking for the next one.
+        '''
+        self.expect('{')
+        if self.peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            self.expect(':')
+            yield key
+            if self.expect(',}') == '}':
+                return
+
+    def array_items(self):
+        '''
+        Iterates over the decoded items of the array that comes next.
+        '''
+        self.expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield self.value()
+            if self.expect(',]') == ']':
+                return
+
+
+def _bounding_box_only(entry):
+    return {'bounding_box': entry['bounding_box']}
+
+
+def _syl_box(box):
+    return {'syl': box['syl'], 'ul': box['ul'], 'lr': box['lr']}
+
+
+def _choose_backend(fname, backend):
+    if backend == 'auto':
+        try:
+            import orjson
+        except ImportError:
+            return 'stream'
+        return 'orjson' if os.path.getsize(fname) <= ORJSON_MAX_SIZE else 'stream'
+    if backend not in ('stream', 'orjson'):
+        raise ValueError('unknown JSON backend {}'.format(backend))
+    return backend
+
+
+def _load_orjson(fname):
+    import orjson
+    with open(fname, 'rb') as f:
+        return orjson.loads(f.read())
+
+
+def load_jsomr(fname, backend='auto'):
+    '''
+    Reads the JSOMR file @fname into a dict with the 'glyphs' as a GlyphTable, and the 'staves'
+    and 'page' reduced to their bounding boxes, ready to be passed to build_mei_file.process.
+    '''
+    strings = {}
+    if _choose_backend(fname, backend) == 'orjson':
+        jsomr = _load_orjson(fname)
+        return {
+            'glyphs': GlyphTable.from_rows([jsomr_row(g, strings) for g in jsomr['glyphs']]),
+            'staves': [_bounding_box_only(s) for s in jsomr['staves']],
+            'page': _bounding_box_only(jsomr['page']),
+        }
+
+    result = {'glyphs': None, 'staves': None, 'page': None}
+    with io.open(fname, 'r', encoding='utf-8') as f:
+        reader = _Reader(f)
+        for key in reader.object_keys():
+            if key == 'glyphs':
+                result['glyphs'] = GlyphTable.from_rows([jsomr_row(g, strings) for g in reader.array_items()])
+            elif key == 'staves':
+                result['staves'] = [_bounding_box_only(s) for s in reader.array_items()]
+            elif key == 'page':
+                result['page'] = _bounding_box_only(reader.value())
+            else:
+                reader.value()
+
+    for key, value in result.items():
+        if value is None:
+            raise ValueError('{} has no {}'.format(fname, key))
+    return result
+
+
+def load_alignment(fname, backend='auto'):
+    '''
+    Reads the text alignment results in @fname, keeping only the text and corners of every
+    syllable box and the median line spacing.
+    '''
+    if _choose_backend(fname, backend) == 'orjson':
+        syls = _load_orjson(fname)
+        return {
+            'syl_boxes': [_syl_box(b) for b in syls['syl_boxes']],
+            'median_line_spacing': syls['median_line_spacing'],
+        }
+
+    result = {'syl_boxes': None, 'median_line_spacing': None}
+    with io.open(fname, 'r', encoding='utf-8') as f:
+        reader = _Reader(f)
+        for key in reader.object_keys():
+            if key == 'syl_boxes':
+                result['syl_boxes'] = [_syl_box(b) for b in reader.array_items()]
+            elif key == 'median_line_spacing':
+                result['median_line_spacing'] = reader.value()
+            else:
+                reader.value()
+
+    if result['syl_boxes'] is None:
+        raise ValueError('{} has no syl_boxes'.format(fname))
+    return result
@@ -0,0 +1,191 @@
+'''
+Checks the structural invariants the encoder is supposed to guarantee, in a single pass over a
+document, instead of a separate RelaxNG validation of every output file:
+    - every @facs refers to a zone in the document,
+    - no custos is inside an <sb>,
+    - every <nc> has a @pname and an @oct,
+    - every <syllable> has a <syl>,
+    - no <neume> is left without any <nc> (e.g. after merging).
+
+A StructureValidator only ever looks at one element at a time, fed to it as start/end events,
+and keeps nothing but the IDs of the zones and the elements still open, so it is cheap enough to
+leave on. It can be attached to the streaming writer (see build_mei_file.process), run over a
+pymei document, or run over an MEI file:
+    python mei_validator.py output.mei [more.mei ...]
+'''
+import sys
+from collections import namedtuple
+
+MEI_NS = '{http://www.music-encoding.org/ns/mei}'
+XML_ID = '{http://www.w3.org/XML/1998/namespace}id'
+
+# how many violations are kept per document; any more are only counted
+MAX_VIOLATIONS = 100
+
+# @rule is one of the names below, @element the xml:id of the offending element
+Violation = namedtuple('Violation', ['rule', 'element', 'message'])
+
+UNRESOLVED_FACS = 'unresolved-facs'
+CUSTOS_IN_SB = 'custos-in-sb'
+UNPITCHED_NC = 'unpitched-nc'
+SYLLABLE_WITHOUT_SYL = 'syllable-without-syl'
+EMPTY_NEUME = 'empty-neume'
+
+
+class StructureValidator(object):
+    '''
+    Collects the Violations of the invariants listed in the module documentation in
+    @violations (at most @max_violations of them; @count has the total), given the elements of a
+    document in order as start() and end() events, followed by a call to finish().
+    '''
+
+    def __init__(self, max_violations=MAX_VIOLATIONS):
+        self.max_violations = max_violations
+        self.violations = []
+        self.count = 0
+        self.zones = set()
+        self._unresolved = []
+        # one [name, xml:id, has a <syl>, number of <nc>s] entry per open element
+        self._open = []
+        self._sb_depth = 0
+
+    def add(self, rule, element, message):
+        '''
+        Records a violation of @rule by the element with the xml:id @element, e.g. one found by
+        another validator on part of the same document.
+        '''
+        self.count += 1
+        if len(self.violations) < self.max_violations:
+            self.violations.append(Violation(rule, element, message))
+
+    def start(self, name, element_id, attribs):
+        '''
+        An element @name with the given xml:id and (name -> value) @attribs starts.
+        '''
+        self._start(name, element_id, attribs.get('facs'), attribs.get('pname'), attribs.get('oct'))
+
+    def _start(self, name, element_id, facs, pname, octave):
+        if self._open:
+            parent = self._open[-1]
+            if name == 'syl' and parent[0] == 'syllable':
+                parent[2] = True
+            elif name == 'nc' and parent[0] == 'neume':
+                parent[3] += 1
+
+        if name == 'zone':
+            self.zones.add(element_id)
+        elif name == 'nc' and not (pname and octave):
+            self.add(UNPITCHED_NC, element_id, 'nc has no pname or oct')
+        elif name == 'custos' and self._sb_depth:
+            self.add(CUSTOS_IN_SB, element_id, 'custos inside an sb')
+        elif name == 'sb':
+            self._sb_depth += 1
+
+        if facs is not None and facs[1:] not in self.zones:
+            # zones normally come first, but the surface could be anywhere
+            self._unresolved.append((element_id, facs))
+
+        self._open.append([name, element_id, False, 0])
+
+    def end(self):
+        '''
+        The element started last ends.
+        '''
+        name, element_id, has_syl, ncs = self._open.pop()
+        if name == 'syllable' and not has_syl:
+            self.add(SYLLABLE_WITHOUT_SYL, element_id, 'syllable has no syl')
+        elif name == 'neume' and not ncs:
+            self.add(EMPTY_NEUME, element_id, 'neume has no nc')
+        elif name == 'sb':
+            self._sb_depth -= 1
+
+    def element(self, el):
+        '''
+        Feeds a whole MeiElement or StreamElement @el and its descendants to the validator.
+        '''
+        facs = pname = octave = None
+        for attribute in el.attributes:
+            if attribute.name == 'facs':
+                facs = attribute.value
+            elif attribute.name == 'pname':
+                pname = attribute.value
+            elif attribute.name == 'oct':
+                octave = attribute.value
+        self._start(el.name, el.id, facs, pname, octave)
+        for child in el.children:
+            self.element(child)
+        self.end()
+
+    def finish(self):
+        '''
+        Checks what can only be checked once the whole document has been seen, and returns the
+        violations.
+        '''
+        for element_id, facs in self._unresolved:
+            if facs[1:] not in self.zones:
+                self.add(UNRESOLVED_FACS, element_id, 'facs {} is not a zone'.format(facs))
+        self._unresolved = []
+        return self.violations
+
+    def report(self):
+        '''
+        Returns the violations as text, one per line, or an empty string if there are none.
+        '''
+        lines = ['{}: {} ({})'.format(v.element, v.message, v.rule) for v in self.violations]
+        if self.count > len(self.violations):
+            lines.append('... and {} more'.format(self.count - len(self.violations)))
+        return '\n'.join(lines)
+
+
+def validate_document(meiDoc, max_violations=MAX_VIOLATIONS):
+    '''
+    Validates a pymei document, returning the StructureValidator with its violations.
+    '''
+    validator = StructureValidator(max_violations)
+    validator.element(meiDoc.getRootElement())
+    validator.finish()
+    return validator
+
+
+def validate_file(fname, max_violations=MAX_VIOLATIONS):
+    '''
+    Validates the MEI file @fname one element at a time, without building a document, returning
+    the StructureValidator with its violations.
+    '''
+    import xml.etree.ElementTree as ET
+
+    validator = StructureValidator(max_violations)
+    depth = 0
+    for event, el in ET.iterparse(fname, ('start', 'end')):
+        if event == 'start':
+            depth += 1
+            name = el.tag[len(MEI_NS):] if el.tag.startswith(MEI_NS) else el.tag
+            validator.start(name, el.get(XML_ID), el.attrib)
+        else:
+            depth -= 1
+            validator.end()
+            # keep the tree from growing; only the root has to stay for iterparse
+            if depth:
+                el.clear()
+    validator.finish()
+    return validator
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv:
+        print(__doc__)
+        return 1
+    failed = 0
+    for fname in argv:
+        validator = validate_file(fname)
+        if validator.count:
+            failed += 1
+            print('{}: {} violations\n{}'.format(fname, validator.count, validator.report()))
+        else:
+            print('{}: ok'.format(fname))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
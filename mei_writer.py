@@ -0,0 +1,352 @@
+import gzip
+import io
+import shutil
+import tempfile
+import uuid
+from collections import OrderedDict, namedtuple
+
+MEI_NS = 'http://www.music-encoding.org/ns/mei'
+XML_DECLARATION = '<?xml version="1.0" encoding="UTF-8"?>\n'
+
+# layer content is buffered in memory up to this many characters before spilling to disk
+SPOOL_SIZE = 8 * 1024 * 1024
+
+
+# how an MEI file is written out: with short sequential IDs instead of random ones, without
+# indentation and line breaks, and/or gzip-compressed
+OutputFormat = namedtuple('OutputFormat', ['compact_ids', 'minify', 'gzip'])
+
+OUTPUT_FORMATS = OrderedDict([
+    ('standard', OutputFormat(False, False, False)),
+    ('compact', OutputFormat(True, False, False)),
+    ('minified', OutputFormat(True, True, False)),
+    ('gzip', OutputFormat(True, True, True)),
+])
+
+# prefixes of the compact IDs of the elements the encoder creates most; any other element's ID
+# starts with its name
+ID_PREFIXES = {
+    'zone': 'z',
+    'syllable': 's',
+    'syl': 'sy',
+    'neume': 'n',
+    'nc': 'nc',
+    'sb': 'sb',
+    'clef': 'c',
+    'custos': 'cu',
+    'divLine': 'd',
+    'accid': 'a',
+}
+
+
+def generate_id():
+    '''
+    Returns a new element ID in the same form as the ones libmei generates.
+    '''
+    return 'm-' + str(uuid.uuid4())
+
+
+def get_output_format(name):
+    '''
+    Returns the OutputFormat called @name (one of OUTPUT_FORMATS), or the standard one for None.
+    '''
+    if name is None:
+        return OUTPUT_FORMATS['standard']
+    try:
+        return OUTPUT_FORMATS[name]
+    except KeyError:
+        raise ValueError('unknown output format {} (expected one of {})'.format(
+            name, ', '.join(OUTPUT_FORMATS)))
+
+
+class _GzipOutput(gzip.GzipFile):
+    '''
+    A GzipFile writing to @path that leaves the file name and modification time out of its
+    header, so that compressing the same text twice gives the same bytes.
+    '''
+
+    def __init__(self, path):
+        self._raw = open(path, 'wb')
+        gzip.GzipFile.__init__(self, filename='', mode='wb', fileobj=self._raw, mtime=0)
+
+    def close(self):
+        try:
+            gzip.GzipFile.close(self)
+        finally:
+            self._raw.close()
+
+
+def open_output(path, fmt):
+    '''
+    Opens @path for writing MEI text in the OutputFormat @fmt.
+    '''
+    if fmt.gzip:
+        return io.TextIOWrapper(_GzipOutput(path), encoding='utf-8')
+    return io.open(path, 'w', encoding='utf-8')
+
+
+class SequentialIds(object):
+    '''
+    Creates @element_cls elements (passed where the encoder takes an element class) with short
+    IDs numbered in the order they are created: z1, nc2, n3, ... (see ID_PREFIXES). Unlike the
+    random IDs libmei generates, these are the same every time a page is encoded.
+    '''
+
+    def __init__(self, element_cls):
+        self.element_cls = element_cls
+        self.count = 0
+
+    def __call__(self, name):
+        el = self.element_cls(name)
+        el.setId(self.next_id(name))
+        return el
+
+    def next_id(self, name):
+        '''
+        Returns the ID the next element created would get if it were called @name, as if it had
+        been created.
+        '''
+        self.count += 1
+        return '{}{}'.format(ID_PREFIXES.get(name, name), self.count)
+
+
+class StreamAttribute(object):
+    __slots__ = ('name', 'value')
+
+    def __init__(self, name, value):
+        self.name = name
+        self.value = value
+
+
+class StreamElement(object):
+    '''
+    A lightweight stand-in for pymei's MeiElement, implementing the part of its interface used by
+    build_mei_file, so the same encoding code can build elements for the streaming writer. Unlike
+    MeiElement, these are only kept around until they are written out. An @id can be given up
+    front, instead of a new random one.
+    '''
+    __slots__ = ('name', 'id', 'attributes', 'children', 'value')
+
+    def __init__(self, name, id=None):
+        self.name = name
+        self.id = id if id is not None else generate_id()
+        self.attributes = []
+        self.children = []
+        self.value = ''
+
+    def getId(self):
+        return self.id
+
+    def setId(self, id):
+        self.id = id
+
+    def addAttribute(self, name, value):
+        for attribute in self.attributes:
+            if attribute.name == name:
+                attribute.value = value
+                return
+        self.attributes.append(StreamAttribute(name, value))
+
+    def getAttribute(self, name):
+        for attribute in self.attributes:
+            if attribute.name == name:
+                return attribute
+        return None
+
+    def hasAttribute(self, name):
+        return self.getAttribute(name) is not None
+
+    def removeAttribute(self, name):
+        self.attributes = [a for a in self.attributes if a.name != name]
+
+    def addChild(self, child):
+        self.children.append(child)
+
+    def removeChild(self, child):
+        self.children.remove(child)
+
+    def setChildren(self, children):
+        self.children = list(children)
+
+    def getChildren(self):
+        return list(self.children)
+
+    def getChildrenByName(self, name):
+        return [c for c in self.children if c.name == name]
+
+    def setValue(self, value):
+        self.value = value
+
+    def getValue(self):
+        return self.value
+
+
+def _escape_text(text):
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;').replace('\r', '&#13;')
+
+
+def _escape_attribute(value):
+    return (
+        _escape_text(value).replace('"', '&quot;')
+        .replace('\n', '&#10;').replace('\t', '&#9;')
+    )
+
+
+def _start_tag(el, namespace=None, close=False):
+    attribs = [('xml:id', el.id)] + [(a.name, a.value) for a in el.attributes]
+    if namespace:
+        attribs.insert(0, ('xmlns', namespace))
+    text = ''.join(' {}="{}"'.format(name, _escape_attribute(value)) for name, value in attribs)
+    return '<{}{}{}>'.format(el.name, text, '/' if close else '')
+
+
+def _layout(depth, minify):
+    # the indentation and line ending of an element at @depth
+    if minify:
+        return '', ''
+    return '  ' * depth, '\n'
+
+
+def element_to_text(el, depth=0, minify=False):
+    '''
+    Serializes @el and its descendants the way libmei's documentToText does (libxml2's formatted
+    output): two spaces of indentation per level, xml:id first, empty elements self-closed. With
+    @minify, the indentation and line breaks are left out.
+    '''
+    indent, newline = _layout(depth, minify)
+    if el.children:
+        inner = ''.join(element_to_text(c, depth + 1, minify) for c in el.children)
+        return '{}{}{}{}{}</{}>{}'.format(indent, _start_tag(el), newline, inner, indent, el.name, newline)
+    if el.value:
+        return '{}{}{}</{}>{}'.format(indent, _start_tag(el), _escape_text(el.value), el.name, newline)
+    return '{}{}{}'.format(indent, _start_tag(el, close=True), newline)
+
+
+def element_tag_lines(el, depth=0, minify=False):
+    '''
+    Returns the lines that element_to_text puts before and after the children of @el, for
+    serializing its children separately.
+    '''
+    indent, newline = _layout(depth, minify)
+    return '{}{}{}'.format(indent, _start_tag(el), newline), '{}</{}>{}'.format(indent, el.name, newline)
+
+
+class _PendingParent(object):
+    '''
+    Stands in for an element whose children are written out one by one. Each child is held until
+    the next one is added (the encoder may still be filling it in, e.g. adding attributes), then
+    passed to @on_child and written to @out at the given depth (or minified, with @minify).
+    @written counts the characters written so far.
+    '''
+
+    def __init__(self, out, depth, on_child=None, before_flush=None, minify=False):
+        self.out = out
+        self.depth = depth
+        self.minify = minify
+        self.on_child = on_child
+        self.before_flush = before_flush
+        self.pending = None
+        self.written = 0
+
+    def addChild(self, el):
+        self.flush()
+        self.pending = el
+
+    def flush(self):
+        if self.pending is None:
+            return
+        if self.before_flush is not None:
+            self.before_flush()
+        if self.on_child is not None:
+            self.on_child(self.pending)
+        self._write(element_to_text(self.pending, self.depth, self.minify))
+        self.pending = None
+
+    def add_serialized(self, text):
+        '''
+        Writes children that are already serialized (at this parent's depth) as they are.
+        '''
+        self.flush()
+        if self.before_flush is not None:
+            self.before_flush()
+        self._write(text)
+
+    def _write(self, text):
+        self.out.write(text)
+        self.written += len(text)
+
+
+class StreamingMeiWriter(object):
+    '''
+    Writes an MEI document to the file-like object @out incrementally, instead of building it as
+    a pymei tree and converting it to a string at the end.
+
+    @root is the document skeleton (see build_mei_file.generate_base_tree), built from
+    StreamElements, with @surface and @layer being two of its (empty) descendants. The skeleton up
+    to <surface> is written immediately; after that, zones added to self.surface are written as
+    they arrive, while children added to self.layer are buffered (in memory, spilling to a
+    temporary file past SPOOL_SIZE) until close() writes the rest of the document around them.
+
+    @on_zone is called with every zone as it is written, and @on_layer_child with every child of
+    the layer just before it is written, which is the last chance to modify it. With @minify, the
+    whole document is written without indentation or line breaks.
+    '''
+
+    def __init__(self, out, root, surface, layer, on_zone=None, on_layer_child=None, minify=False):
+        self.out = out
+        self.minify = minify
+        self.layer_buffer = tempfile.SpooledTemporaryFile(
+            max_size=SPOOL_SIZE, mode='w+', encoding='utf-8', newline='')
+
+        # pre-render the skeleton around the two insertion points
+        self._segments = []
+        self._depths = {}
+        self._current = []
+        self._render(root, 0, (surface, layer))
+        self._segments.append(''.join(self._current))
+
+        head, self._middle, self._tail = self._segments
+        declaration = XML_DECLARATION.rstrip('\n') if minify else XML_DECLARATION
+        self._head_length = len(declaration) + len(head)
+
+        # zones go straight to the output; layer content can only follow once the surface is
+        # closed, so it is buffered. the surface is flushed before every layer child so that all
+        # zones referenced by it have been seen by on_zone.
+        self.surface = _PendingParent(out, self._depths[id(surface)] + 1, on_zone, minify=minify)
+        self.layer = _PendingParent(
+            self.layer_buffer, self._depths[id(layer)] + 1, on_layer_child, self.surface.flush, minify)
+
+        self.out.write(declaration)
+        self.out.write(head)
+
+    def _render(self, el, depth, insertion_points):
+        indent, newline = _layout(depth, self.minify)
+        namespace = MEI_NS if depth == 0 else None
+        if el in insertion_points:
+            self._depths[id(el)] = depth
+            self._current.append('{}{}{}'.format(indent, _start_tag(el, namespace), newline))
+            self._segments.append(''.join(self._current))
+            self._current = ['{}</{}>{}'.format(indent, el.name, newline)]
+        elif el.children:
+            self._current.append('{}{}{}'.format(indent, _start_tag(el, namespace), newline))
+            for c in el.children:
+                self._render(c, depth + 1, insertion_points)
+            self._current.append('{}</{}>{}'.format(indent, el.name, newline))
+        else:
+            self._current.append(element_to_text(el, depth, self.minify))
+
+    def close(self):
+        '''
+        Writes out the remaining layer content and the end of the document. Afterwards,
+        self.layer_start is the (character) offset in the output at which the layer's content
+        starts, and self.length the length of the whole output.
+        '''
+        self.layer.flush()
+        self.surface.flush()
+        self.layer_start = self._head_length + self.surface.written + len(self._middle)
+        self.length = self.layer_start + self.layer.written + len(self._tail)
+        self.out.write(self._middle)
+        self.layer_buffer.seek(0)
+        shutil.copyfileobj(self.layer_buffer, self.out)
+        self.layer_buffer.close()
+        self.out.write(self._tail)
@@ -0,0 +1,122 @@
+'''
+Memory-bounded encoding: keeps track of how much memory encoding a page takes, staff by staff,
+and stops with a MemoryLimitExceeded error once it goes over a given ceiling, rather than
+carrying on until the worker is killed for running out of memory.
+
+In memory-bounded mode (build_mei_file.process with a @memory_limit), the MEI is always streamed
+to its output file: each syllable is written out as soon as the next one is encoded, so the only
+things held for the whole page are the compact GlyphTable, the syllable boxes and the zone
+geometry. A MemoryGuard stage at the end of the pipeline samples the resident set size (RSS) of
+the process every time a new staff starts, and every CHECK_EVERY syllable groups within a staff,
+so the peak and the RSS at every staff can be reported (see
+instrumentation.EncodingMetrics.memory).
+
+The limit is a soft one, on how much the RSS has grown since encoding started, so whatever the
+process held before (e.g. a Celery worker's own modules, or the JSOMR already loaded) doesn't
+count against it. Since the RSS is only sampled between syllable groups, encoding can go over the
+limit by as much as CHECK_EVERY groups take before it is stopped.
+'''
+import os
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# number of syllable groups encoded between two samples of the RSS within a staff
+CHECK_EVERY = 64
+
+
+class MemoryLimitExceeded(MemoryError):
+    '''
+    Raised when the process goes over the memory ceiling of a MemoryGuard.
+    '''
+
+
+def current_rss():
+    '''
+    Returns the resident set size of this process in bytes, or None if it can't be measured here.
+    Where /proc isn't available, the peak RSS so far is returned instead.
+    '''
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, IndexError):
+        return peak_rss()
+
+
+def peak_rss():
+    '''
+    Returns the highest resident set size this process has reached in bytes, or None if it can't
+    be measured here.
+    '''
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes everywhere but on macOS
+    return peak if os.uname()[0] == 'Darwin' else peak * 1024
+
+
+class MemoryGuard(object):
+    '''
+    Samples the RSS of the process at every staff, every CHECK_EVERY syllable groups and whenever
+    check() is called, keeping the highest value seen in @peak and the value at the start of every
+    staff in @staves, and raises MemoryLimitExceeded as soon as it is more than @limit bytes (if
+    given) above the @baseline sampled when the guard was created.
+    '''
+
+    def __init__(self, limit=None):
+        self.limit = limit
+        self.baseline = current_rss()
+        self.peak = self.baseline
+        self.staves = []
+        self._staff = None
+
+    def check(self, where):
+        '''
+        Samples the RSS, raising MemoryLimitExceeded if it has grown by more than the limit.
+        @where describes what is being done, for the error message.
+        '''
+        rss = current_rss()
+        if rss is None:
+            return None
+        if self.peak is None or rss > self.peak:
+            self.peak = rss
+        growth = rss - (self.baseline or 0)
+        if self.limit is not None and growth > self.limit:
+            raise MemoryLimitExceeded(
+                '{:.1f}MB more in use at {} than when encoding started, over the limit of {:.1f}MB'.format(
+                    growth / 1e6, where, self.limit / 1e6))
+        return rss
+
+    def stage(self, groups, context):
+        '''
+        Pipeline stage that checks the memory used every time a group starts a new staff, and
+        every CHECK_EVERY groups in between.
+        '''
+        self.check('the start of the page')
+        since_check = 0
+        for group in groups:
+            if len(group.glyphs) and str(group.glyphs[0]['staff']) != self._staff:
+                self._staff = str(group.glyphs[0]['staff'])
+                self.staves.append((self._staff, self.check('staff {}'.format(self._staff))))
+                since_check = 0
+            elif since_check >= CHECK_EVERY:
+                self.check('staff {}'.format(self._staff))
+                since_check = 0
+            since_check += 1
+            yield group
+
+    def report(self):
+        '''
+        Returns what was measured: the limit, the RSS when encoding started, the highest RSS
+        sampled while encoding and the highest ever reached by the process, and the RSS at the
+        start of every staff.
+        '''
+        return {
+            'limit_bytes': self.limit,
+            'baseline_rss_bytes': self.baseline,
+            'peak_rss_bytes': self.peak,
+            'process_peak_rss_bytes': peak_rss(),
+            'staves': [{'staff': staff, 'rss_bytes': rss} for staff, rss in self.staves],
+        }
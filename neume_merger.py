@@ -0,0 +1,47 @@
+class NeumeMerger(object):
+    '''
+    Merges nearby neume components while syllables are being built, instead of reworking the
+    finished document as merge_nearby_neume_components does.
+
+    Every child of a syllable is added through add(), along with the bounding box of the glyph it
+    came from (all the components of a neume share it). A neume that follows another neume with a
+    gap of at most @max_distance between them is not added to the syllable at all: its neume
+    components go straight into the first neume of the run. This is one left-to-right sweep per
+    syllable, giving the same result as merge_nearby_neume_components with the same distance.
+    '''
+
+    def __init__(self, max_distance):
+        self.max_distance = max_distance
+        self.merged = 0
+        self._syllable = None
+        self._target = None
+        self._prev_lrx = None
+
+    def begin(self, syllable):
+        '''
+        Starts the sweep over a new @syllable element.
+        '''
+        self._syllable = syllable
+        self._target = None
+        self._prev_lrx = None
+
+    def add(self, el, bb=None):
+        '''
+        Adds @el to the current syllable, or merges its neume components into the previous neume
+        if it is a neume close enough to it. @bb is the bounding box of the glyph @el came from.
+        '''
+        if el.name != 'neume' or bb is None:
+            self._syllable.addChild(el)
+            self._prev_lrx = None
+            return
+
+        if self._prev_lrx is not None and bb['ulx'] - self._prev_lrx <= self.max_distance:
+            for nc in el.getChildren():
+                self._target.addChild(nc)
+            self.merged += 1
+        else:
+            self._syllable.addChild(el)
+            self._target = el
+
+        # the next neume is compared against this one's own extent, not the whole merged run's
+        self._prev_lrx = bb['lrx']
@@ -1,6 +1,39 @@
-import numpy as np
-import xml.etree.ElementTree as ET
 import csv
+import hashlib
+import logging
+import os
+import pickle
+import tempfile
+from collections import Counter, namedtuple, OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# compiled classifiers are cached on disk here, keyed by the hash of the csv's contents. bump
+# CACHE_FORMAT whenever the compiled form changes so that stale entries are ignored.
+CACHE_DIR = os.environ.get(
+    'MEI_ENCODING_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'mei_encoding_classifiers'))
+CACHE_FORMAT = 2
+
+# number of compiled classifiers kept in memory by load_classifier, most recently used last
+MEMORY_CACHE_SIZE = 16
+_memory_cache = OrderedDict()
+cache_stats = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0}
+
+# A classifier entry compiled by compile_classifier. @attribs is a tuple of (name, value) pairs in
+# the order they are written out; a value of None marks an attribute that is filled in from the
+# glyph when the template is instantiated (line, oct, pname). @components holds one
+# ComponentTemplate per neume component, and is empty for elements with no children (clefs,
+# custos), which are instantiated directly from @tag and @attribs.
+GlyphTemplate = namedtuple('GlyphTemplate', ['tag', 'attribs', 'components'])
+
+# One neume component of a GlyphTemplate. @interval is the number of diatonic steps from the
+# previous component, parsed from the @intm attribute (0 for the first component), and @offset the
+# number of steps from the first component, i.e. the sum of the intervals up to this one.
+ComponentTemplate = namedtuple('ComponentTemplate', ['tag', 'attribs', 'interval', 'offset'])
+
+# separates the parts of a glyph class name, from the most general to the most specific
+# (e.g. neume.podatus2.variant)
+CLASS_SEPARATOR = '.'
 
 
 def fetch_table_from_excel(classifier_fname):
@@ -10,6 +43,7 @@ def fetch_table_from_excel(classifier_fname):
     Given a path to an excel spreadsheet, returns a dictionary linking classification names to
     MEI snippets, given that it contains a table with columns labeled "mei" and "classification."
     '''
+    import xml.etree.ElementTree as ET
     from xlrd import open_workbook
     from unidecode import unidecode
 
@@ -49,6 +83,9 @@ def fetch_table_from_csv(fname):
     outputs a dictionary linking classifications of glyphs (e.g., podatus2, punctum, ligature3)
     to ElementTree objects of MEI snippets.
     '''
+    # only needed on a classifier cache miss, so kept off the import path
+    import xml.etree.ElementTree as ET
+
     with open(fname, 'r') as f:
         table_reader = csv.reader(f)
         full_table = []
@@ -69,3 +106,298 @@ def fetch_table_from_csv(fname):
         name_to_mei[class_name] = parsed
 
     return name_to_mei
+
+
+def parse_interval(intm):
+    '''
+    Converts the value of an @intm attribute (e.g. "2S", "-3s") into a signed number of diatonic
+    steps. Anything that can't be read as a number of steps counts as 0.
+    '''
+    try:
+        return int(intm.lower().replace('s', ''))
+    except (ValueError, AttributeError):
+        return 0
+
+
+def _compile_attribs(xml, pitched_keys, keep_intm):
+    '''
+    Orders the attributes of @xml the way they are written out for a glyph: the snippet's own
+    attributes first, then any of @pitched_keys it doesn't already have, with the pitched ones
+    left as None to be filled in from the glyph. Static values of 'None' are never written, so
+    they are dropped here.
+    '''
+    attribs = []
+    for key, value in xml.attrib.items():
+        if key in pitched_keys:
+            attribs.append((key, None))
+        elif key == 'intm' and not keep_intm:
+            continue
+        elif value != 'None':
+            attribs.append((key, value))
+    for key in pitched_keys:
+        if key not in xml.attrib:
+            attribs.append((key, None))
+    return tuple(attribs)
+
+
+def compile_entry(xml):
+    '''
+    Compiles one ElementTree MEI snippet from the classifier table into a GlyphTemplate.
+    '''
+    # ncs, custos do not have a @line attribute; only clefs get one from the glyph
+    pitched_keys = ('line', 'oct', 'pname') if xml.tag == 'clef' else ('oct', 'pname')
+
+    children = list(xml)
+    if not children:
+        return GlyphTemplate(xml.tag, _compile_attribs(xml, pitched_keys, True), ())
+
+    # the parent of a neume only takes its tag from the snippet. the first component keeps its
+    # @intm, the pitch of every later one is resolved from it, so @intm is dropped
+    components = []
+    offset = 0
+    for i, nc in enumerate(children):
+        nc_pitched_keys = ('line', 'oct', 'pname') if nc.tag == 'clef' else ('oct', 'pname')
+        interval = parse_interval(nc.get('intm')) if i > 0 else 0
+        offset += interval
+        components.append(
+            ComponentTemplate(nc.tag, _compile_attribs(nc, nc_pitched_keys, i == 0), interval, offset))
+    return GlyphTemplate(xml.tag, (), tuple(components))
+
+
+def compile_classifier(name_to_mei):
+    '''
+    Given the dictionary output by fetch_table_from_csv (or fetch_table_from_excel), returns a new
+    dictionary linking the same classification names to immutable GlyphTemplates, so that
+    encoding a glyph never has to look at (or write into) the ElementTree objects. Entries that
+    are already compiled are passed through as they are.
+    '''
+    compiled = {}
+    for name, entry in name_to_mei.items():
+        compiled[name] = entry if isinstance(entry, GlyphTemplate) else compile_entry(entry)
+    return compiled
+
+
+def _to_plain(compiled):
+    # namedtuples are pickled by reference to this module, which may be imported under a
+    # different name by whatever process reads the cache, so store plain tuples instead
+    return dict(
+        (name, (t.tag, t.attribs, tuple(tuple(c) for c in t.components)))
+        for name, t in compiled.items()
+    )
+
+
+def _from_plain(plain):
+    return dict(
+        (name, GlyphTemplate(tag, attribs, tuple(ComponentTemplate(*c) for c in components)))
+        for name, (tag, attribs, components) in plain.items()
+    )
+
+
+def _read_disk_cache(path):
+    try:
+        with open(path, 'rb') as f:
+            return _from_plain(pickle.load(f))
+    except (IOError, OSError, EOFError, ValueError, TypeError, pickle.UnpicklingError):
+        return None
+
+
+def replace_file(src, dst):
+    '''
+    Moves the file @src over @dst in one step, as os.replace does on Python 3; on Python 2,
+    os.rename does the same on POSIX systems.
+    '''
+    getattr(os, 'replace', os.rename)(src, dst)
+
+
+def _write_disk_cache(path, compiled):
+    # write to a temporary file first so that concurrent workers never see a partial entry
+    cache_dir = os.path.dirname(path)
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(_to_plain(compiled), f, pickle.HIGHEST_PROTOCOL)
+        replace_file(tmp_path, path)
+    except (IOError, OSError) as e:
+        logger.warning('could not write classifier cache %s: %s', path, e)
+
+
+def load_classifier(fname, cache_dir=CACHE_DIR, logger=logger):
+    '''
+    Returns the compiled classifier (see compile_classifier) for the MEI mapping csv at @fname,
+    skipping the parse whenever a csv with identical contents has been loaded before: first from
+    an in-process LRU of the last MEMORY_CACHE_SIZE classifiers, then from a pickle in
+    @cache_dir keyed by the hash of the file's contents. Pass cache_dir=None to use only the
+    in-process cache. Hits and misses are counted in cache_stats and reported to @logger.
+    '''
+    with open(fname, 'rb') as f:
+        key = '{}-{}'.format(hashlib.sha1(f.read()).hexdigest(), CACHE_FORMAT)
+
+    if key in _memory_cache:
+        _memory_cache[key] = _memory_cache.pop(key)
+        cache_stats['memory_hits'] += 1
+        logger.info('classifier cache: memory hit for %s %s', fname, cache_stats)
+        return _memory_cache[key]
+
+    cache_path = os.path.join(cache_dir, key + '.pickle') if cache_dir else None
+    compiled = _read_disk_cache(cache_path) if cache_path else None
+    if compiled is not None:
+        cache_stats['disk_hits'] += 1
+        logger.info('classifier cache: disk hit for %s %s', fname, cache_stats)
+    else:
+        compiled = compile_classifier(fetch_table_from_csv(fname))
+        cache_stats['misses'] += 1
+        logger.info('classifier cache: miss for %s %s', fname, cache_stats)
+        if cache_path:
+            _write_disk_cache(cache_path, compiled)
+
+    _memory_cache[key] = compiled
+    while len(_memory_cache) > MEMORY_CACHE_SIZE:
+        _memory_cache.popitem(last=False)
+    return compiled
+
+
+class ClassifierResolver(object):
+    '''
+    Looks up glyph class names in a compiled classifier (see compile_classifier), falling back
+    on more general classes for names that aren't in it: a name with no entry of its own is
+    looked up in @aliases (a dictionary of class names to the names to use instead), then with
+    its last dotted part left off, and so on, so that neume.podatus2.variant is encoded as
+    neume.podatus2 (or whatever that is an alias of) if the table has no entry for the variant.
+    What every name resolves to is remembered, so only the first glyph of a class pays for it.
+
+    Behaves as a read-only dictionary of the names it can resolve. Encoding a glyph goes through
+    lookup(), which also counts the names that can't be resolved in @unknown, so they can be
+    reported once for the whole page (see log_unknown) instead of once per glyph. The encoder
+    counts the pitches of neumes it can't transpose the same way, in @out_of_scale.
+    '''
+
+    def __init__(self, classifier, aliases=None):
+        self.classifier = compile_classifier(classifier)
+        self.aliases = dict(aliases or {})
+        self.unknown = Counter()
+        self.out_of_scale = Counter()
+        self._resolved = {}
+
+    def for_page(self):
+        '''
+        Returns a resolver for another page, with the same classifier, aliases and resolved names
+        but nothing counted in @unknown or @out_of_scale yet.
+        '''
+        resolver = ClassifierResolver.__new__(ClassifierResolver)
+        resolver.classifier = self.classifier
+        resolver.aliases = self.aliases
+        resolver.unknown = Counter()
+        resolver.out_of_scale = Counter()
+        resolver._resolved = self._resolved
+        return resolver
+
+    def resolve(self, name):
+        '''
+        Returns the GlyphTemplate the class @name resolves to, or None if it doesn't resolve to
+        anything.
+        '''
+        try:
+            return self._resolved[name]
+        except KeyError:
+            template = self._resolved[name] = self._fallback(name, set())
+            return template
+
+    def _fallback(self, name, seen):
+        # @seen holds the alias targets already followed, so that aliases going round in a
+        # circle end up unresolved
+        while name:
+            template = self.classifier.get(name)
+            if template is not None:
+                return template
+            target = self.aliases.get(name)
+            if target is not None and target not in seen:
+                seen.add(target)
+                template = self._fallback(target, seen)
+                if template is not None:
+                    return template
+            name = name.rpartition(CLASS_SEPARATOR)[0]
+        return None
+
+    def lookup(self, name):
+        '''
+        Returns what the class of a glyph to be encoded, @name, resolves to, counting it in
+        @unknown if that is nothing.
+        '''
+        template = self.resolve(name)
+        if template is None:
+            self.unknown[name] += 1
+        return template
+
+    def report(self):
+        '''
+        Returns the names counted in @unknown as a single line of text, or an empty string if
+        there are none.
+        '''
+        if not self.unknown:
+            return ''
+        return '{} glyphs of {} classes not found in classifier table: {}'.format(
+            sum(self.unknown.values()), len(self.unknown),
+            ', '.join('{} (x{})'.format(k, v) for k, v in sorted(self.unknown.items())))
+
+    def log_unknown(self, logger=logger):
+        '''
+        Logs the report of the names counted in @unknown as a warning to @logger, if there are any,
+        and another one for the pitches counted in @out_of_scale.
+        '''
+        if self.unknown:
+            logger.warning(self.report())
+        if self.out_of_scale:
+            logger.warning('{} neumes with pitches not in scale, left untransposed: {}'.format(
+                sum(self.out_of_scale.values()),
+                ', '.join('{} (x{})'.format(k, v) for k, v in sorted(self.out_of_scale.items()))))
+
+    def __getitem__(self, name):
+        template = self.resolve(name)
+        if template is None:
+            raise KeyError(name)
+        return template
+
+    def get(self, name, default=None):
+        template = self.resolve(name)
+        return default if template is None else template
+
+    def __contains__(self, name):
+        return self.resolve(name) is not None
+
+    def __iter__(self):
+        return iter(self.classifier)
+
+    def __len__(self):
+        return len(self.classifier)
+
+    def items(self):
+        return self.classifier.items()
+
+
+def resolver(classifier, aliases=None):
+    '''
+    Returns a ClassifierResolver to encode one page with: a fresh one from @classifier if it is
+    one already (ignoring @aliases), or else a new one for @classifier, compiled, with @aliases.
+    '''
+    if isinstance(classifier, ClassifierResolver):
+        return classifier.for_page()
+    return ClassifierResolver(classifier, aliases)
+
+
+def parse_aliases(text):
+    '''
+    Reads glyph class aliases for a ClassifierResolver from @text, written as name=target pairs
+    separated by commas or line breaks (e.g. "neume.podatus3=neume.podatus2, ligature=neume").
+    Raises a ValueError on anything else.
+    '''
+    aliases = {}
+    for pair in text.replace('\n', ',').split(','):
+        if not pair.strip():
+            continue
+        name, sep, target = pair.partition('=')
+        if not (sep and name.strip() and target.strip()):
+            raise ValueError('bad classifier alias {!r}, expected name=target'.format(pair.strip()))
+        aliases[name.strip()] = target.strip()
+    return aliases
@@ -0,0 +1,217 @@
+import build_mei_file as bm
+from neume_merger import NeumeMerger
+
+
+class SyllableGroup(object):
+    '''
+    The unit of work passed between pipeline stages: the glyphs of one syllable and its syllable
+    box, filled in by later stages with the look-ahead flags for those glyphs, the NeumeMerger to
+    encode them with (if any) and, once encoded, the elements to add to the layer (@syllable being
+    the <syllable> among them, if any).
+    '''
+    __slots__ = ('glyphs', 'syl_box', 'syllable_over', 'merger', 'syllable', 'elements')
+
+    def __init__(self, glyphs, syl_box, elements=None):
+        self.glyphs = glyphs
+        self.syl_box = syl_box
+        self.syllable_over = None
+        self.merger = None
+        self.syllable = None
+        self.elements = elements if elements is not None else []
+
+
+class EncodingContext(object):
+    '''
+    Everything the stages of a pipeline share while encoding one page: the inputs to process(),
+    the ZoneRegistry and element class of the document being built, and whatever stages record
+    for later ones (@syllable_boxes, the boxes of all syllable groups, and @orphan_glyphs, the
+    number of glyphs before the first syllable, are set by the alignment).
+
+    When only part of a page is encoded (see staff_parallel.py), the page's @merge_distance can be
+    given up front, and @initial_break turned off so the encode stage doesn't start a new system.
+    '''
+
+    def __init__(self, glyphs, syl_boxes, median_line_spacing, classifier, staves, page,
+                 width_mult=0, zones=None, element_cls=None, merge_distance=None, initial_break=True):
+        self.glyphs = glyphs
+        self.syl_boxes = syl_boxes
+        self.median_line_spacing = median_line_spacing
+        self.classifier = classifier
+        self.staves = staves
+        self.page = page
+        self.width_mult = width_mult
+        self.zones = zones
+        self.element_cls = element_cls
+        self.syllable_boxes = None
+        self.orphan_glyphs = 0
+        self.initial_break = initial_break
+        self._merge_distance = merge_distance
+
+    def merge_distance(self):
+        '''
+        The largest gap allowed between two neumes that are merged: the median width of all the
+        page's zones times @width_mult, as in merge_nearby_neume_components.
+        '''
+        if self._merge_distance is None:
+            widths = bm.zone_widths(self.glyphs, self.syllable_boxes, self.classifier, self.staves)
+            self._merge_distance = bm.merge_threshold(widths, self.width_mult)
+        return self._merge_distance
+
+
+def align(groups, context):
+    '''
+    Source stage: splits the page's glyphs into syllable groups with neume_to_lyric_alignment's
+    rules, slicing each group out only when the next stage asks for it. Ignores @groups.
+    '''
+    if not context.syl_boxes:
+        pairs = bm.dummy_syllable_pairs(context.glyphs)
+        context.syllable_boxes = [syl_box for _, syl_box in pairs]
+    else:
+        starts = bm.anchor_starts(context.glyphs, context.syl_boxes, context.median_line_spacing)
+        pairs = bm.iter_pairs_from_starts(context.glyphs, context.syl_boxes, starts)
+        context.syllable_boxes = list(context.syl_boxes)
+        if starts[0] != 0:
+            context.syllable_boxes.append(bm.blank_syllable())
+            context.orphan_glyphs = starts[0]
+
+    for gs, syl_box in pairs:
+        yield SyllableGroup(gs, syl_box)
+
+
+def from_pairs(pairs):
+    '''
+    Returns a source stage that yields the given ([glyphs], syllable) pairs as they are, for
+    replacing align when the alignment has already been done.
+    '''
+    def pairs_source(groups, context):
+        context.syllable_boxes = [syl_box for _, syl_box in pairs]
+        context.glyphs = [g for gs, _ in pairs for g in gs]
+        for gs, syl_box in pairs:
+            yield SyllableGroup(gs, syl_box)
+    return pairs_source
+
+
+def lookahead(groups, context):
+    '''
+    Computes, in a single backward pass over each group, whether the syllable is over at every
+    glyph (see build_mei_file.syllable_over_flags).
+    '''
+    for group in groups:
+        group.syllable_over = bm.syllable_over_flags(group.glyphs)
+        yield group
+
+
+def encode(groups, context):
+    '''
+    Encodes each syllable group into the elements to add to the layer, preceded by a group holding
+    only the initial system break (unless the context's @initial_break is off).
+    '''
+    if context.initial_break:
+        yield SyllableGroup([], None, [bm.create_system_break(context.staves[0], context.zones, context.element_cls)])
+
+    for group in groups:
+        group.elements = bm.encode_syllable(
+            group.glyphs, group.syl_box, context.classifier, context.staves, context.zones,
+            context.element_cls, group.syllable_over, group.merger)
+        group.syllable = group.elements[0]
+        yield group
+
+
+def merge(groups, context):
+    '''
+    Hands every group the page's NeumeMerger, so that the encode stage after it merges nearby
+    neume components as each syllable is built (with the same result as
+    merge_nearby_neume_components). Passes groups through untouched if @width_mult is 0.
+    '''
+    merger = None
+    for group in groups:
+        if context.width_mult > 0:
+            if merger is None:
+                merger = NeumeMerger(context.merge_distance())
+            group.merger = merger
+        yield group
+
+
+DEFAULT_STAGES = (
+    ('align', align),
+    ('lookahead', lookahead),
+    ('merge', merge),
+    ('encode', encode),
+)
+
+
+class Pipeline(object):
+    '''
+    An ordered list of named, lazy stages that the encoder runs a page through. Each stage is a
+    function taking an iterable of SyllableGroups and the EncodingContext, and yielding
+    SyllableGroups; the first stage is the source and ignores its input. Running the pipeline
+    pulls one group at a time through every stage and adds its elements to the layer, so no stage
+    ever holds the whole page.
+
+    Stages can be inserted, removed, replaced and reordered by name, e.g.
+        pipeline = Pipeline()
+        pipeline.remove('merge')
+        pipeline.insert_after('encode', 'count', count_stage)
+    '''
+
+    def __init__(self, stages=DEFAULT_STAGES):
+        self.stages = list(stages)
+
+    def names(self):
+        return [name for name, _ in self.stages]
+
+    def index(self, name):
+        try:
+            return self.names().index(name)
+        except ValueError:
+            raise KeyError('no stage named {} in pipeline {}'.format(name, self.names()))
+
+    def get(self, name):
+        return self.stages[self.index(name)][1]
+
+    def append(self, name, stage):
+        self.stages.append((name, stage))
+        return self
+
+    def insert_before(self, before, name, stage):
+        self.stages.insert(self.index(before), (name, stage))
+        return self
+
+    def insert_after(self, after, name, stage):
+        self.stages.insert(self.index(after) + 1, (name, stage))
+        return self
+
+    def remove(self, name):
+        del self.stages[self.index(name)]
+        return self
+
+    def replace(self, name, stage):
+        self.stages[self.index(name)] = (name, stage)
+        return self
+
+    def reorder(self, names):
+        '''
+        Puts the stages in the order given by @names, dropping any stage not listed.
+        '''
+        self.stages = [(name, self.get(name)) for name in names]
+        return self
+
+    def copy(self):
+        return Pipeline(self.stages)
+
+    def iter_groups(self, context):
+        '''
+        Chains the stages together and returns the (lazy) iterable of groups out of the last one.
+        '''
+        groups = iter(())
+        for _, stage in self.stages:
+            groups = stage(groups, context)
+        return groups
+
+    def run(self, context, layer):
+        '''
+        Runs the page through all stages, adding every group's elements to @layer as it comes out.
+        '''
+        for group in self.iter_groups(context):
+            for el in group.elements:
+                layer.addChild(el)
@@ -0,0 +1,215 @@
+'''
+Encodes a page once for a whole list of Neume Component Spacing values, for tuning that setting.
+
+The page is aligned and encoded a single time without merging, recording the gap between every
+two consecutive neumes in a syllable (which is what merging compares against the threshold). For
+each spacing value the threshold is the median zone width times that value, and the merged
+result is just a cutoff on those gaps: every gap at or below it joins two neumes. One MEI file
+is written per value, all sharing the same zones and IDs, along with a summary of how many
+neumes each value gives, which is read off the sorted gaps.
+
+Usage:
+    python spacing_sweep.py classifier.csv page.json alignment.json out_dir 0.25 0.5 1 2
+'''
+import io
+import json
+import os
+import sys
+from bisect import bisect_right
+
+import build_mei_file as bm
+import jsomr_ingest
+import parse_classifier_table as pct
+import pipeline
+from glyph_table import GlyphTable
+from mei_writer import StreamElement, StreamingMeiWriter, element_to_text, element_tag_lines
+from zone_registry import ZoneRegistry
+
+
+class GapRecorder(object):
+    '''
+    Takes the place of a NeumeMerger in encode_syllable, adding every child to the syllable as it
+    is but recording, for each child, the gap between it and the neume before it (None unless
+    both are neumes).
+    '''
+
+    def __init__(self):
+        self.gaps = []
+        self._syllable = None
+        self._prev_lrx = None
+
+    def begin(self, syllable):
+        self._syllable = syllable
+        self.gaps = []
+        self._prev_lrx = None
+
+    def add(self, el, bb=None):
+        self._syllable.addChild(el)
+        if el.name != 'neume' or bb is None:
+            self.gaps.append(None)
+            self._prev_lrx = None
+            return
+        self.gaps.append(None if self._prev_lrx is None else bb['ulx'] - self._prev_lrx)
+        self._prev_lrx = bb['lrx']
+
+
+class _FanOut(object):
+    '''
+    Adds every child it is given to each of several parents, so zones reach every writer.
+    '''
+
+    def __init__(self, parents):
+        self.parents = parents
+
+    def addChild(self, el):
+        for parent in self.parents:
+            parent.addChild(el)
+
+
+class _SyllablePieces(object):
+    '''
+    A syllable's children, each serialized once, from which its text for any merge threshold is
+    put together.
+    '''
+
+    def __init__(self, syllable, gaps, depth):
+        self.open, self.close = element_tag_lines(syllable, depth)
+        self.children = []
+        for child, gap in zip(syllable.children, gaps):
+            if child.name == 'neume':
+                neume_open, neume_close = element_tag_lines(child, depth + 1)
+                ncs = [element_to_text(nc, depth + 2) for nc in child.children]
+                self.children.append((gap, neume_open, ncs, neume_close))
+            else:
+                self.children.append((None, element_to_text(child, depth + 1), None, None))
+
+    def text(self, threshold):
+        '''
+        The syllable with every pair of neumes at most @threshold apart merged (or none merged, if
+        @threshold is None).
+        '''
+        out = [self.open]
+        neume = None
+        for gap, start, ncs, end in self.children:
+            if neume is not None and ncs is not None and gap is not None and threshold is not None \
+                    and gap <= threshold:
+                neume[1].extend(ncs)
+                continue
+            if neume is not None:
+                out.append(neume[0])
+                out.extend(neume[1])
+                out.append(neume[2])
+                neume = None
+            if ncs is None:
+                out.append(start)
+            else:
+                neume = (start, list(ncs), end)
+        if neume is not None:
+            out.append(neume[0])
+            out.extend(neume[1])
+            out.append(neume[2])
+        out.append(self.close)
+        return ''.join(out)
+
+
+def _record_gaps(groups, context):
+    recorder = GapRecorder()
+    for group in groups:
+        group.merger = recorder
+        yield group
+
+
+def sweep(jsomr, syls, classifier, width_mults, output_paths):
+    '''
+    Encodes the page once and writes it to each of @output_paths, merging neume components with
+    the matching one of @width_mults (0 meaning no merging, as in process). Returns a summary
+    list with, for every value, its merge threshold and the number of neumes it gives.
+    '''
+    syl_boxes = syls['syl_boxes'] if syls is not None else None
+    median_line_spacing = syls['median_line_spacing'] if syls is not None else None
+    classifier = pct.resolver(classifier)
+    glyphs = jsomr['glyphs']
+    if not isinstance(glyphs, GlyphTable):
+        glyphs = GlyphTable.from_jsomr(glyphs)
+
+    context = pipeline.EncodingContext(
+        glyphs, syl_boxes, median_line_spacing, classifier, jsomr['staves'], jsomr['page'])
+    stages = pipeline.Pipeline().replace('merge', _record_gaps)
+
+    root, surface, layer = bm.generate_base_tree(StreamElement)
+    bm.set_surface_bounds(surface, context.page)
+
+    outs = [io.open(path, 'w', encoding='utf-8') for path in output_paths]
+    try:
+        writers = [StreamingMeiWriter(out, root, surface, layer) for out in outs]
+        context.zones = ZoneRegistry(_FanOut([w.surface for w in writers]), StreamElement)
+        context.element_cls = StreamElement
+        depth = writers[0].layer.depth
+
+        thresholds = None
+        gaps = []
+        neumes = 0
+        for group in stages.iter_groups(context):
+            texts = [''] * len(writers)
+            for el in group.elements:
+                if el is group.syllable:
+                    # the syllable boxes are only known once the alignment has started
+                    if thresholds is None:
+                        widths = bm.zone_widths(glyphs, context.syllable_boxes, classifier, context.staves)
+                        thresholds = [bm.merge_threshold(widths, m) if m > 0 else None for m in width_mults]
+                    pieces = _SyllablePieces(el, group.merger.gaps, depth)
+                    gaps.extend(gap for gap in group.merger.gaps if gap is not None)
+                    neumes += sum(1 for c in el.children if c.name == 'neume')
+                    for i, threshold in enumerate(thresholds):
+                        texts[i] += pieces.text(threshold)
+                else:
+                    text = element_to_text(el, depth)
+                    texts = [t + text for t in texts]
+            for writer, text in zip(writers, texts):
+                writer.layer.add_serialized(text)
+
+        for writer in writers:
+            writer.close()
+    finally:
+        for out in outs:
+            out.close()
+    classifier.log_unknown()
+
+    gaps.sort()
+    return [
+        {
+            'width_mult': m,
+            'threshold': threshold,
+            'neumes': neumes - (bisect_right(gaps, threshold) if threshold is not None else 0),
+        }
+        for m, threshold in zip(width_mults, thresholds or [None] * len(width_mults))
+    ]
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) < 5:
+        print(__doc__)
+        return 1
+    classifier_fname, jsomr_fname, syls_fname, out_dir = argv[:4]
+    width_mults = [float(m) for m in argv[4:]]
+
+    jsomr = jsomr_ingest.load_jsomr(jsomr_fname)
+    syls = jsomr_ingest.load_alignment(syls_fname) if syls_fname != '-' else None
+    classifier = pct.load_classifier(classifier_fname)
+
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    stem = os.path.splitext(os.path.basename(jsomr_fname))[0]
+    output_paths = [os.path.join(out_dir, '{}_{}.mei'.format(stem, m)) for m in width_mults]
+
+    summary = sweep(jsomr, syls, classifier, width_mults, output_paths)
+    with open(os.path.join(out_dir, '{}_summary.json'.format(stem)), 'w') as f:
+        json.dump(summary, f, indent=2)
+    for entry, path in zip(summary, output_paths):
+        print('{:>8} {:>6} neumes  {}'.format(entry['width_mult'], entry['neumes'], path))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,248 @@
+'''
+Encodes the staves of a page in parallel, for pages dense enough that encoding them on one core
+takes too long.
+
+Once the glyphs are aligned to syllables, every syllable is encoded on its own; all the
+syllables of a page share is the list of zones in the <surface>, where a bounding box seen
+before reuses its zone, and the order of the layer. So the aligned syllable groups are split
+into runs starting on the same staff (see staff_chunks), and the rest of the pipeline runs on
+every run in a worker process. Each worker serializes its zones and layer content itself, with
+placeholders for the IDs of the zones (and, for sequential IDs, of all its elements), and hands
+back the text along with what it created in order: the name of every element, and the bounding
+box of every zone.
+
+Back in the main process, the runs are stitched together in page order. Every zone is looked up
+on the page, and only written out if no earlier staff has one for the same bounding box; every
+element gets the ID it would have been given had the page been encoded serially; and the text
+goes into the layer with its placeholders filled in. The output is the same as that of the
+serial encoder.
+
+Processes are used rather than threads, since encoding is pure Python and threads would take
+turns holding the GIL. See build_mei_file.process(staff_workers=...).
+'''
+import multiprocessing
+import re
+import uuid
+
+import build_mei_file as bm
+import parse_classifier_table as pct
+import pipeline
+from glyph_table import GlyphRow
+from instrumentation import Instrumentation
+from mei_validator import StructureValidator
+from mei_writer import SequentialIds, StreamElement, element_to_text, generate_id
+from zone_registry import Zone, ZoneRegistry
+
+# set in every worker process by _init_worker
+_classifier = None
+_staves = None
+_width_mult = 0
+_stages = None
+_sequential = False
+_layout = None
+# the @max_violations of the page's StructureValidator, or None if it isn't validated
+_max_violations = None
+_measure = False
+
+
+def staff_chunks(groups):
+    '''
+    Splits the SyllableGroups coming out of the alignment into lists of consecutive groups
+    whose first glyph is on the same staff (groups without glyphs go with the ones before them),
+    which can be encoded independently of each other. A syllable that runs over onto the next
+    staff stays in one piece, with the staff it starts on.
+    '''
+    chunk = []
+    staff = None
+    for group in groups:
+        if len(group.glyphs):
+            group_staff = group.glyphs[0]['staff']
+            if chunk and group_staff != staff:
+                yield chunk
+                chunk = []
+            staff = group_staff
+        chunk.append(group)
+    if chunk:
+        yield chunk
+
+
+def chunk_task(index, chunk, merge_distance):
+    '''
+    Returns the task encode_chunk takes for the @index'th chunk of groups from staff_chunks: the
+    chunk's glyphs, the (start, stop, syllable box) of each group in them, and the page's
+    @merge_distance. Glyphs from a GlyphTable are sent as a table of just those glyphs.
+    '''
+    glyphs = [g for group in chunk for g in group.glyphs]
+    if glyphs and all(isinstance(g, GlyphRow) and g.table is glyphs[0].table for g in glyphs):
+        glyphs = glyphs[0].table.take([g.index for g in glyphs])
+
+    bounds = []
+    start = 0
+    for group in chunk:
+        bounds.append((start, start + len(group.glyphs), group.syl_box))
+        start += len(group.glyphs)
+    return index, glyphs, bounds, merge_distance
+
+
+class _PlaceholderIds(object):
+    '''
+    Creates StreamElements, keeping the name of every element in @created in the order they were
+    created. Zones, and all elements if @sequential, get placeholder IDs, @token followed by the
+    number of elements created before; the rest get random IDs as usual.
+    '''
+
+    def __init__(self, sequential):
+        self.sequential = sequential
+        self.token = 'p' + uuid.uuid4().hex + '-'
+        self.created = []
+
+    def __call__(self, name):
+        number = len(self.created)
+        self.created.append(name)
+        if self.sequential or name == 'zone':
+            return StreamElement(name, self.token + str(number))
+        return StreamElement(name)
+
+
+def _init_worker(classifier, staves, width_mult, stages, sequential, layout, max_violations, measure):
+    global _classifier, _staves, _width_mult, _stages, _sequential, _layout, _max_violations, _measure
+    _classifier = classifier
+    _staves = staves
+    _width_mult = width_mult
+    _stages = stages
+    _sequential = sequential
+    _layout = layout
+    _max_violations = max_violations
+    _measure = measure
+
+
+def encode_chunk(task):
+    '''
+    Encodes one task from chunk_task in a worker, with the stages after the source of the page's
+    pipeline; only the first chunk of a page starts with a system break. Returns the serialized
+    layer content, its placeholder token, what was created in order (the names of elements, and
+    for zones, their (ulx, uly, lrx, lry) and serialized zone element instead), the glyph class
+    names that couldn't be resolved, and, if the worker was set up for them, the (violations,
+    count) of a StructureValidator and the EncodingMetrics of the chunk.
+    '''
+    index, glyphs, bounds, merge_distance = task
+    source_name, stages = _stages
+    pairs = [(glyphs[start:stop], syl_box) for start, stop, syl_box in bounds]
+    surface_depth, layer_depth, minify = _layout
+
+    ids = _PlaceholderIds(_sequential)
+    zones = ZoneRegistry(StreamElement('surface'), ids)
+    classifier = pct.resolver(_classifier)
+    context = pipeline.EncodingContext(
+        None, None, None, classifier, _staves, None, _width_mult, zones, ids,
+        merge_distance=merge_distance, initial_break=index == 0)
+    stages = pipeline.Pipeline([(source_name, pipeline.from_pairs(pairs))] + stages)
+
+    instrumentation = None
+    if _measure:
+        instrumentation = Instrumentation()
+        instrumentation.start()
+    layer = StreamElement('layer')
+    bm.run_stages(stages, context, layer, instrumentation)
+    with bm.measure(instrumentation, 'serialize'):
+        text = ''.join(element_to_text(el, layer_depth, minify) for el in layer.children)
+        created = ids.created
+        for zone in zones.surface.children:
+            created[int(zone.id[len(ids.token):])] = (
+                tuple(zones[zone.id]), element_to_text(zone, surface_depth, minify))
+
+    violations = None
+    if _max_violations is not None:
+        validator = StructureValidator(_max_violations)
+        for el in zones.surface.children + layer.children:
+            validator.element(el)
+        validator.finish()
+        violations = (validator.violations, validator.count)
+
+    metrics = None
+    if instrumentation is not None:
+        instrumentation.finish(context)
+        metrics = instrumentation.metrics
+    return text, ids.token, created, (classifier.unknown, classifier.out_of_scale), violations, metrics
+
+
+def _stitch(result, context, writer, instrumentation, validator):
+    # adds the output of encode_chunk to the page, giving its elements their final IDs
+    text, token, created, (unknown, out_of_scale), violations, metrics = result
+    sequential = isinstance(context.element_cls, SequentialIds)
+
+    ids = []
+    new_zones = []
+    for entry in created:
+        if isinstance(entry, tuple):
+            bb = dict(zip(Zone._fields, entry[0]))
+            zone_id = context.zones.get_id(bb)
+            if zone_id is None:
+                zone_id = context.element_cls.next_id('zone') if sequential else generate_id()
+                context.zones.add(zone_id, bb)
+                new_zones.append(entry[1])
+            ids.append(zone_id)
+        else:
+            # with random IDs, only zones have placeholders
+            ids.append(context.element_cls.next_id(entry) if sequential else None)
+
+    placeholder = re.compile(re.escape(token) + r'(\d+)')
+
+    def resolve(text):
+        return placeholder.sub(lambda m: ids[int(m.group(1))], text)
+
+    if new_zones:
+        writer.surface.add_serialized(resolve(''.join(new_zones)))
+    writer.layer.add_serialized(resolve(text))
+
+    if isinstance(context.classifier, pct.ClassifierResolver):
+        context.classifier.unknown.update(unknown)
+        context.classifier.out_of_scale.update(out_of_scale)
+    if violations is not None:
+        found, count = violations
+        for v in found:
+            validator.add(v.rule, resolve(v.element), resolve(v.message))
+        validator.count += count - len(found)
+    if metrics is not None:
+        instrumentation.add_metrics(metrics)
+
+
+def encode_staves(stages, context, writer, workers, instrumentation=None, validator=None):
+    '''
+    Runs the page described by @context through the pipeline @stages into the StreamingMeiWriter
+    @writer, as build_mei_file.stream_document does, but with every staff encoded separately over
+    @workers processes, as described in the module documentation. The source stage runs in this
+    process; the stages after it run in the workers, so they have to be picklable (e.g. functions
+    defined at the top level of a module). The measurements of @instrumentation and the
+    violations found by @validator are collected from the workers, so the times of the stages
+    after the source are added up over all of them; putting the results together in this
+    process is measured as the stitch stage.
+
+    Falls back to encoding in this process (with the same result) if there is only one staff or
+    worker, or child processes can't be started here, e.g. in a daemonic Celery worker.
+    '''
+    (source_name, source), stages = stages.stages[0], stages.stages[1:]
+    with bm.measure(instrumentation, source_name):
+        chunks = list(staff_chunks(source(iter(()), context)))
+    merge_distance = context.merge_distance() if context.width_mult > 0 else None
+    # even an empty page starts with a system break
+    tasks = [chunk_task(i, chunk, merge_distance) for i, chunk in enumerate(chunks)]
+    tasks = tasks or [chunk_task(0, [], merge_distance)]
+
+    initargs = (
+        context.classifier, context.staves, context.width_mult, (source_name, stages),
+        isinstance(context.element_cls, SequentialIds),
+        (writer.surface.depth, writer.layer.depth, writer.minify),
+        validator.max_violations if validator is not None else None, instrumentation is not None)
+    processes = min(workers, len(tasks))
+    if processes < 2 or multiprocessing.current_process().daemon:
+        _init_worker(*initargs)
+        for result in map(encode_chunk, tasks):
+            with bm.measure(instrumentation, 'stitch'):
+                _stitch(result, context, writer, instrumentation, validator)
+        return
+
+    with multiprocessing.Pool(processes, _init_worker, initargs) as pool:
+        for result in pool.imap(encode_chunk, tasks):
+            with bm.measure(instrumentation, 'stitch'):
+                _stitch(result, context, writer, instrumentation, validator)
@@ -0,0 +1,99 @@
+'''
+Checks that the vectorized batch alignment in batch_alignment.py gives the same anchors and pairs
+as build_mei_file.neume_to_lyric_alignment, page by page. Needs numpy, pymei and Rodan installed;
+otherwise it is skipped. Run from the repository root:
+    python -m unittest discover -s tests
+'''
+import random
+import unittest
+
+from test_mei_writer import bm, synthetic
+
+try:
+    import batch_alignment as ba
+    from glyph_table import GlyphTable
+except ImportError:
+    ba = None
+
+STAFF_HEIGHT = 100
+
+
+def synthetic_page(seed):
+    jsomr = synthetic.make_jsomr(300, 8, seed=seed)
+    syls = synthetic.make_alignment(jsomr, seed=seed)
+    return GlyphTable.from_jsomr(jsomr['glyphs']), syls['syl_boxes'], syls['median_line_spacing']
+
+
+def scrambled_page(seed, fractional=False):
+    # overlapping staves, repeated left edges, and syllable boxes out of reading order, so that
+    # boxes often find their nearest glyph already passed by an earlier one
+    rng = random.Random(seed)
+    glyphs = []
+    for _ in range(rng.randint(0, 200)):
+        staff = rng.randint(1, 6)
+        ulx = rng.randrange(0, 1000, 5) + (rng.choice((0, 0.5)) if fractional else 0)
+        glyphs.append({
+            'glyph': {
+                'name': 'neume.punctum',
+                'bounding_box': {'ulx': ulx, 'uly': staff * STAFF_HEIGHT + rng.randint(-40, 60),
+                                 'ncols': rng.randint(5, 60), 'nrows': 20},
+            },
+            'pitch': {'staff': str(staff), 'offset': str(int(ulx)), 'strt_pos': '5', 'octave': '3', 'note': 'c'},
+        })
+    syl_boxes = []
+    for _ in range(rng.randint(1, 80)):
+        x, y = rng.randint(-20, 1050), rng.randint(0, 8 * STAFF_HEIGHT)
+        syl_boxes.append({'syl': 'la', 'ul': [x, y], 'lr': [x + 40, y + 30]})
+    return GlyphTable.from_jsomr(glyphs), syl_boxes, rng.choice((0, 30, STAFF_HEIGHT * 1.5, 1000))
+
+
+def as_dicts(page):
+    # the same page, with the glyphs as the list of dicts add_flags_to_glyphs gives
+    glyphs, syl_boxes, median_line_spacing = page
+    return [dict(g, bounding_box=dict(g['bounding_box'])) for g in glyphs], syl_boxes, median_line_spacing
+
+
+@unittest.skipIf(bm is None or ba is None, 'needs numpy, pymei and Rodan')
+class TestBatchAlignment(unittest.TestCase):
+
+    def check(self, pages):
+        starts = ba.find_anchor_starts_batch(pages)
+        pairs = ba.neume_to_lyric_alignment_batch(pages)
+        self.assertEqual(len(pairs), len(pages))
+        for i, page in enumerate(pages):
+            if page[1]:
+                self.assertEqual(starts[i], bm.anchor_starts(*page), 'page {}'.format(i))
+            else:
+                self.assertEqual(starts[i], [])
+            self.assertEqual(pairs[i], bm.neume_to_lyric_alignment(*page), 'page {}'.format(i))
+
+    def test_synthetic_pages(self):
+        self.check([synthetic_page(seed) for seed in range(4)])
+
+    def test_scrambled_pages(self):
+        self.check([scrambled_page(seed) for seed in range(40)])
+
+    def test_fractional_coordinates(self):
+        self.check([scrambled_page(seed, fractional=True) for seed in range(10)])
+
+    def test_glyph_dicts(self):
+        self.check([as_dicts(synthetic_page(0)), as_dicts(scrambled_page(1))])
+
+    def test_pages_without_syllables(self):
+        glyphs, syl_boxes, median_line_spacing = synthetic_page(5)
+        self.check([(glyphs, [], median_line_spacing), scrambled_page(2), (glyphs, None, None)])
+
+    def test_small_chunks(self):
+        chunk_cells = ba.CHUNK_CELLS
+        ba.CHUNK_CELLS = 50
+        try:
+            self.check([scrambled_page(seed) for seed in range(10)])
+        finally:
+            ba.CHUNK_CELLS = chunk_cells
+
+    def test_empty_batch(self):
+        self.assertEqual(ba.neume_to_lyric_alignment_batch([]), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
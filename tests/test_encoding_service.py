@@ -0,0 +1,129 @@
+'''
+Checks that the encoding service answers /encode requests with the same MEI as
+build_mei_file.process, and turns away requests naming a classifier it wasn't started with, or
+malformed ones, with a generic error that gives nothing about the service's files away. Needs
+pymei and Rodan installed, as the jobs do; otherwise it is skipped. Run from the repository root:
+    python -m unittest discover -s tests
+'''
+import asyncio
+import copy
+import json
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+from test_mei_writer import bm, make_classifier, make_page, number_ids
+
+if bm is not None:
+    import encoding_service
+    import parse_classifier_table as pct
+
+
+class _Writer(object):
+    # collects what the service writes back on a connection
+    def __init__(self):
+        self.data = b''
+
+    def write(self, data):
+        self.data += data
+
+    async def drain(self):
+        pass
+
+    def close(self):
+        pass
+
+
+@unittest.skipIf(bm is None, 'needs pymei and Rodan')
+class TestEncodingService(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp_dir = tempfile.mkdtemp()
+        make_classifier(cls.tmp_dir)
+        cls.classifier_path = os.path.join(cls.tmp_dir, 'mapping.csv')
+        cls.logger = logging.getLogger('test_encoding_service')
+        cls.service = encoding_service.EncodingService(workers=1, classifiers=[cls.classifier_path],
+                                                       logger=cls.logger)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.service.close()
+        shutil.rmtree(cls.tmp_dir)
+
+    def setUp(self):
+        self.jsomr, self.syls = make_page(num_glyphs=200, num_staves=3)
+
+    def request(self, path, body=b'', method='POST'):
+        # sends one request through the service's connection handler; returns the status and body
+        async def send():
+            reader = asyncio.StreamReader()
+            reader.feed_data('{} {} HTTP/1.1\r\nContent-Length: {}\r\n\r\n'.format(
+                method, path, len(body)).encode('latin-1') + body)
+            reader.feed_eof()
+            writer = _Writer()
+            await self.service.handle(reader, writer)
+            return writer.data
+
+        head, _, body = asyncio.run(send()).partition(b'\r\n\r\n')
+        return int(head.split()[1]), body.decode('utf-8')
+
+    def encode(self, **fields):
+        request = {'jsomr': self.jsomr, 'alignment': self.syls, 'classifier': 'mapping', 'width_mult': 0.5}
+        request.update(fields)
+        return self.request('/encode', json.dumps(request).encode('utf-8'))
+
+    def test_same_as_process(self):
+        status, mei = self.encode()
+        self.assertEqual(status, 200)
+        classifier = pct.load_classifier(self.classifier_path)
+        expected = bm.process(copy.deepcopy(self.jsomr), self.syls, classifier, 0.5)
+        self.assertEqual(number_ids(mei), number_ids(expected))
+
+    def test_compact(self):
+        status, mei = self.encode(output_format='compact')
+        self.assertEqual(status, 200)
+        classifier = pct.load_classifier(self.classifier_path)
+        expected = bm.process(copy.deepcopy(self.jsomr), self.syls, classifier, 0.5, output_format='compact')
+        self.assertEqual(mei, expected)
+
+    def test_unregistered_classifier(self):
+        # by another name, or by the path of the CSV itself or of any other file
+        for name in ('other', self.classifier_path, os.path.join('..', 'mapping'), '/etc/passwd', ['mapping'], None):
+            status, body = self.encode(classifier=name)
+            self.assertEqual(status, 400, name)
+            self.assertEqual(body, 'unknown classifier\n')
+            self.assertNotIn(self.tmp_dir, body)
+
+    def test_malformed_requests(self):
+        for body in (b'not json', b'[]', json.dumps({'jsomr': {}, 'classifier': 'mapping'}).encode('utf-8'),
+                     json.dumps({'jsomr': self.jsomr}).encode('utf-8')):
+            status, message = self.request('/encode', body)
+            self.assertEqual(status, 400)
+            self.assertTrue(message.startswith('bad request'), message)
+        self.assertEqual(self.encode(output_format='pretty'), (400, 'unknown output format\n'))
+        self.assertEqual(self.request('/encode', method='GET')[0], 405)
+        self.assertEqual(self.request('/nothing'), (404, 'not found\n'))
+
+    def test_failure_is_generic(self):
+        del self.jsomr['glyphs'][3]['glyph']['bounding_box']
+        with self.assertLogs(self.logger, logging.ERROR) as logs:
+            status, body = self.encode()
+        self.assertEqual((status, body), (500, 'encoding failed\n'))
+        self.assertIn('bounding_box', logs.output[0])
+
+    def test_stats(self):
+        status, body = self.request('/stats', method='GET')
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body)['classifiers'], ['mapping'])
+
+    def test_classifier_names(self):
+        other_dir = os.path.join(self.tmp_dir, 'other')
+        self.assertRaises(ValueError, encoding_service.classifier_names,
+                          [self.classifier_path, os.path.join(other_dir, 'mapping.csv')])
+
+
+if __name__ == '__main__':
+    unittest.main()
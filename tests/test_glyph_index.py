@@ -0,0 +1,100 @@
+'''
+Checks GlyphIndex.nearest_right against a linear scan over the same glyphs, on synthetic pages
+with glyphs that overlap across staves, share their left edges, and sit right on the edges of the
+query bands. Run from the repository root:
+    python -m unittest discover -s tests
+'''
+import os
+import random
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from glyph_index import GlyphIndex
+from glyph_table import GlyphTable
+
+STAFF_HEIGHT = 100
+
+
+def make_glyphs(num_glyphs, num_staves, seed=0):
+    # glyphs on neighbouring staves overlap vertically, and left edges repeat, so ties do come up
+    rng = random.Random(seed)
+    glyphs = []
+    for _ in range(num_glyphs):
+        staff = rng.randint(1, num_staves)
+        ulx = rng.randrange(0, 2000, 5)
+        glyphs.append({
+            'glyph': {
+                'name': 'neume.punctum',
+                'bounding_box': {
+                    'ulx': ulx,
+                    'uly': staff * STAFF_HEIGHT + rng.randint(-40, 60),
+                    'ncols': rng.randint(5, 60),
+                    'nrows': rng.randint(5, 40),
+                },
+            },
+            'pitch': {'staff': str(staff), 'offset': str(ulx), 'strt_pos': '5', 'octave': '3', 'note': 'c'},
+        })
+    return glyphs
+
+
+def flat_glyphs(table):
+    return [dict(table[pos], bounding_box=dict(table[pos]['bounding_box'])) for pos in range(len(table))]
+
+
+def scan_nearest_right(glyphs, x, y_low, y_high, first_pos=0):
+    '''
+    The linear scan nearest_right stands in for: the leftmost glyph from @first_pos on whose top
+    is strictly within the band and whose center is strictly to the right of @x.
+    '''
+    best = None
+    for pos in range(first_pos, len(glyphs)):
+        bb = glyphs[pos]['bounding_box']
+        if y_low < bb['uly'] < y_high and x < bb['ulx'] + bb['ncols'] // 2:
+            if best is None or bb['ulx'] < glyphs[best]['bounding_box']['ulx']:
+                best = pos
+    return best
+
+
+class TestGlyphIndex(unittest.TestCase):
+
+    def check_queries(self, glyphs, index, seed=0, num_queries=2000):
+        rng = random.Random(seed)
+        for _ in range(num_queries):
+            if rng.random() < 0.3:
+                # a query on the edges of an existing glyph
+                bb = glyphs[rng.randrange(len(glyphs))]['bounding_box']
+                x = bb['ulx'] + bb['ncols'] // 2 - rng.randint(0, 1)
+                y_high = bb['uly'] + rng.choice((0, 1, 50))
+            else:
+                x = rng.randint(-50, 2100)
+                y_high = rng.randint(0, (len(glyphs) // 20 + 2) * STAFF_HEIGHT)
+            y_low = y_high - rng.choice((1, 30, 150, 400))
+            first_pos = rng.randint(0, len(glyphs))
+            self.assertEqual(
+                index.nearest_right(x, y_low, y_high, first_pos),
+                scan_nearest_right(glyphs, x, y_low, y_high, first_pos),
+                'x {} y_low {} y_high {} first_pos {}'.format(x, y_low, y_high, first_pos))
+
+    def test_glyph_table(self):
+        for seed in range(5):
+            table = GlyphTable.from_jsomr(make_glyphs(400, 20, seed=seed))
+            self.check_queries(flat_glyphs(table), GlyphIndex(table), seed=seed)
+
+    def test_glyph_dicts(self):
+        glyphs = flat_glyphs(GlyphTable.from_jsomr(make_glyphs(400, 20, seed=1)))
+        self.check_queries(glyphs, GlyphIndex(glyphs), seed=1)
+
+    def test_single_staff(self):
+        table = GlyphTable.from_jsomr(make_glyphs(200, 1, seed=2))
+        self.check_queries(flat_glyphs(table), GlyphIndex(table), seed=2)
+
+    def test_empty_page(self):
+        index = GlyphIndex([])
+        self.assertEqual(len(index), 0)
+        self.assertIsNone(index.nearest_right(0, -1000, 1000))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+'''
+Checks that GlyphTable.from_jsomr gives the same glyphs as build_mei_file.add_flags_to_glyphs: the
+same field values, in the same order, with the same system_begin flags. Needs pymei and Rodan
+installed, as the jobs do; otherwise it is skipped. Run from the repository root:
+    python -m unittest discover -s tests
+'''
+import copy
+import random
+import unittest
+
+from test_mei_writer import bm, synthetic
+
+from glyph_table import GlyphRow, GlyphTable
+
+FIELDS = ('name', 'note', 'staff', 'offset', 'strt_pos', 'octave')
+BOX_FIELDS = ('ulx', 'uly', 'ncols', 'nrows', 'lrx', 'lry')
+
+
+def shuffled_page(seed):
+    # glyphs out of order, with pitch fields as strings or missing, and some sharing a staff and
+    # offset, so that the order among them depends on the sort being stable
+    rng = random.Random(seed)
+    glyphs = synthetic.make_jsomr(200, 5, seed=seed)['glyphs']
+    for g in rng.sample(glyphs, 40):
+        other = rng.choice(glyphs)
+        g['pitch']['staff'] = other['pitch']['staff']
+        g['pitch']['offset'] = str(other['pitch']['offset'])
+    for g in rng.sample(glyphs, 10):
+        g['pitch']['strt_pos'] = str(g['pitch']['strt_pos'])
+        g['pitch']['octave'] = None
+    rng.shuffle(glyphs)
+    return glyphs
+
+
+def expected(value, field):
+    # the table keeps staves, offsets and positions as integers, and what it can't read as one as None
+    if field in ('staff', 'offset', 'strt_pos', 'octave'):
+        return None if value is None else int(value)
+    return value
+
+
+@unittest.skipIf(bm is None, 'needs pymei and Rodan')
+class TestGlyphTable(unittest.TestCase):
+
+    def check(self, glyphs):
+        table = GlyphTable.from_jsomr(copy.deepcopy(glyphs))
+        dicts = bm.add_flags_to_glyphs(copy.deepcopy(glyphs))
+        self.assertEqual(len(table), len(dicts))
+        for i, (row, g) in enumerate(zip(table, dicts)):
+            for field in FIELDS:
+                self.assertEqual(row[field], expected(g[field], field), 'glyph {} {}'.format(i, field))
+            for field in BOX_FIELDS:
+                self.assertEqual(row['bounding_box'][field], g['bounding_box'][field], 'glyph {} {}'.format(i, field))
+            self.assertEqual(row['system_begin'], g['system_begin'], 'glyph {}'.format(i))
+
+    def test_synthetic_page(self):
+        self.check(synthetic.make_jsomr(300, 8)['glyphs'])
+
+    def test_shuffled_pages(self):
+        for seed in range(5):
+            self.check(shuffled_page(seed))
+
+    def test_empty_page(self):
+        self.check([])
+
+    def test_row_views(self):
+        table = GlyphTable.from_jsomr(shuffled_page(0))
+        self.assertEqual(table[3], table[3])
+        self.assertEqual(table[-1], table[len(table) - 1])
+        self.assertEqual(table[2:5], [GlyphRow(table, i) for i in range(2, 5)])
+        self.assertEqual(list(table)[7], table[7])
+        self.assertRaises(IndexError, lambda: table[len(table)])
+
+    def test_take(self):
+        table = GlyphTable.from_jsomr(shuffled_page(1))
+        positions = [4, 0, 9, 9]
+        taken = table.take(positions)
+        for row, i in zip(taken, positions):
+            for field in FIELDS + ('system_begin',):
+                self.assertEqual(row[field], table[i][field])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+'''
+Checks that incremental.encode_incremental reuses what it should on a rerun, re-encodes only the
+syllable group of a glyph that changed, and writes the same MEI as a fresh build_mei_file.process.
+Needs pymei and Rodan installed, as the jobs do; otherwise it is skipped. Run from the repository
+root:
+    python -m unittest discover -s tests
+'''
+import copy
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+from test_mei_writer import bm, make_classifier, make_page, number_ids
+
+if bm is not None:
+    import incremental
+    import parse_classifier_table as pct
+
+# a glyph in the middle of the third staff of make_page
+EDITED = 250
+
+
+def layer(text):
+    # the content of the layer, without its own tag
+    return text[text.index('>', text.index('<layer')) + 1:text.index('</layer>')]
+
+
+def read(fname):
+    with io.open(fname, 'r', encoding='utf-8', newline='') as f:
+        return f.read()
+
+
+@unittest.skipIf(bm is None, 'needs pymei and Rodan')
+class TestIncremental(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.output = os.path.join(self.tmp_dir, 'page.mei')
+        self.jsomr, self.syls = make_page()
+        # any alias will do; with one set, the settings saved with the state have to read back equal
+        self.classifier = pct.ClassifierResolver(make_classifier(self.tmp_dir), {'neume.unknown': 'neume'})
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def encode(self, jsomr, width_mult=0.5):
+        return incremental.encode_incremental(copy.deepcopy(jsomr), self.syls, self.classifier, width_mult,
+                                              self.output)
+
+    def fresh(self, jsomr, width_mult=0.5):
+        return bm.process(copy.deepcopy(jsomr), self.syls, self.classifier, width_mult)
+
+    def edited_page(self):
+        jsomr = copy.deepcopy(self.jsomr)
+        pitch = jsomr['glyphs'][EDITED]['pitch']
+        pitch['strt_pos'] = pitch['strt_pos'] % 9 + 1
+        return jsomr, pitch['staff']
+
+    def test_first_run(self):
+        result = self.encode(self.jsomr)
+        self.assertEqual(result.reused, 0)
+        self.assertEqual(result.reason, 'no previous run')
+        self.assertEqual(number_ids(read(self.output)), number_ids(self.fresh(self.jsomr)))
+
+    def test_unchanged_rerun(self):
+        first = self.encode(self.jsomr)
+        text = read(self.output)
+        result = self.encode(self.jsomr)
+        self.assertIsNone(result.reason)
+        self.assertEqual(result.encoded, 0)
+        self.assertEqual(result.reused, first.encoded)
+        self.assertEqual(result.changed_staves, [])
+        # all the same but the IDs of the elements around the layer, which are new every time
+        self.assertEqual(layer(read(self.output)), layer(text))
+        self.assertEqual(number_ids(read(self.output)), number_ids(self.fresh(self.jsomr)))
+
+    def test_one_glyph_edited(self):
+        first = self.encode(self.jsomr)
+        jsomr, staff = self.edited_page()
+        result = self.encode(jsomr)
+        self.assertIsNone(result.reason)
+        self.assertEqual(result.encoded, 1)
+        self.assertEqual(result.reused, first.encoded - 1)
+        self.assertEqual(result.changed_staves, [staff])
+        self.assertEqual(number_ids(read(self.output)), number_ids(self.fresh(jsomr)))
+
+    def test_edit_shares_a_later_zone(self):
+        # the edited glyph takes the bounding box of one a few syllables on, so the zone that the
+        # reused group after it had is now made by the group encoded again
+        self.encode(self.jsomr)
+        jsomr = copy.deepcopy(self.jsomr)
+        jsomr['glyphs'][EDITED]['glyph']['bounding_box'] = dict(jsomr['glyphs'][EDITED + 6]['glyph']['bounding_box'])
+        result = self.encode(jsomr)
+        self.assertIsNone(result.reason)
+        self.assertGreater(result.reused, 0)
+        self.assertEqual(number_ids(read(self.output)), number_ids(self.fresh(jsomr)))
+
+    def test_settings_changed(self):
+        self.encode(self.jsomr)
+        result = self.encode(self.jsomr, width_mult=2)
+        self.assertEqual(result.reason, 'page-wide settings changed')
+        self.assertEqual(result.reused, 0)
+        self.assertEqual(number_ids(read(self.output)), number_ids(self.fresh(self.jsomr, width_mult=2)))
+
+
+if __name__ == '__main__':
+    unittest.main()
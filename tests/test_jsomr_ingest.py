@@ -0,0 +1,110 @@
+'''
+Checks that jsomr_ingest's 'stream' backend reads JSOMR and text alignment files into the same
+glyphs, staves, page and syllable boxes as json.load followed by GlyphTable.from_jsomr, and that
+the page encodes the same either way. Needs pymei and Rodan installed, as the jobs do; otherwise
+it is skipped. Run from the repository root:
+    python -m unittest discover -s tests
+'''
+import copy
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from test_mei_writer import bm, make_classifier, make_page, number_ids
+
+import jsomr_ingest
+from glyph_table import GlyphTable
+
+COLUMNS = ('names', 'notes', 'staff', 'offset', 'strt_pos', 'octave', 'ulx', 'uly', 'ncols', 'nrows',
+           'lrx', 'lry', 'system_begin')
+
+
+def columns(table):
+    return dict((name, list(getattr(table, name))) for name in COLUMNS)
+
+
+@unittest.skipIf(bm is None, 'needs pymei and Rodan')
+class TestStreamBackend(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.jsomr, self.syls = make_page()
+        self.syls['syl_boxes'][1]['syl'] = u'\u017fanct\u00e6'
+        # fields the encoder never reads, which the stream backend skips over
+        self.jsomr['extra'] = {'nested': [1, 2.5, None, {'a': 'b'}], 'text': u'\u2627'}
+        self.syls['image'] = [[0, 1], [2, 3]]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write(self, name, data, **kwargs):
+        fname = os.path.join(self.tmp_dir, name)
+        with io.open(fname, 'w', encoding='utf-8') as f:
+            f.write(json.dumps(data, ensure_ascii=False, **kwargs))
+        return fname
+
+    def load_json(self, fname):
+        with io.open(fname, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def check(self, **kwargs):
+        jsomr_fname = self.write('page.json', self.jsomr, **kwargs)
+        syls_fname = self.write('syls.json', self.syls, **kwargs)
+
+        jsomr = jsomr_ingest.load_jsomr(jsomr_fname, 'stream')
+        expected = self.load_json(jsomr_fname)
+        self.assertEqual(columns(jsomr['glyphs']), columns(GlyphTable.from_jsomr(expected['glyphs'])))
+        self.assertEqual(jsomr['staves'], [{'bounding_box': s['bounding_box']} for s in expected['staves']])
+        self.assertEqual(jsomr['page'], {'bounding_box': expected['page']['bounding_box']})
+
+        syls = jsomr_ingest.load_alignment(syls_fname, 'stream')
+        expected_syls = self.load_json(syls_fname)
+        self.assertEqual(syls['median_line_spacing'], expected_syls['median_line_spacing'])
+        self.assertEqual(syls['syl_boxes'], expected_syls['syl_boxes'])
+
+        classifier = make_classifier(self.tmp_dir)
+        self.assertEqual(number_ids(bm.process(jsomr, syls, classifier, 0.5)),
+                         number_ids(bm.process(expected, expected_syls, classifier, 0.5)))
+
+    def test_compact(self):
+        self.check(separators=(',', ':'))
+
+    def test_indented(self):
+        self.check(indent=4)
+
+    def test_reader_chunks(self):
+        # values, and numbers in particular (median_line_spacing), cut across chunk boundaries of
+        # every size
+        self.syls['median_line_spacing'] = 123456.5
+        for fname in (self.write('page.json', self.jsomr, indent=1), self.write('syls.json', self.syls)):
+            expected = self.load_json(fname)
+            for chunk_size in (1, 2, 7, 64, 1000):
+                with io.open(fname, 'r', encoding='utf-8') as f:
+                    reader = jsomr_ingest._Reader(f, chunk_size)
+                    read = {}
+                    for key in reader.object_keys():
+                        read[key] = list(reader.array_items()) if key in ('glyphs', 'syl_boxes') else reader.value()
+                self.assertEqual(read, expected, '{} in chunks of {}'.format(os.path.basename(fname), chunk_size))
+
+    def test_missing_key(self):
+        jsomr = copy.deepcopy(self.jsomr)
+        del jsomr['page']
+        fname = self.write('page.json', jsomr)
+        self.assertRaises(ValueError, jsomr_ingest.load_jsomr, fname, 'stream')
+
+    def test_truncated_file(self):
+        fname = self.write('page.json', self.jsomr)
+        with open(fname, 'rb+') as f:
+            f.truncate(os.path.getsize(fname) // 2)
+        self.assertRaises(ValueError, jsomr_ingest.load_jsomr, fname, 'stream')
+
+    def test_unknown_backend(self):
+        fname = self.write('page.json', self.jsomr)
+        self.assertRaises(ValueError, jsomr_ingest.load_jsomr, fname, 'yaml')
+
+
+if __name__ == '__main__':
+    unittest.main()
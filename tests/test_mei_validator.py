@@ -0,0 +1,114 @@
+'''
+Checks that StructureValidator finds the same violations in a page whether it is run over the
+pymei document process() builds, fed the elements as the streaming writer writes them (one staff
+after the other or over staff workers), or run over the written file: none on a valid page, and
+every one of the faults a stage added to it otherwise. Needs pymei and Rodan installed, as the
+jobs do; otherwise it is skipped. Run from the repository root:
+    python -m unittest discover -s tests
+'''
+import collections
+import copy
+import os
+import shutil
+import tempfile
+import unittest
+
+from test_mei_writer import bm, make_classifier, make_page
+
+if bm is not None:
+    import mei_validator
+    import pipeline
+    from mei_validator import StructureValidator
+
+RULES = ('unresolved-facs', 'custos-in-sb', 'unpitched-nc', 'syllable-without-syl', 'empty-neume')
+
+
+def add_faults(groups, context):
+    # adds one of each kind of fault after every syllable
+    for group in groups:
+        if group.syllable is not None:
+            new = context.element_cls
+            group.elements.append(new('neume'))
+
+            syllable = new('syllable')
+            neume = new('neume')
+            nc = new('nc')
+            nc.addAttribute('facs', '#nowhere')
+            neume.addChild(nc)
+            syllable.addChild(neume)
+            group.elements.append(syllable)
+
+            sb = new('sb')
+            sb.addChild(new('custos'))
+            group.elements.append(sb)
+        yield group
+
+
+def rules(validator):
+    return collections.Counter(v.rule for v in validator.violations)
+
+
+@unittest.skipIf(bm is None, 'needs pymei and Rodan')
+class TestStructureValidator(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.classifier = make_classifier(self.tmp_dir)
+        self.jsomr, self.syls = make_page()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def encode(self, stages=None, **kwargs):
+        validator = StructureValidator(max_violations=100000)
+        result = bm.process(copy.deepcopy(self.jsomr), self.syls, self.classifier, 0.5, stages=stages,
+                            validator=validator, **kwargs)
+        self.assertEqual(validator.count, len(validator.violations))
+        return validator, result
+
+    def validators(self, stages=None):
+        # the validators of every way of encoding the page, and the number of syllables in it
+        fname = os.path.join(self.tmp_dir, 'page.mei')
+        dom, text = self.encode(stages)
+        streamed, _ = self.encode(stages, output_path=fname, output_format='compact')
+        written = mei_validator.validate_file(fname, max_violations=100000)
+        parallel, _ = self.encode(stages, output_path=fname, output_format='compact', staff_workers=2)
+        parallel_written = mei_validator.validate_file(fname, max_violations=100000)
+        return [dom, streamed, written, parallel, parallel_written], text.count('<syl ')
+
+    def test_valid_page(self):
+        validators, _ = self.validators()
+        for validator in validators:
+            self.assertEqual(validator.count, 0, validator.report())
+
+        meiDoc = bm.build_mei(
+            bm.neume_to_lyric_alignment(bm.add_flags_to_glyphs(copy.deepcopy(self.jsomr['glyphs'])),
+                                        self.syls['syl_boxes'], self.syls['median_line_spacing']),
+            self.classifier, self.jsomr['staves'], self.jsomr['page'])
+        self.assertEqual(mei_validator.validate_document(meiDoc).count, 0)
+
+    def test_faults(self):
+        stages = pipeline.Pipeline().append('faults', add_faults)
+        validators, syllables = self.validators(stages)
+        self.assertGreater(syllables, 0)
+        expected = collections.Counter(dict((rule, syllables) for rule in RULES))
+        for validator in validators:
+            self.assertEqual(rules(validator), expected)
+
+        # with compact IDs, the streamed violations name the same elements as the file's
+        streamed, written, parallel, parallel_written = validators[1:]
+        self.assertEqual(streamed.violations, written.violations)
+        self.assertEqual(sorted(parallel.violations), sorted(parallel_written.violations))
+        self.assertEqual(sorted(parallel.violations), sorted(streamed.violations))
+
+    def test_max_violations(self):
+        validator, _ = self.encode(pipeline.Pipeline().append('faults', add_faults))
+        limited = StructureValidator(max_violations=3)
+        for v in validator.violations:
+            limited.add(*v)
+        self.assertEqual((limited.count, limited.violations), (validator.count, validator.violations[:3]))
+        self.assertTrue(limited.report().endswith('... and {} more'.format(validator.count - 3)))
+
+
+if __name__ == '__main__':
+    unittest.main()
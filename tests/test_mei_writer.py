@@ -0,0 +1,126 @@
+'''
+Checks that the streaming writer gives the same MEI as building a pymei document and writing it
+with libmei's documentToText. Needs pymei (libmei's Python bindings) and Rodan installed, as the
+jobs do; otherwise it is skipped. Run from the repository root:
+    python -m unittest discover -s tests
+'''
+import copy
+import io
+import os
+import re
+import shutil
+import sys
+import tempfile
+import unittest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+import mei_writer
+from mei_writer import StreamElement, StreamingMeiWriter, element_to_text
+
+try:
+    import build_mei_file as bm
+    import parse_classifier_table as pct
+except ImportError:
+    bm = None
+
+import synthetic
+
+_RANDOM_ID = re.compile(r'm-[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}')
+
+
+def number_ids(text):
+    '''
+    Replaces the random IDs in the MEI @text with numbers in the order they first appear, so two
+    encodings of the same page can be compared.
+    '''
+    ids = {}
+    return _RANDOM_ID.sub(lambda m: ids.setdefault(m.group(0), 'id{}'.format(len(ids))), text)
+
+
+def make_page(num_glyphs=600, num_staves=6, seed=0):
+    # a page with every kind of glyph, and a syllable that has to be escaped
+    jsomr = synthetic.make_jsomr(num_glyphs, num_staves, seed=seed)
+    syls = synthetic.make_alignment(jsomr, seed=seed)
+    syls['syl_boxes'][0]['syl'] = 'a&<b>"c'
+    return jsomr, syls
+
+
+def make_classifier(tmp_dir):
+    fname = os.path.join(tmp_dir, 'mapping.csv')
+    synthetic.write_mapping_csv(fname)
+    return pct.load_classifier(fname, cache_dir=None)
+
+
+@unittest.skipIf(bm is None, 'needs pymei and Rodan')
+class TestStreamingParity(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.classifier = make_classifier(self.tmp_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def encode_both(self, width_mult, with_syls=True):
+        jsomr, syls = make_page()
+        if not with_syls:
+            syls = None
+        document = bm.process(copy.deepcopy(jsomr), syls, self.classifier, width_mult)
+        out_fname = os.path.join(self.tmp_dir, 'page.mei')
+        bm.process(copy.deepcopy(jsomr), syls, self.classifier, width_mult, output_path=out_fname)
+        with io.open(out_fname, 'r', encoding='utf-8', newline='') as f:
+            streamed = f.read()
+        return document, streamed
+
+    def test_same_as_document_to_text(self):
+        for width_mult in (0, 0.5, 2):
+            document, streamed = self.encode_both(width_mult)
+            self.assertEqual(number_ids(streamed), number_ids(document), 'width_mult {}'.format(width_mult))
+
+    def test_same_without_alignment(self):
+        document, streamed = self.encode_both(0.5, with_syls=False)
+        self.assertEqual(number_ids(streamed), number_ids(document))
+
+
+class TestLayerSpill(unittest.TestCase):
+    '''
+    Layer content past SPOOL_SIZE is spilled to a temporary file, which has to give back the same
+    text whatever the locale's encoding.
+    '''
+
+    def setUp(self):
+        self.spool_size = mei_writer.SPOOL_SIZE
+        mei_writer.SPOOL_SIZE = 1024
+
+    def tearDown(self):
+        mei_writer.SPOOL_SIZE = self.spool_size
+
+    def test_non_ascii_past_spool_size(self):
+        root = StreamElement('mei', 'm-root')
+        surface = StreamElement('surface', 'm-surface')
+        layer = StreamElement('layer', 'm-layer')
+        root.addChild(surface)
+        root.addChild(layer)
+        writer = StreamingMeiWriter(io.StringIO(), root, surface, layer)
+
+        layer_text = []
+        for i in range(200):
+            syl = StreamElement('syl', 'm-syl-{}'.format(i))
+            syl.value = u'\u017fanct\u00e6 \u2627 {}'.format(i)
+            layer_text.append(element_to_text(syl, 2))
+            writer.layer.addChild(syl)
+        layer_text = ''.join(layer_text)
+        self.assertGreater(len(layer_text), mei_writer.SPOOL_SIZE)
+        writer.close()
+
+        text = writer.out.getvalue()
+        self.assertEqual(len(text), writer.length)
+        self.assertEqual(text[writer.layer_start:writer.layer_start + len(layer_text)], layer_text)
+        self.assertTrue(text.endswith('  </layer>\n</mei>\n'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+'''
+Checks that NeumeMerger, which merges nearby neumes while each syllable is built, gives the same
+syllables as merge_nearby_neume_components reworking the finished document. Needs pymei and Rodan
+installed, as the jobs do; otherwise it is skipped. Run from the repository root:
+    python -m unittest discover -s tests
+'''
+import copy
+import random
+import shutil
+import tempfile
+import unittest
+
+from test_mei_writer import bm, make_classifier, make_page, number_ids
+
+if bm is not None:
+    from pymei import MeiElement, documentToText
+    from neume_merger import NeumeMerger
+    from zone_registry import ZoneRegistry
+
+
+def make_children(seed, zones):
+    # (element, bounding box) pairs for the children of one syllable: mostly neumes of one to
+    # three components, at gaps around the merging distance (or overlapping the one before), with
+    # clefs, custos and breaks between
+    rng = random.Random(seed)
+    children = []
+    x = rng.randint(0, 100)
+    for _ in range(rng.randint(0, 12)):
+        x += rng.randint(-60, 40)
+        width = rng.randint(5, 50)
+        bb = {'ulx': x, 'uly': 100, 'lrx': x + width, 'lry': 150}
+        x += width
+        kind = rng.choice(['neume'] * 6 + ['clef', 'custos', 'sb'])
+        el = MeiElement(kind)
+        if kind == 'neume':
+            for _ in range(rng.randint(1, 3)):
+                nc = MeiElement('nc')
+                nc.addAttribute('facs', '#' + zones.register(bb))
+                el.addChild(nc)
+        elif kind != 'sb':
+            el.addAttribute('facs', '#' + zones.register(bb))
+        children.append((el, bb if kind != 'sb' else None))
+    return children
+
+
+def shape(el):
+    return el.name, [(a.name, a.value) for a in el.attributes], [shape(c) for c in el.children]
+
+
+@unittest.skipIf(bm is None, 'needs pymei and Rodan')
+class TestNeumeMerger(unittest.TestCase):
+
+    def test_same_syllables(self):
+        merged = 0
+        for seed in range(300):
+            zones = ZoneRegistry(MeiElement('surface'), MeiElement)
+            max_distance = [-5, 0, 10, 20][seed % 4]
+
+            # the same children are made twice, one set for each way of merging them
+            expected = MeiElement('syllable')
+            for el, _ in make_children(seed, zones):
+                expected.addChild(el)
+            bm.merge_syllable_neumes(expected, zones, max_distance)
+
+            syllable = MeiElement('syllable')
+            merger = NeumeMerger(max_distance)
+            merger.begin(syllable)
+            children = make_children(seed, zones)
+            for el, bb in children:
+                merger.add(el, bb)
+
+            self.assertEqual(shape(syllable), shape(expected), 'seed {}'.format(seed))
+            self.assertEqual(merger.merged, len(children) - len(expected.children))
+            merged += merger.merged
+        self.assertGreater(merged, 0)
+
+
+@unittest.skipIf(bm is None, 'needs pymei and Rodan')
+class TestMergedPage(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.classifier = make_classifier(self.tmp_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_same_as_merging_the_document(self):
+        jsomr, syls = make_page()
+        for width_mult in (0.5, 1, 3):
+            glyphs = bm.add_flags_to_glyphs(copy.deepcopy(jsomr['glyphs']))
+            pairs = bm.neume_to_lyric_alignment(glyphs, syls['syl_boxes'], syls['median_line_spacing'])
+            zones = ZoneRegistry()
+            meiDoc = bm.build_mei(pairs, self.classifier, jsomr['staves'], jsomr['page'], zones)
+            bm.merge_nearby_neume_components(meiDoc, width_mult, zones)
+
+            merged = bm.process(copy.deepcopy(jsomr), syls, self.classifier, width_mult)
+            self.assertEqual(number_ids(merged), number_ids(documentToText(meiDoc)),
+                             'width_mult {}'.format(width_mult))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+'''
+Checks that the 'compact', 'minified' and 'gzip' output formats give the same MEI as the standard
+one, built as a pymei document and written with documentToText: the same elements, with short
+sequential IDs in place of random ones, and with the indentation left out when minified. Needs
+pymei and Rodan installed, as the jobs do; otherwise it is skipped. Run from the repository root:
+    python -m unittest discover -s tests
+'''
+import copy
+import gzip
+import os
+import re
+import shutil
+import tempfile
+import unittest
+
+from test_mei_writer import bm, make_classifier, make_page
+
+if bm is not None:
+    from mei_writer import ID_PREFIXES
+
+_ID = re.compile(r'xml:id="([^"]+)"')
+_ID_OR_REFERENCE = re.compile(r'(xml:id="|"#)([^"]+)"')
+_ELEMENT_ID = re.compile(r'<(\w+) xml:id="([^"]+)"')
+
+
+def renumber(text):
+    '''
+    Replaces every ID in the MEI @text, and every reference to one, with a number in the order the
+    elements appear, whatever form the IDs took.
+    '''
+    ids = dict((element_id, 'id{}'.format(i)) for i, element_id in enumerate(_ID.findall(text)))
+    return _ID_OR_REFERENCE.sub(lambda m: '{}{}"'.format(m.group(1), ids[m.group(2)]), text)
+
+
+def unindent(text):
+    return ''.join(line.strip() for line in text.splitlines())
+
+
+@unittest.skipIf(bm is None, 'needs pymei and Rodan')
+class TestOutputFormats(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.classifier = make_classifier(self.tmp_dir)
+        self.jsomr, self.syls = make_page()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def encode(self, output_format=None, width_mult=0.5, **kwargs):
+        return bm.process(copy.deepcopy(self.jsomr), self.syls, self.classifier, width_mult,
+                          output_format=output_format, **kwargs)
+
+    def test_compact(self):
+        for width_mult in (0, 0.5, 2):
+            standard = self.encode(width_mult=width_mult)
+            compact = self.encode('compact', width_mult)
+            self.assertEqual(renumber(compact), renumber(standard), 'width_mult {}'.format(width_mult))
+            self.assertEqual(self.encode('compact', width_mult), compact)
+
+    def test_compact_ids(self):
+        compact = self.encode('compact')
+        numbers = []
+        for name, element_id in _ELEMENT_ID.findall(compact):
+            prefix = ID_PREFIXES.get(name, name)
+            self.assertTrue(element_id.startswith(prefix) and element_id[len(prefix):].isdigit(), element_id)
+            numbers.append(int(element_id[len(prefix):]))
+        # numbered in the order the elements were made, so neumes merged away leave gaps
+        self.assertEqual(len(set(numbers)), len(numbers))
+
+    def test_minified(self):
+        compact = self.encode('compact')
+        minified = self.encode('minified')
+        self.assertNotIn('\n', minified)
+        self.assertEqual(minified, unindent(compact))
+        self.assertEqual(renumber(minified), unindent(renumber(self.encode())))
+
+    def test_gzip(self):
+        fname = os.path.join(self.tmp_dir, 'page.mei.gz')
+        self.assertIsNone(self.encode('gzip', output_path=fname))
+        with gzip.open(fname, 'rb') as f:
+            self.assertEqual(f.read().decode('utf-8'), self.encode('minified'))
+        self.assertRaises(ValueError, self.encode, 'gzip')
+
+    def test_unknown_format(self):
+        self.assertRaises(ValueError, self.encode, 'pretty')
+
+
+if __name__ == '__main__':
+    unittest.main()
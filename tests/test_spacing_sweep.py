@@ -0,0 +1,62 @@
+'''
+Checks that spacing_sweep.sweep writes, for every Neume Component Spacing value, the same MEI as
+build_mei_file.process gives with that value, and counts the neumes in it right. Needs pymei and
+Rodan installed, as the jobs do; otherwise it is skipped. Run from the repository root:
+    python -m unittest discover -s tests
+'''
+import copy
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+from test_mei_writer import bm, make_classifier, make_page, number_ids
+
+if bm is not None:
+    import spacing_sweep
+
+WIDTH_MULTS = [0, 0.25, 0.5, 1, 2, 5]
+
+
+def read(fname):
+    with io.open(fname, 'r', encoding='utf-8', newline='') as f:
+        return f.read()
+
+
+@unittest.skipIf(bm is None, 'needs pymei and Rodan')
+class TestSpacingSweep(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.classifier = make_classifier(self.tmp_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def check(self, jsomr, syls):
+        paths = [os.path.join(self.tmp_dir, '{}.mei'.format(m)) for m in WIDTH_MULTS]
+        summary = spacing_sweep.sweep(copy.deepcopy(jsomr), syls, self.classifier, WIDTH_MULTS, paths)
+        self.assertEqual([s['width_mult'] for s in summary], WIDTH_MULTS)
+
+        for m, path, s in zip(WIDTH_MULTS, paths, summary):
+            expected = bm.process(copy.deepcopy(jsomr), syls, self.classifier, m)
+            swept = read(path)
+            self.assertEqual(number_ids(swept), number_ids(expected), 'width_mult {}'.format(m))
+            self.assertEqual(s['neumes'], swept.count('<neume '), 'width_mult {}'.format(m))
+
+        # merging only ever takes neumes away
+        neumes = [s['neumes'] for s in summary]
+        self.assertEqual(neumes, sorted(neumes, reverse=True))
+        self.assertGreater(neumes[0], neumes[-1])
+
+    def test_same_as_process(self):
+        self.check(*make_page())
+
+    def test_without_alignment(self):
+        jsomr, _ = make_page(seed=1)
+        self.check(jsomr, None)
+
+
+if __name__ == '__main__':
+    unittest.main()
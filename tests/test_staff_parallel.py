@@ -0,0 +1,62 @@
+'''
+Checks that encoding a page with its staves split over worker processes gives the same MEI as
+encoding them one after the other, with both random and sequential IDs. Needs pymei and Rodan
+installed, as the jobs do; otherwise it is skipped. Run from the repository root:
+    python -m unittest discover -s tests
+'''
+import copy
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+from test_mei_writer import bm, make_classifier, make_page, number_ids
+
+
+@unittest.skipIf(bm is None, 'needs pymei and Rodan')
+class TestStaffParallel(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.classifier = make_classifier(self.tmp_dir)
+        self.jsomr, self.syls = make_page()
+        # a glyph put on a later staff with the same box as one on the first, so the two staves
+        # share a zone that only the stitching can deduplicate
+        shared = copy.deepcopy(self.jsomr['glyphs'][1])
+        shared['pitch']['staff'] = '4'
+        self.jsomr['glyphs'].append(shared)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def encode(self, width_mult, output_format, staff_workers=None):
+        return bm.process(copy.deepcopy(self.jsomr), self.syls, self.classifier, width_mult,
+                          output_format=output_format, staff_workers=staff_workers)
+
+    def test_random_ids(self):
+        for output_format in (None, 'standard'):
+            for width_mult in (0, 0.5):
+                serial = self.encode(width_mult, output_format)
+                parallel = self.encode(width_mult, output_format, staff_workers=2)
+                self.assertEqual(number_ids(parallel), number_ids(serial),
+                                 'format {} width_mult {}'.format(output_format, width_mult))
+
+    def test_sequential_ids(self):
+        for output_format in ('compact', 'minified'):
+            for width_mult in (0, 0.5):
+                serial = self.encode(width_mult, output_format)
+                parallel = self.encode(width_mult, output_format, staff_workers=2)
+                self.assertEqual(parallel, serial, 'format {} width_mult {}'.format(output_format, width_mult))
+
+    def test_to_file(self):
+        serial = self.encode(0.5, 'compact')
+        out_fname = os.path.join(self.tmp_dir, 'page.mei')
+        bm.process(copy.deepcopy(self.jsomr), self.syls, self.classifier, 0.5, output_path=out_fname,
+                   output_format='compact', staff_workers=2)
+        with io.open(out_fname, 'r', encoding='utf-8', newline='') as f:
+            self.assertEqual(f.read(), serial)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,137 @@
+'''
+Checks that encoding glyphs from the templates compiled by parse_classifier_table.compile_classifier
+gives the same elements as reading the ElementTree snippets of the mapping CSV directly, as the
+encoder did before templates, resolving the pitch of every neume component from the one before
+it. Needs pymei and Rodan installed, as the jobs do; otherwise it is skipped. Run from the
+repository root:
+    python -m unittest discover -s tests
+'''
+import csv
+import os
+import shutil
+import tempfile
+import unittest
+import xml.etree.ElementTree as ET
+
+from test_mei_writer import bm, synthetic
+
+if bm is not None:
+    import parse_classifier_table as pct
+    from pymei import MeiElement
+    from zone_registry import ZoneRegistry
+
+SCALE = ['c', 'd', 'e', 'f', 'g', 'a', 'b']
+
+# snippets with intervals written in other ways, static attributes that are never written, and
+# pitched attributes already set in the snippet
+ODD_MAPPING = [
+    ('neume.odd1', '<neume><nc intm="2S" tilt="n"/><nc intm="-3s"/><nc intm="up"/><nc intm="4"/></neume>'),
+    ('neume.odd2', '<neume><nc pname="d" oct="9"/><nc ligated="None" intm="-1S"/><nc/></neume>'),
+    ('clef.odd', '<clef line="4" shape="C" oct="2"/>'),
+    ('custos.odd', '<custos form="None"/>'),
+    ('accid.odd', '<accid accid="f" intm="2S"/>'),
+]
+
+
+def dom_element(xml, glyph, zones, previous=None):
+    # one element, straight from its ElementTree snippet; the pitch of a component after the
+    # first is its @intm away from the one before it
+    attribs = dict(xml.attrib)
+    if xml.tag == 'clef':
+        attribs['line'] = str(glyph['strt_pos'])
+    attribs['oct'] = str(glyph['octave'])
+    attribs['pname'] = str(glyph['note'])
+    if previous is not None:
+        attribs['pname'], attribs['oct'] = resolve_interval(previous, pct.parse_interval(xml.get('intm')))
+        attribs.pop('intm', None)
+
+    el = MeiElement(xml.tag)
+    for key, value in attribs.items():
+        if value != 'None':
+            el.addAttribute(key, str(value))
+    el.addAttribute('facs', '#' + zones.register(glyph['bounding_box']))
+    return el
+
+
+def resolve_interval(previous, interval):
+    index = SCALE.index(previous.getAttribute('pname').value) + interval
+    octave = int(previous.getAttribute('oct').value) + index // len(SCALE)
+    return SCALE[index % len(SCALE)], str(octave)
+
+
+def dom_glyph_to_element(table, glyph, zones):
+    xml = table.get(glyph['name'])
+    if xml is None:
+        return None
+    if not list(xml):
+        return dom_element(xml, glyph, zones)
+
+    els = []
+    for nc in xml:
+        els.append(dom_element(nc, glyph, zones, els[-1] if els else None))
+    parent = MeiElement(xml.tag)
+    parent.setChildren(els)
+    return parent
+
+
+def shape(el, zones):
+    # the element as comparable data, with its zone as the bounding box it stands for
+    attribs = {}
+    for attribute in el.attributes:
+        value = attribute.value
+        if attribute.name == 'facs':
+            value = zones[value[1:]]
+        attribs[attribute.name] = value
+    return el.name, attribs, [shape(c, zones) for c in el.children]
+
+
+@unittest.skipIf(bm is None, 'needs pymei and Rodan')
+class TestCompiledTemplates(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        fname = os.path.join(self.tmp_dir, 'mapping.csv')
+        with open(fname, 'w') as f:
+            writer = csv.writer(f)
+            writer.writerow(['classification', 'mei'])
+            for name, mei in synthetic.MAPPING + ODD_MAPPING:
+                writer.writerow([name, mei])
+        self.table = pct.fetch_table_from_csv(fname)
+        self.compiled = pct.compile_classifier(self.table)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def glyphs(self):
+        jsomr = synthetic.make_jsomr(400, 4, ligature_density=0.5)
+        names = [name for name, _ in ODD_MAPPING]
+        for i, g in enumerate(jsomr['glyphs']):
+            if i % 7 == 0:
+                g['glyph']['name'] = names[i // 7 % len(names)]
+        return bm.add_flags_to_glyphs(jsomr['glyphs'])
+
+    def test_same_elements(self):
+        for glyph in self.glyphs():
+            zones = ZoneRegistry(MeiElement('surface'), MeiElement)
+            expected = shape(dom_glyph_to_element(self.table, glyph, zones), zones)
+            el = bm.glyph_to_element(self.compiled, glyph, zones)
+            self.assertEqual(shape(el, zones), expected, glyph['name'])
+
+    def test_snippets_left_as_they_were(self):
+        # the templates are compiled once, and encoding glyphs with them never writes into the snippets
+        before = dict((name, ET.tostring(xml)) for name, xml in self.table.items())
+        zones = ZoneRegistry(MeiElement('surface'), MeiElement)
+        for glyph in self.glyphs():
+            bm.glyph_to_element(self.compiled, glyph, zones)
+        self.assertEqual(dict((name, ET.tostring(xml)) for name, xml in self.table.items()), before)
+
+    def test_unknown_class(self):
+        glyph = self.glyphs()[0]
+        glyph['name'] = 'mystery'
+        zones = ZoneRegistry(MeiElement('surface'), MeiElement)
+        self.assertIsNone(bm.glyph_to_element(self.compiled, glyph, zones))
+        self.assertEqual(len(zones.surface.children), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+'''
+Checks that glyph classes missing from the classifier, and neumes whose pitch is not in the scale,
+are reported once per page, to the logger given, and that the classes are counted the same in the
+instrumentation's metrics, whether the staves are encoded one after the other or over worker
+processes. Needs pymei and Rodan installed, as the jobs do;
+otherwise it is skipped. Run from the repository root:
+    python -m unittest discover -s tests
+'''
+import copy
+import logging
+import shutil
+import tempfile
+import unittest
+
+from test_mei_writer import bm, make_classifier, make_page
+
+if bm is not None:
+    from instrumentation import Instrumentation
+
+# positions of glyphs on the first, second and fifth staves of make_page, and their new classes
+UNKNOWN = [(5, 'mystery.a'), (150, 'mystery.b'), (450, 'mystery.a')]
+
+# positions of neumes of more than one component on the same staves, and their new notes
+OUT_OF_SCALE = [(2, 'h'), (149, 'h'), (448, 'x')]
+
+
+@unittest.skipIf(bm is None, 'needs pymei and Rodan')
+class TestUnknownClasses(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.classifier = make_classifier(self.tmp_dir)
+        self.jsomr, self.syls = make_page()
+        for pos, name in UNKNOWN:
+            self.jsomr['glyphs'][pos]['glyph']['name'] = name
+        self.logger = logging.getLogger('test_unknown_classes')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def out_of_scale(self):
+        for pos, note in OUT_OF_SCALE:
+            self.jsomr['glyphs'][pos]['pitch']['note'] = note
+
+    def encode(self, staff_workers=None):
+        metrics = []
+        with self.assertLogs(self.logger, logging.WARNING) as logs:
+            bm.process(copy.deepcopy(self.jsomr), self.syls, self.classifier, 0.5,
+                       instrumentation=Instrumentation([metrics.append], logger=self.logger),
+                       staff_workers=staff_workers, logger=self.logger)
+        return logs.output, metrics[0]
+
+    def check(self, staff_workers=None):
+        warnings, metrics = self.encode(staff_workers)
+        self.assertEqual(len(warnings), 1, warnings)
+        self.assertIn('3 glyphs of 2 classes', warnings[0])
+        self.assertEqual(dict(metrics.unknown_names), {'mystery.a': 2, 'mystery.b': 1})
+        self.assertEqual(metrics.counts['unknown_glyphs'], 3)
+
+    def test_serial(self):
+        self.check()
+
+    def test_staff_workers(self):
+        self.check(staff_workers=2)
+
+    def check_out_of_scale(self, staff_workers=None):
+        self.out_of_scale()
+        warnings, metrics = self.encode(staff_workers)
+        self.assertEqual(len(warnings), 2, warnings)
+        self.assertIn('3 glyphs of 2 classes', warnings[0])
+        self.assertIn('3 neumes with pitches not in scale', warnings[1])
+        self.assertEqual(metrics.counts['unknown_glyphs'], 3)
+
+    def test_out_of_scale(self):
+        self.check_out_of_scale()
+
+    def test_out_of_scale_staff_workers(self):
+        self.check_out_of_scale(staff_workers=2)
+
+
+if __name__ == '__main__':
+    unittest.main()
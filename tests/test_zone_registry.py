@@ -0,0 +1,132 @@
+'''
+Checks that ZoneRegistry writes every distinct bounding box as a zone only once, while keeping
+the widths the merging heuristic takes its median over the same as when every registration made a
+zone of its own in the surface, as the encoder did before. Needs pymei and Rodan installed, as the
+jobs do; otherwise it is skipped. Run from the repository root:
+    python -m unittest discover -s tests
+'''
+import copy
+import random
+import shutil
+import tempfile
+import unittest
+
+from test_mei_writer import bm, make_classifier, make_page
+
+if bm is not None:
+    from pymei import MeiElement
+    from zone_registry import Zone, ZoneRegistry
+
+
+def make_boxes(num_boxes, seed=0):
+    # few distinct boxes, so most come up more than once
+    rng = random.Random(seed)
+    distinct = []
+    for _ in range(num_boxes // 4 + 1):
+        ulx, uly = rng.randint(0, 2000), rng.randint(0, 3000)
+        distinct.append({'ulx': ulx, 'uly': uly, 'lrx': ulx + rng.randint(1, 80), 'lry': uly + rng.randint(1, 80)})
+    return [dict(rng.choice(distinct)) for _ in range(num_boxes)]
+
+
+def one_zone_per_box(boxes):
+    # a surface with a zone for every registration, duplicates and all
+    surface = MeiElement('surface')
+    for bb in boxes:
+        el = MeiElement('zone')
+        for name in Zone._fields:
+            el.addAttribute(name, str(bb[name]))
+        surface.addChild(el)
+    return surface
+
+
+def as_zone(bb):
+    return Zone(*(bb[name] for name in Zone._fields))
+
+
+def geometry(el):
+    coords = dict((a.name, int(a.value)) for a in el.attributes)
+    return Zone(*(coords[name] for name in Zone._fields))
+
+
+@unittest.skipIf(bm is None, 'needs pymei and Rodan')
+class TestZoneRegistry(unittest.TestCase):
+
+    def test_one_zone_per_distinct_box(self):
+        boxes = make_boxes(300)
+        zones = ZoneRegistry(MeiElement('surface'), MeiElement)
+        ids = [zones.register(bb) for bb in boxes]
+
+        seen = []
+        for bb in boxes:
+            if as_zone(bb) not in seen:
+                seen.append(as_zone(bb))
+        self.assertEqual(len(zones.surface.children), len(seen))
+        self.assertEqual([geometry(el) for el in zones.surface.children], seen)
+        self.assertEqual(len(zones), len(seen))
+        for zone_id, bb in zip(ids, boxes):
+            self.assertEqual(zones[zone_id], as_zone(bb))
+            self.assertEqual(zones.get_id(bb), zone_id)
+
+    def test_widths_as_with_a_zone_per_box(self):
+        boxes = make_boxes(301, seed=1)
+        zones = ZoneRegistry(MeiElement('surface'), MeiElement)
+        for bb in boxes:
+            zones.register(bb)
+        widths = [z.lrx - z.ulx for z in map(geometry, one_zone_per_box(boxes).children)]
+        # lengths first, since a diff of the whole lists would take long to show
+        self.assertEqual(len(zones.widths), len(widths))
+        self.assertEqual(zones.widths, widths)
+        self.assertEqual(bm.merge_threshold(zones.widths, 0.5), bm.merge_threshold(widths, 0.5))
+
+    def test_from_surface(self):
+        boxes = make_boxes(100, seed=2)
+        surface = one_zone_per_box(boxes)
+        zones = ZoneRegistry.from_surface(surface)
+        self.assertEqual(len(zones.widths), len(boxes))
+        self.assertEqual(zones.widths, [bb['lrx'] - bb['ulx'] for bb in boxes])
+        for el in surface.children:
+            self.assertEqual(zones[el.id], geometry(el))
+            # a box that appears more than once is found as its first zone
+            first = next(c for c in surface.children if geometry(c) == geometry(el))
+            self.assertEqual(zones.get_id(dict(geometry(el)._asdict())), first.id)
+
+    def test_add(self):
+        zones = ZoneRegistry(MeiElement('surface'), MeiElement)
+        bb = {'ulx': 1, 'uly': 2, 'lrx': 30, 'lry': 40}
+        zones.add('z-given', bb)
+        self.assertEqual(zones.register(bb), 'z-given')
+        self.assertEqual(zones.widths, [29, 29])
+        self.assertEqual(len(zones.surface.children), 0)
+
+
+@unittest.skipIf(bm is None, 'needs pymei and Rodan')
+class TestEncodedZones(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.classifier = make_classifier(self.tmp_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_encoded_page(self):
+        jsomr, syls = make_page()
+        glyphs = bm.add_flags_to_glyphs(copy.deepcopy(jsomr['glyphs']))
+        pairs = bm.neume_to_lyric_alignment(glyphs, syls['syl_boxes'], syls['median_line_spacing'])
+        zones = ZoneRegistry()
+        meiDoc = bm.build_mei(pairs, self.classifier, jsomr['staves'], jsomr['page'], zones)
+
+        surface = meiDoc.getElementsByName('surface')[0]
+        geometries = [geometry(el) for el in surface.children]
+        self.assertEqual(len(set(geometries)), len(geometries))
+
+        # every reference to a zone is one registration, which used to be a zone of its own
+        references = [el.getAttribute('facs').value[1:] for el in meiDoc.getRootElement().getDescendants()
+                      if el.hasAttribute('facs')]
+        self.assertEqual(len(zones.widths), len(references))
+        self.assertEqual(sorted(zones.widths), sorted(zones[ref].lrx - zones[ref].ulx for ref in references))
+        self.assertGreater(len(references), len(geometries))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,86 +1,297 @@
-import numpy as np
-from PIL import Image, ImageDraw, ImageFont, ImageOps
-from pymei import MeiDocument, MeiElement, MeiAttribute, documentToText, documentToFile
+import csv
+import os
+import sys
+import traceback
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image, ImageDraw
+from zone_registry import Zone, ZoneRegistry
 
 # This file contains only functions for drawing out intermediate results of the alignment, for
 # use when developing; nothing here is called in the rodan job.
+#
+# Drawing happens in two steps: the geometry to draw is first collected into an Overlay (boxes
+# and lines in page coordinates), which is then drawn in one go onto the page image, optionally
+# scaled down or split into tiles. Greyscale scans are drawn on as they are rather than converted
+# to RGB. Tiles are only a way of getting the result in pieces that image viewers handle easily:
+# the whole page is still decoded at once, so they don't lower the memory needed to draw it.
+
+MEI_NS = '{http://www.music-encoding.org/ns/mei}'
+XML_ID = '{http://www.w3.org/XML/1998/namespace}id'
+
+# a page to render with draw_mei_files: the page image, its MEI file, and the image to write
+OverlayPage = namedtuple('OverlayPage', ['png', 'mei', 'output'])
 
 
-def draw_neume_alignment(in_png, out_fname, pairs, text_size=60):
+class Overlay(object):
     '''
-    Given the pairs from neume_to_lyric_alignment, draws the result on the original page (given a
-    path to the .png)
+    The boxes and lines to draw over a page, in page coordinates, each as an (x0, y0, x1, y1)
+    tuple along with its line width.
     '''
-    fnt = ImageFont.truetype('FreeMono.ttf', text_size)
-    im = Image.open(in_png).convert('RGB')
-    draw = ImageDraw.Draw(im)
 
-    last_text = None
+    def __init__(self):
+        self.boxes = []
+        self.lines = []
+
+    def add_box(self, ulx, uly, lrx, lry, width=1):
+        self.boxes.append(((ulx, uly, lrx, lry), width))
+
+    def add_line(self, x0, y0, x1, y1, width=1):
+        self.lines.append(((x0, y0, x1, y1), width))
+
+
+def neume_alignment_overlay(pairs):
+    '''
+    Collects the pairs from neume_to_lyric_alignment into an Overlay: every text box, and a line
+    from each glyph (other than clefs and custos) up to the text box it was aligned to.
+    '''
+    overlay = Overlay()
     for gs, tb in pairs:
         if not tb:
             continue
 
-        draw.rectangle(tb['ul'] + tb['lr'], outline='black')
-        # draw.text(tb['ul'], tb['syl'], font=fnt, fill='gray')
+        overlay.add_box(tb['ul'][0], tb['ul'][1], tb['lr'][0], tb['lr'][1])
+        pt2 = ((tb['ul'][0] + tb['lr'][0]) // 2, (tb['ul'][1] + tb['lr'][1]) // 2)
         for g in gs:
-
             if 'clef' in g['name'] or 'custos' in g['name']:
                 continue
 
             bb = g['bounding_box']
             pt1 = (bb['ulx'] + bb['ncols'] // 2, bb['uly'] + bb['nrows'] // 2)
-            pt2 = ((tb['ul'][0] + tb['lr'][0]) // 2, (tb['ul'][1] + tb['lr'][1]) // 2)
-
             if pt1[1] > pt2[1]:
                 continue
+            overlay.add_line(pt1[0], pt1[1], pt2[0], pt2[1], width=5)
+    return overlay
+
+
+def _add_syllable(overlay, syl_zone, neume_zones):
+    # a box around each neume, and a line from it to its syllable's text
+    if syl_zone is not None:
+        syl_x = (syl_zone.ulx + syl_zone.lrx) // 2
+        syl_y = (syl_zone.uly + syl_zone.lry) // 2
+    for nc_zones in neume_zones:
+        if not nc_zones:
+            continue
+        ulx = min(z.ulx for z in nc_zones)
+        uly = min(z.uly for z in nc_zones)
+        lrx = max(z.lrx for z in nc_zones)
+        lry = max(z.lry for z in nc_zones)
+        overlay.add_box(ulx, uly, lrx, lry)
+
+        # don't draw a line to a blank syllable
+        if syl_zone is None or not syl_x or not syl_y:
+            continue
+        overlay.add_line((ulx + lrx) // 2, (uly + lry) // 2, syl_x, syl_y, width=3)
+
 
-            draw.line((pt1, pt2), fill='black', width=5)
-    im.save(out_fname)
+def _zone(zones, el):
+    facs = el.getAttribute('facs')
+    if facs is None:
+        return None
+    return zones[facs.value[1:]]
 
 
-def draw_mei_doc(in_png, out_fname, meiDoc, text_size=60):
+def mei_doc_overlay(meiDoc, zones=None):
     '''
-    Given an encoded mei_doc result, draws the result on the original page (given a
-    path to the .png)
+    Collects an encoded pymei document into an Overlay: a box around every neume, and a line from
+    it to the text of its syllable. @zones is the ZoneRegistry the document was built with, if
+    available; otherwise it is built from the document's surface, once.
     '''
+    if zones is None:
+        zones = ZoneRegistry.from_surface(meiDoc.getElementsByName('surface')[0])
+
+    overlay = Overlay()
+    for syllable in meiDoc.getElementsByName('syllable'):
+        syl_zone = None
+        neume_zones = []
+        for child in syllable.children:
+            if child.name == 'syl' and syl_zone is None:
+                syl_zone = _zone(zones, child)
+            elif child.name == 'neume':
+                nc_zones = (_zone(zones, nc) for nc in child.children)
+                neume_zones.append([z for z in nc_zones if z is not None])
+        _add_syllable(overlay, syl_zone, neume_zones)
+    return overlay
+
+
+def mei_file_overlay(fname):
+    '''
+    Same as mei_doc_overlay, but reading the MEI file @fname directly, one element at a time,
+    without building a pymei document. Zones come before the music in MEI, so each syllable can be
+    drawn as soon as it has been read.
+    '''
+    import xml.etree.ElementTree as ET
+
+    zones = {}
+    overlay = Overlay()
+    for _, el in ET.iterparse(fname):
+        tag = el.tag[len(MEI_NS):] if el.tag.startswith(MEI_NS) else el.tag
+        if tag == 'zone':
+            zones[el.get(XML_ID)] = Zone(*(int(el.get(k)) for k in Zone._fields))
+        elif tag == 'syllable':
+            syl_zone = None
+            neume_zones = []
+            for child in el:
+                child_tag = child.tag[len(MEI_NS):]
+                facs = child.get('facs')
+                if child_tag == 'syl' and syl_zone is None and facs:
+                    syl_zone = zones[facs[1:]]
+                elif child_tag == 'neume':
+                    neume_zones.append([zones[nc.get('facs')[1:]] for nc in child if nc.get('facs')])
+            _add_syllable(overlay, syl_zone, neume_zones)
+            el.clear()
+    return overlay
 
-    fnt = ImageFont.truetype('FreeMono.ttf', text_size)
-    im = Image.open(in_png).convert('RGB')
+
+def load_page(in_png, scale=1.0):
+    '''
+    Opens the page image @in_png for drawing, scaled by @scale. Greyscale and bilevel scans are
+    kept as greyscale rather than converted to RGB, since everything is drawn in black, and the
+    image is scaled down before anything else is done with it.
+    '''
+    im = Image.open(in_png)
+    if scale != 1:
+        size = (max(1, int(im.width * scale)), max(1, int(im.height * scale)))
+        # lets decoders that can (e.g. JPEG) decode at a lower resolution straight away
+        im.draft(None, size)
+    if im.mode not in ('L', 'RGB'):
+        im = im.convert('RGB' if im.mode in ('RGBA', 'P', 'CMYK') else 'L')
+    if scale != 1 and im.size != size:
+        im = im.resize(size, Image.BILINEAR)
+    return im
+
+
+def draw_overlay(im, overlay, scale=1.0, origin=(0, 0)):
+    '''
+    Draws the @overlay onto the image @im, which shows the page scaled by @scale, with its top
+    left corner at @origin in scaled coordinates (e.g. the corner of a tile).
+    '''
     draw = ImageDraw.Draw(im)
+    ox, oy = origin
+
+    def scaled(coords):
+        return (
+            coords[0] * scale - ox, coords[1] * scale - oy,
+            coords[2] * scale - ox, coords[3] * scale - oy,
+        )
+
+    for coords, width in overlay.boxes:
+        draw.rectangle(scaled(coords), outline='black', width=max(1, int(round(width * scale))))
+    for coords, width in overlay.lines:
+        draw.line(scaled(coords), fill='black', width=max(1, int(round(width * scale))))
+
+
+def _tile_overlays(overlay, scale, tile_size):
+    # buckets every primitive into the tiles it overlaps, by (column, row)
+    tiles = {}
+
+    def bucket(coords, width, kind):
+        margin = width * scale
+        x0, x1 = sorted((coords[0] * scale, coords[2] * scale))
+        y0, y1 = sorted((coords[1] * scale, coords[3] * scale))
+        for col in range(max(0, int((x0 - margin) // tile_size)), int((x1 + margin) // tile_size) + 1):
+            for row in range(max(0, int((y0 - margin) // tile_size)), int((y1 + margin) // tile_size) + 1):
+                tile = tiles.get((col, row))
+                if tile is None:
+                    tile = tiles[col, row] = Overlay()
+                getattr(tile, kind).append((coords, width))
+
+    for coords, width in overlay.boxes:
+        bucket(coords, width, 'boxes')
+    for coords, width in overlay.lines:
+        bucket(coords, width, 'lines')
+    return tiles
+
+
+def draw_page(in_png, out_fname, overlay, scale=1.0, tile_size=None):
+    '''
+    Draws @overlay over the page image @in_png, scaled by @scale, and saves it to @out_fname.
+
+    With @tile_size, the scaled page is instead cut into tiles of that many pixels square, each
+    saved as <out_fname>_<column>_<row>.<ext> with only what overlaps it drawn on it (the page is
+    decoded whole either way). Returns the paths written.
+    '''
+    im = load_page(in_png, scale)
+    if tile_size is None:
+        draw_overlay(im, overlay, scale)
+        im.save(out_fname)
+        return [out_fname]
+
+    stem, ext = os.path.splitext(out_fname)
+    tiles = _tile_overlays(overlay, scale, tile_size)
+    written = []
+    for row in range(0, (im.height + tile_size - 1) // tile_size):
+        for col in range(0, (im.width + tile_size - 1) // tile_size):
+            box = (col * tile_size, row * tile_size,
+                   min(im.width, (col + 1) * tile_size), min(im.height, (row + 1) * tile_size))
+            tile = im.crop(box)
+            if (col, row) in tiles:
+                draw_overlay(tile, tiles[col, row], scale, box[:2])
+            fname = '{}_{}_{}{}'.format(stem, col, row, ext)
+            tile.save(fname)
+            written.append(fname)
+    return written
+
+
+def draw_neume_alignment(in_png, out_fname, pairs, text_size=60, scale=1.0, tile_size=None):
+    '''
+    Given the pairs from neume_to_lyric_alignment, draws the result on the original page (given a
+    path to the .png), scaled or tiled as in draw_page.
+    '''
+    return draw_page(in_png, out_fname, neume_alignment_overlay(pairs), scale, tile_size)
+
+
+def draw_mei_doc(in_png, out_fname, meiDoc, text_size=60, zones=None, scale=1.0, tile_size=None):
+    '''
+    Given an encoded mei_doc result, draws the result on the original page (given a
+    path to the .png), scaled or tiled as in draw_page. @zones is the ZoneRegistry the document
+    was built with, if available.
+    '''
+    return draw_page(in_png, out_fname, mei_doc_overlay(meiDoc, zones), scale, tile_size)
+
+
+def _draw_mei_file(page, scale, tile_size):
+    try:
+        draw_page(page.png, page.output, mei_file_overlay(page.mei), scale, tile_size)
+    except Exception:
+        return traceback.format_exc()
+    return None
+
+
+def draw_mei_files(pages, scale=1.0, tile_size=None, threads=None):
+    '''
+    Draws the MEI file of every OverlayPage in @pages over its page image, in a pool of @threads
+    threads (by default, as many as ThreadPoolExecutor picks); PIL decodes, scales and encodes
+    images without holding the GIL. A page that fails doesn't stop the rest. Returns, for every
+    page in order, the formatted exception it failed with, or None.
+    '''
+    with ThreadPoolExecutor(threads) as pool:
+        return list(pool.map(lambda page: _draw_mei_file(page, scale, tile_size), pages))
+
+
+def main(argv=None):
+    '''
+    Draws overlays for every row (png, mei, output) of a CSV manifest:
+        python visualize_alignment.py pages.csv [scale] [tile_size] [threads]
+    '''
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv:
+        print(main.__doc__)
+        return 1
+    scale = float(argv[1]) if len(argv) > 1 else 1.0
+    tile_size = int(argv[2]) if len(argv) > 2 and int(argv[2]) > 0 else None
+    threads = int(argv[3]) if len(argv) > 3 else None
+
+    with open(argv[0]) as f:
+        pages = [OverlayPage(row['png'], row['mei'], row['output']) for row in csv.DictReader(f)]
+    errors = draw_mei_files(pages, scale, tile_size, threads)
+    for page, error in zip(pages, errors):
+        print('{} {}'.format('failed' if error else 'drew', page.output))
+        if error:
+            print(error)
+    return 1 if any(errors) else 0
 
-    all_syllables = meiDoc.getElementsByName('syllable')
-    surface = meiDoc.getElementsByName('surface')[0]
-
-    # build a dictionary linking each zone's ID to its element object for easy access
-    surf_dict = {}
-    for c in surface.getChildren():
-        surf_dict[c.id] = {}
-        for coord in c.attributes:
-            surf_dict[c.id][coord.name] = int(coord.value)
-
-    for syllable in all_syllables:
-        neumes = syllable.getChildrenByName('neume')
-
-        for n in neumes:
-            nc_ids = [x.getAttribute('facs').value[1:] for x in n.children]
-            zones = [surf_dict[x] for x in nc_ids]
-            ulx = min([z['ulx'] for z in zones])
-            uly = min([z['uly'] for z in zones])
-            lrx = max([z['lrx'] for z in zones])
-            lry = max([z['lry'] for z in zones])
-
-            draw.rectangle((ulx, uly, lrx, lry), outline='black')
-            neume_avg_x = (ulx + lrx) // 2
-            neume_avg_y = (uly + lry) // 2
-
-            syl = syllable.getChildrenByName('syl')[0]
-            syl_zone = surf_dict[syl.getAttribute('facs').value[1:]]
-            syl_avg_x = (syl_zone['ulx'] + syl_zone['lrx']) // 2
-            syl_avg_y = (syl_zone['uly'] + syl_zone['lry']) // 2
-
-            # don't draw a line to a blank syllable
-            if not syl_avg_x or syl_avg_y:
-                continue
-            draw.line((neume_avg_x, neume_avg_y, syl_avg_x, syl_avg_y), fill='black', width=3)
 
-    im.save(out_fname)
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,97 @@
+from collections import namedtuple
+
+Zone = namedtuple('Zone', ['ulx', 'uly', 'lrx', 'lry'])
+
+
+class ZoneRegistry(object):
+    '''
+    Keeps track of the zones in the <surface> of an MEI document, so that every distinct bounding
+    box is written out as a zone only once: all the neume components of a ligature or podatus
+    share their glyph's bounding box, for example, and now share its zone too.
+
+    Registering a bounding box returns the ID of its zone, creating the zone (as an @element_cls
+    element added to @surface) only the first time that box is seen. The geometry of every zone
+    can be looked up by ID (registry[zone_id].ulx, ...), and @widths holds the width of every
+    registration in order, repeats included, which is what the neume component merging heuristic
+    takes its median over.
+    '''
+
+    def __init__(self, surface=None, element_cls=None):
+        self.surface = surface
+        self.element_cls = element_cls
+        self.widths = []
+        self._ids = {}
+        self._zones = {}
+
+    @classmethod
+    def from_surface(cls, surface):
+        '''
+        Builds a registry from the zones already in an existing @surface element, e.g. one read
+        from an MEI file rather than built by build_mei.
+        '''
+        registry = cls(surface)
+        for c in surface.getChildren():
+            coords = dict((a.name, int(a.value)) for a in c.attributes)
+            zone = Zone(coords['ulx'], coords['uly'], coords['lrx'], coords['lry'])
+            registry._ids.setdefault(zone, c.id)
+            registry._zones[c.id] = zone
+            registry.widths.append(zone.lrx - zone.ulx)
+        return registry
+
+    def register(self, bb, zone_id=None):
+        '''
+        Given a bounding box (anything with ulx, uly, lrx and lry keys), returns the ID of the zone
+        for it, adding a new zone element to the surface if there isn't one yet. A new zone gets
+        @zone_id as its ID, if given.
+        '''
+        zone = Zone(bb['ulx'], bb['uly'], bb['lrx'], bb['lry'])
+        self.widths.append(zone.lrx - zone.ulx)
+
+        existing_id = self._ids.get(zone)
+        if existing_id is not None:
+            return existing_id
+
+        el = self.element_cls('zone')
+        if zone_id is not None:
+            el.setId(zone_id)
+        for name, value in zip(Zone._fields, zone):
+            if value is not None:
+                el.addAttribute(name, str(value))
+        self.surface.addChild(el)
+
+        zone_id = el.getId()
+        self._ids[zone] = zone_id
+        self._zones[zone_id] = zone
+        return zone_id
+
+    def get_id(self, bb):
+        '''
+        Returns the ID of the zone for the bounding box @bb if there is one, or None, without
+        registering it.
+        '''
+        return self._ids.get(Zone(bb['ulx'], bb['uly'], bb['lrx'], bb['lry']))
+
+    def add(self, zone_id, bb):
+        '''
+        Registers the zone @zone_id for the bounding box @bb without creating an element, for a
+        zone that is written to the surface some other way (e.g. already serialized).
+        '''
+        zone = Zone(bb['ulx'], bb['uly'], bb['lrx'], bb['lry'])
+        self.widths.append(zone.lrx - zone.ulx)
+        self._ids[zone] = zone_id
+        self._zones[zone_id] = zone
+
+    def items(self):
+        '''
+        Returns (zone ID, Zone) pairs for all zones.
+        '''
+        return self._zones.items()
+
+    def __getitem__(self, zone_id):
+        return self._zones[zone_id]
+
+    def __contains__(self, zone_id):
+        return zone_id in self._zones
+
+    def __len__(self):
+        return len(self._zones)